@@ -0,0 +1,33 @@
+from sqlalchemy import Column, Integer, String, DateTime, Boolean
+from datetime import datetime, timezone
+from model.basemodel import Base
+
+# 任务事件发件箱
+# 任务状态变化时在同一个本地事务内写入一条事件, 由后台发送器按id顺序推送到任务管理器.
+# SQLite同一时间只有一个写事务, 且id自增不复用(sqlite_autoincrement), 因此id的顺序即提交顺序,
+# 发送器只需记录已送达的最大id(高水位)
+
+class VtTaskEvent(Base):
+    __tablename__ = 'vt_task_event'
+
+    id = Column(Integer, primary_key=True)
+    task_id = Column(Integer, nullable=False)
+    status = Column(String(16), nullable=False)
+    report_ready = Column(Boolean, nullable=False, default=False)
+    errmsg = Column(String(256), nullable=True)
+    create_time = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    def __repr__(self):
+        return f"<VtTaskEvent(id={self.id}, task_id={self.task_id}, status={self.status})>"
+
+
+class VtTaskEventMark(Base):
+    """发件箱的高水位, 只有一行"""
+    __tablename__ = 'vt_task_event_mark'
+
+    id = Column(Integer, primary_key=True)
+    # 已送达的最大事件id
+    delivered_id = Column(Integer, nullable=False, default=0)
+    update_time = Column(DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
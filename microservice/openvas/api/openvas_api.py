@@ -1,3 +1,6 @@
+import os
+import threading
+import time
 from datetime import datetime
 from enum import Enum
 from typing import List
@@ -9,10 +12,11 @@ import structlog
 from zh.zh_generate import gvm_zh_report
 from sqlalchemy.exc import SQLAlchemyError
 from fastapi.middleware.cors import CORSMiddleware
-from sqllite_sql import get_db_session
+from sqllite_sql import get_db_session, get_db
 from model.openvas_task import VtOpenvasTask, TaskStatus
 from sqlalchemy.orm import Session
 from sqlalchemy import desc
+from task_events import task_event_sender, record_task_event, events_enabled
 
 # 日志相关
 # 设置结构化日志
@@ -22,6 +26,8 @@ logging.basicConfig(
     datefmt='%Y-%m-%dT%H:%M:%S%z'
 )
 logger = structlog.wrap_logger(logging.getLogger())
+# 检查运行中任务状态的间隔(秒), 状态变化时推送到任务管理器
+watchInterval = float(os.getenv("OPENVAS_WATCH_INTERVAL", "30"))
 
 app = FastAPI()
 
@@ -62,7 +68,7 @@ class OpenvasStatus(Enum):
 
 
 @app.get("/healthz")
-async def healthz(db_session: Session = Depends(get_db_session)):
+async def healthz(db_session: Session = Depends(get_db)):
     return {'ok': True}
 
 def get_db_openvas_task(id: int, db_session: Session) -> VtOpenvasTask:
@@ -75,29 +81,60 @@ def get_db_running_task(db_session: Session) -> List[VtOpenvasTask]:
     tasks = db_session.query(VtOpenvasTask).filter(VtOpenvasTask.status==TaskStatus.RUNNING).order_by(desc(VtOpenvasTask.create_time)).all()
     return tasks
 
+def refresh_task_status(pygvm, task: VtOpenvasTask, db_session: Session):
+    """从gvm获取任务状态并更新本地记录, 状态变化时在同一事务内写入事件, 返回(进度, 状态)"""
+    gvm_task = pygvm.get_task(task_id=task.running_id)
+    progress = gvm_task['progress']
+    status = gvm_task['status']
+    task_status = TaskStatus.RUNNING
+    if status in [OpenvasStatus.FAILED.value, OpenvasStatus.INTERAPTED.value]:
+        task_status = TaskStatus.ERROR
+    if status in [OpenvasStatus.DONE.value]:
+        task_status = TaskStatus.DONE
+    if status in [OpenvasStatus.QUEUED.value, OpenvasStatus.RUNNING.value, OpenvasStatus.REQUESTED.value]:
+        task_status = TaskStatus.RUNNING
+    if task_status != task.status:
+        task.status = task_status
+        if task.status == TaskStatus.DONE:
+            task.finish_time = datetime.now()
+        db_session.add(task)
+        record_task_event(db_session, task.id, task_status.value, report_ready=task_status == TaskStatus.DONE)
+        # 发送器使用自己的连接, 事件提交后才能读到
+        db_session.commit()
+        task_event_sender.wake()
+    return progress, task_status
+
+def watch_running_tasks():
+    """定期检查运行中的任务, 使任务状态变化能及时推送到任务管理器"""
+    while True:
+        time.sleep(watchInterval)
+        pygvm = None
+        try:
+            with get_db_session() as db_session:
+                tasks = get_db_running_task(db_session=db_session)
+                if not tasks:
+                    continue
+                pygvm = get_gvm_conn()
+                for task in tasks:
+                    refresh_task_status(pygvm, task, db_session)
+        except Exception as e:
+            logger.error('Failed to watch gvm tasks: ' + str(e))
+        finally:
+            if pygvm != None:
+                pygvm.disconnect()
+
+# 启动任务事件发送器, 未配置回调密钥时不推送, 也不需要检查任务状态
+task_event_sender.start()
+if events_enabled():
+    threading.Thread(target=watch_running_tasks, name="openvas-watcher", daemon=True).start()
+
 @app.get("/get_task")
 async def get_task(task_id: str = Query(..., description="Global task id"),
-                   db_session: Session = Depends(get_db_session)):
+                   db_session: Session = Depends(get_db)):
     try:
         task: VtOpenvasTask = get_db_openvas_task(task_id, db_session)
-        running_id = task.running_id
         pygvm = get_gvm_conn()
-        task = pygvm.get_task(task_id=running_id)
-        progress = task['progress']
-        status = task['status']
-        task_status = TaskStatus.RUNNING
-        if status in [OpenvasStatus.FAILED.value, OpenvasStatus.INTERAPTED.value]:
-            task_status = TaskStatus.ERROR
-        if status in [OpenvasStatus.DONE]:
-            task_status = TaskStatus.DONE
-        if status in [OpenvasStatus.QUEUED, OpenvasStatus.RUNNING, OpenvasStatus.REQUESTED]:
-            task_status = TaskStatus.RUNNING
-        if task_status != task.status:
-            task.status = task_status
-            if task.status == TaskStatus.DONE:
-                task.finish_time = datetime.now()
-            db_session.add(task)
-            db_session.flush()
+        progress, task_status = refresh_task_status(pygvm, task, db_session)
         return {'ok': True, 'progress': progress, 'status': task_status}
     except Exception as e:
         logger.error('Failed to get gvm task: ' + str(e))
@@ -108,7 +145,7 @@ async def get_task(task_id: str = Query(..., description="Global task id"),
 @app.post("/create_task")
 async def create_task(task_id:str = Query(..., description="Global task id"),
                       target:str = Query(...,  description="Task target"),
-                      db_session: Session = Depends(get_db_session)):
+                      db_session: Session = Depends(get_db)):
     try:
         pygvm = get_gvm_conn()
         # 0. 获取目标
@@ -130,7 +167,9 @@ async def create_task(task_id:str = Query(..., description="Global task id"),
             finish_time=None
         )
         db_session.add(task)
-        db_session.flush()
+        record_task_event(db_session, task_id, TaskStatus.RUNNING.value)
+        db_session.commit()
+        task_event_sender.wake()
         return {'ok': True, 'running_id': running_id}
     except Exception as e:
         logger.error('Failed to create gvm task: ' + str(e))
@@ -140,7 +179,7 @@ async def create_task(task_id:str = Query(..., description="Global task id"),
 
 @app.get("/get_task_result")
 async def get_task_result(task_id:str = Query(..., description="Global task id"),
-                      db_session: Session = Depends(get_db_session)):
+                      db_session: Session = Depends(get_db)):
     try:
         pygvm = get_gvm_conn()
         task:VtOpenvasTask = get_db_openvas_task(id=task_id, db_session=db_session)
@@ -156,7 +195,7 @@ async def get_task_result(task_id:str = Query(..., description="Global task id")
 
 @app.delete("/delete_task")
 async def delete_task(task_id:str = Query(..., description="Global task id"),
-                      db_session: Session = Depends(get_db_session)):
+                      db_session: Session = Depends(get_db)):
     try:
         pygvm = get_gvm_conn()
         task:VtOpenvasTask = get_db_openvas_task(id=task_id, db_session=db_session)
@@ -174,7 +213,7 @@ async def delete_task(task_id:str = Query(..., description="Global task id"),
 
 @app.get("/get_report")
 async def get_report(task_id:str = Query(..., description="Global task id"),
-                      db_session: Session = Depends(get_db_session)):
+                      db_session: Session = Depends(get_db)):
     try:
         pygvm = get_gvm_conn()
         task:VtOpenvasTask = get_db_openvas_task(id=task_id, db_session=db_session)
@@ -194,7 +233,7 @@ async def get_report(task_id:str = Query(..., description="Global task id"),
 
 @app.get("/get_report_zh")
 async def get_report_zh(task_id:str = Query(..., description="Global task id"),
-                        db_session: Session = Depends(get_db_session)):
+                        db_session: Session = Depends(get_db)):
     try:
         pygvm = get_gvm_conn()
         task:VtOpenvasTask = get_db_openvas_task(id=task_id, db_session=db_session)
@@ -214,7 +253,7 @@ async def get_report_zh(task_id:str = Query(..., description="Global task id"),
 # 缩容接口
 @app.get("/scale_in_with_num")
 async def scale_in_with_num(num:str = Query(..., description="task num to scale in"),
-                        db_session: Session = Depends(get_db_session)):
+                        db_session: Session = Depends(get_db)):
     try:
         pygvm = get_gvm_conn()
         tasks:List[VtOpenvasTask] = get_db_running_task(db_session=db_session)
@@ -225,7 +264,10 @@ async def scale_in_with_num(num:str = Query(..., description="task num to scale
             pygvm.stop_task(task_id=running_id)
             task.status = TaskStatus.ERROR
             db_session.add(task)
+            record_task_event(db_session, task.id, TaskStatus.ERROR.value)
             num -= 1
+        db_session.commit()
+        task_event_sender.wake()
         return {'ok':True}
     except Exception as e:
         logger.error('Failed to scale in: ' + str(e))
@@ -1,14 +1,36 @@
+import os
 from contextlib import contextmanager
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from model.basemodel import Base
+# 导入模型, 使create_all能创建对应的表
+import model.openvas_task
+import model.task_event
+
+# 写锁等待时间(毫秒), 追踪线程与接口同时写入时等待而不是直接报database is locked
+sqliteBusyTimeout = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))
+# 调试时打开, 生产环境不输出每条SQL
+sqlEcho = os.getenv("SQL_ECHO", "false").lower() == "true"
 
 # 创建引擎并连接到SQLite数据库
 # 如果数据库文件不存在，将会自动创建
-engine = create_engine('sqlite:///tasks.db', echo=True)
+engine = create_engine('sqlite:///tasks.db', echo=sqlEcho)
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """WAL模式下读写互不阻塞, synchronous=NORMAL在WAL模式下只在checkpoint时fsync"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={sqliteBusyTimeout}")
+    cursor.close()
 
 # 创建所有表
 Base.metadata.create_all(engine)
+# create_all不会为已存在的表补建索引
+for table in Base.metadata.sorted_tables:
+    for index in table.indexes:
+        index.create(engine, checkfirst=True)
 
 # 创建会话工厂
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -25,3 +47,8 @@ def get_db_session():
         raise
     finally:
         db_session.close()
+
+def get_db():
+    """FastAPI依赖: Depends不能直接使用contextmanager, 包装为生成器"""
+    with get_db_session() as db_session:
+        yield db_session
@@ -1,11 +1,18 @@
 from kubernetes import config
 from kubernetes.config.config_exception import ConfigException
 
+# 配置只需要加载一次, 之后创建的client共用
+kube_config_loaded = False
+
 def load_kube_config():
     """
     尝试加载集群内部或外部的 Kubernetes 配置。
     如果在集群内，则使用 incluster 配置；如果在集群外，则加载本地 kubeconfig 文件。
+    重复调用时直接返回。
     """
+    global kube_config_loaded
+    if kube_config_loaded:
+        return
     try:
         # 尝试加载集群内的配置
         config.load_incluster_config()
@@ -16,6 +23,7 @@ def load_kube_config():
             config.load_kube_config()
         except ConfigException as e:
             raise Exception("Could not configure kubernetes python client: %s" % e)
+    kube_config_loaded = True
 
 # 如果希望在导入时自动加载配置，可以在文件末尾调用该函数
 if __name__ == '__main__':
@@ -0,0 +1,191 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+import structlog
+from kubernetes import client, watch
+from kubernetes.client.rest import ApiException
+
+# 基于list+watch的本地缓存
+# 启动时list一次得到全量对象和resourceVersion, 之后从该resourceVersion开始watch增量事件,
+# 读取直接访问本地缓存, 不再每次请求API server. 事件到达时回调handler, 可以立即触发处理.
+# resourceVersion过期(410 Gone)或watch异常时重新list
+
+logging.basicConfig(
+    level=logging.WARNING,
+    format='%(asctime)s %(levelname)s %(message)s',
+    datefmt='%Y-%m-%dT%H:%M:%S%z'
+)
+logger = structlog.wrap_logger(logging.getLogger())
+
+def object_meta(obj) -> dict:
+    """取对象的metadata, 兼容kubernetes模型对象和CRD返回的dict"""
+    if isinstance(obj, dict):
+        metadata = obj.get('metadata', {})
+        return {
+            'name': metadata.get('name'),
+            'namespace': metadata.get('namespace'),
+            'resource_version': metadata.get('resourceVersion'),
+        }
+    return {
+        'name': obj.metadata.name,
+        'namespace': obj.metadata.namespace,
+        'resource_version': obj.metadata.resource_version,
+    }
+
+def object_key(obj) -> str:
+    meta = object_meta(obj)
+    if meta['namespace']:
+        return f"{meta['namespace']}/{meta['name']}"
+    return meta['name']
+
+def list_resource_version(result) -> str:
+    if isinstance(result, dict):
+        return result.get('metadata', {}).get('resourceVersion')
+    return result.metadata.resource_version
+
+def list_items(result) -> list:
+    if isinstance(result, dict):
+        return result.get('items', [])
+    return result.items
+
+class Informer:
+    """单一资源的list+watch缓存
+
+    Keyword arguments:
+    name: 名称, 仅用于日志
+    list_func: kubernetes client的list函数, 同时用于watch
+    list_args/list_kwargs: 传给list_func的参数, 如namespace、label_selector
+    watch_timeout: 每次watch请求的超时时间(秒), 超时后从最新resourceVersion继续watch
+    """
+
+    def __init__(self, name: str, list_func: Callable, list_args: tuple = (), list_kwargs: dict = None,
+                 watch_timeout: int = 300):
+        self.name = name
+        self.list_func = list_func
+        self.list_args = list_args
+        self.list_kwargs = list_kwargs or {}
+        self.watch_timeout = watch_timeout
+        self.store: Dict[str, object] = {}
+        self.lock = threading.Lock()
+        self.resource_version: Optional[str] = None
+        self.synced = threading.Event()
+        self.handlers: List[Callable] = []
+        self.thread: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+
+    def add_handler(self, handler: Callable):
+        """注册事件回调 handler(event_type, obj), event_type: ADDED / MODIFIED / DELETED"""
+        self.handlers.append(handler)
+
+    def start(self):
+        if self.thread != None:
+            return
+        self.thread = threading.Thread(target=self.run, name=f"informer-{self.name}", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def has_synced(self) -> bool:
+        return self.synced.is_set()
+
+    def wait_synced(self, timeout: float = None) -> bool:
+        return self.synced.wait(timeout)
+
+    def list(self) -> list:
+        with self.lock:
+            return list(self.store.values())
+
+    def get(self, key: str):
+        with self.lock:
+            return self.store.get(key)
+
+    def relist(self):
+        result = self.list_func(*self.list_args, **self.list_kwargs)
+        store = {object_key(obj): obj for obj in list_items(result)}
+        with self.lock:
+            old_store = self.store
+            self.store = store
+            self.resource_version = list_resource_version(result)
+        self.synced.set()
+        # 重新list期间可能错过事件, 与旧缓存对比后补发
+        for key, obj in store.items():
+            if key not in old_store:
+                self.dispatch('ADDED', obj)
+            elif object_meta(old_store[key])['resource_version'] != object_meta(obj)['resource_version']:
+                self.dispatch('MODIFIED', obj)
+        for key, obj in old_store.items():
+            if key not in store:
+                self.dispatch('DELETED', obj)
+
+    def dispatch(self, event_type: str, obj):
+        for handler in self.handlers:
+            try:
+                handler(event_type, obj)
+            except Exception as e:
+                logger.error(f"Informer {self.name} handler error: {e}")
+
+    def watch_once(self):
+        w = watch.Watch()
+        for event in w.stream(self.list_func, *self.list_args, resource_version=self.resource_version,
+                              timeout_seconds=self.watch_timeout, **self.list_kwargs):
+            if self.stopped.is_set():
+                w.stop()
+                return
+            event_type = event['type']
+            obj = event['object']
+            if event_type == 'ERROR':
+                # 410 Gone: resourceVersion已过期, 需要重新list
+                code = obj.get('code') if isinstance(obj, dict) else None
+                raise ApiException(status=code or 500, reason=f"watch error event: {obj}")
+            if event_type == 'BOOKMARK':
+                self.resource_version = object_meta(obj)['resource_version']
+                continue
+            key = object_key(obj)
+            with self.lock:
+                if event_type == 'DELETED':
+                    self.store.pop(key, None)
+                else:
+                    self.store[key] = obj
+                self.resource_version = object_meta(obj)['resource_version']
+            self.dispatch(event_type, obj)
+
+    def run(self):
+        backoff = 1
+        need_list = True
+        while not self.stopped.is_set():
+            try:
+                if need_list:
+                    self.relist()
+                    need_list = False
+                self.watch_once()
+                backoff = 1
+            except ApiException as e:
+                if e.status == 410:
+                    logger.warn(f"Informer {self.name} resource version expired, relisting")
+                else:
+                    logger.error(f"Informer {self.name} watch error: {e}")
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, 30)
+                need_list = True
+            except Exception as e:
+                logger.error(f"Informer {self.name} error: {e}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+                need_list = True
+
+def new_pod_informer(namespace: str, label_selector: str = None) -> Informer:
+    v1 = client.CoreV1Api()
+    kwargs = {'namespace': namespace}
+    if label_selector:
+        kwargs['label_selector'] = label_selector
+    return Informer(f"pods-{namespace}", v1.list_namespaced_pod, list_kwargs=kwargs)
+
+def new_node_informer() -> Informer:
+    v1 = client.CoreV1Api()
+    return Informer("nodes", v1.list_node)
+
+def new_custom_object_informer(group: str, version: str, plural: str) -> Informer:
+    api_instance = client.CustomObjectsApi()
+    return Informer(plural, api_instance.list_cluster_custom_object, list_args=(group, version, plural))
@@ -1,9 +1,12 @@
 import logging
+import os
+from typing import Dict
 import structlog
 from fastapi import FastAPI, Request, status as Status, Query
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pod_create import create_pod_from_yaml, check_node_label
+from fastapi.concurrency import run_in_threadpool
+from pod_create import create_pod_from_yaml, create_pods, check_node_label, start_informers, load_pod_template
 
 # 设置结构化日志
 logging.basicConfig(
@@ -12,6 +15,8 @@ logging.basicConfig(
     datefmt='%Y-%m-%dT%H:%M:%S%z'
 )
 logger = structlog.wrap_logger(logging.getLogger())
+# 扫描器pod模板, 启动时加载校验, 文件修改后自动重新加载
+podTemplatePath = os.getenv("POD_TEMPLATE_PATH", "./openvas-pod.yml")
 
 app = FastAPI()
 
@@ -23,6 +28,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
     
+@app.on_event("startup")
+async def startup():
+    # k8s配置只加载一次, node缓存在后台线程中list+watch
+    start_informers()
+    # 模板不合法时直接启动失败
+    load_pod_template(podTemplatePath)
+
 # 全局异常处理器
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
@@ -38,6 +50,7 @@ async def global_exception_handler(request: Request, exc: Exception):
 @app.get("/scale_out_with_node")
 async def list_scanner_resource(
     node_name:str = Query(..., description="Node name"),
+    standby:bool = Query(False, description="Start as warm standby scanner"),
 ):
     """
     Http Code: 状态码200,返回数据:
@@ -58,7 +71,7 @@ async def list_scanner_resource(
             "ok": False,
             "errmsg": f"Openvas data not ready on node {node_name}"
         }
-    success = create_pod_from_yaml(node_name=node_name)
+    success = create_pod_from_yaml(node_name=node_name, yaml_path=podTemplatePath, standby=standby)
     if not success:
         return {
             "ok": False,
@@ -69,6 +82,45 @@ async def list_scanner_resource(
         "errmsg": ""
     }
     
+# 批量扩容接口
+@app.post("/scale_out_batch")
+async def scale_out_batch(
+    node_pods: Dict[str, int],
+    standby:bool = Query(False, description="Start as warm standby scanner"),
+):
+    """
+    按放置方案批量创建pod, 请求体为{node_name: pod数量}, 各pod并发创建
+    
+    Http Code: 状态码200,返回数据:
+    {
+        "ok": True,  # 全部pod创建成功时为True
+        "errmsg": "",
+        "results": [
+            {"node": "node1", "name": "openvas-xxxxx", "ok": True, "errmsg": ""}
+        ]
+    }
+    """
+    results = []
+    node_names = []
+    for node_name, num in node_pods.items():
+        if num <= 0:
+            continue
+        # 首先检查该node是否含有标签openvas_data=ready
+        if not check_node_label(node_name=node_name, label_key="openvas_data", label_value="ready"):
+            results.extend({"node": node_name, "name": None, "ok": False,
+                            "errmsg": f"Openvas data not ready on node {node_name}"} for _ in range(num))
+            continue
+        node_names.extend([node_name] * num)
+    if node_names:
+        results.extend(await run_in_threadpool(create_pods, node_names=node_names, yaml_path=podTemplatePath,
+                                               standby=standby))
+    failed = [result for result in results if not result['ok']]
+    return {
+        "ok": not failed,
+        "errmsg": f"{len(failed)} of {len(results)} pods failed" if failed else "",
+        "results": results
+    }
+
 # 健康检查接口
 @app.get("/healthz")
 async def healthz(
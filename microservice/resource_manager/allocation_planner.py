@@ -0,0 +1,197 @@
+import heapq
+from typing import Dict, List, Tuple
+import numpy as np
+from resource_manager.cluster_state import ClusterState
+
+# 全局并发度分配
+# 贪心方式每次只调整一个并发度并立即调用扫描器/scaler接口, 受循环次数限制, 需要多轮才能收敛.
+# 这里在内存中一次性求出本轮的目标分配:
+#   1. 超过高水位的node, 按engine已分配/应分配比例从高到低释放并发度, 直到回到高低水位中间
+#   2. 各engine的缺口(任务负载 - 已分配并发度)按比例从低到高, 逐个分配到资源余量最大且放得下的node,
+#      node上已有该engine扫描器且支持vpa时直接增加并发度, 否则通过hpa新建pod
+# 结果以差异的形式返回, 由调用方批量执行
+
+class AllocationPlan:
+    """一轮扩缩容的目标分配与当前分配的差异"""
+
+    def __init__(self):
+        # scanner_id -> 目标并发度
+        self.concurrency: Dict[int, int] = {}
+        # engine -> node -> 新建pod数
+        self.pods: Dict[str, Dict[str, int]] = {}
+
+    def add_pod(self, engine: str, node: str):
+        node_pods = self.pods.setdefault(engine, {})
+        node_pods[node] = node_pods.get(node, 0) + 1
+
+    def empty(self) -> bool:
+        return not self.concurrency and not self.pods
+
+class NodeBudget:
+    """node上cpu/memory的使用量与上限"""
+
+    def __init__(self, node: str, cpu_total: float, memory_total: float, cpu_usage: float, memory_usage: float):
+        self.node = node
+        self.total = {'cpu': cpu_total, 'memory': memory_total}
+        self.usage = {'cpu': cpu_usage, 'memory': memory_usage}
+        self.limit = {'cpu': cpu_total, 'memory': memory_total}
+
+    def fits(self, cpu: float, memory: float) -> bool:
+        return self.usage['cpu'] + cpu <= self.limit['cpu'] and self.usage['memory'] + memory <= self.limit['memory']
+
+    def headroom(self) -> float:
+        # 按比例计算的剩余量, 取cpu/memory中较小者
+        return min((self.limit[m] - self.usage[m]) / self.total[m] if self.total[m] > 0 else .0
+                   for m in ('cpu', 'memory'))
+
+def plan_allocation(state: ClusterState,
+                    scalers: Dict[str, Tuple[str, float, float, float, float, float, str, str]],
+                    node_info: Dict[str, Tuple[float, float]],
+                    node_cpu_other: Dict[str, float],
+                    node_memory_other: Dict[str, float],
+                    pending_scanners: List,
+                    watermarks: Dict[str, Tuple[float, float]],
+                    pod_concurrency: int = 1) -> AllocationPlan:
+    """求解本轮的全局分配方案, 不修改state
+
+    Keyword arguments:
+    state: 集群状态模型
+    scalers: 通过engine获取扩缩容注册信息('hpa', 'cpu_cost', 'memory_cost', 'time_cost', 'external_cpu_cost', 'external_memory_cost', 'hostname', 'port')
+    node_info: 通过node_name获取节点的总量信息,('cpu_total' 'memory_total')
+    node_cpu_other/node_memory_other: 除了scanner使用外的负载情况
+    pending_scanners: 已创建但还未就绪的扫描器, 其占用计入node
+    watermarks: {'cpu': (lwl, hwl), 'memory': (lwl, hwl)}
+    pod_concurrency: 新建pod的并发度
+    """
+    plan = AllocationPlan()
+    assigned = state.engine_assigned.copy()
+    concurrency: Dict[int, int] = {}
+
+    def current(scanner) -> int:
+        return concurrency.get(scanner.id, scanner.max_concurrency)
+
+    def assign_rate(metric: str) -> np.ndarray:
+        unit = state.cost[metric] * state.time_cost
+        external = state.external_cost[metric]
+        expected = state.load * unit + external
+        total_assigned = assigned * unit + external
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (total_assigned / total_assigned.sum()) / (expected / expected.sum())
+
+    budgets: Dict[str, NodeBudget] = {}
+    for node in node_info:
+        if node not in node_cpu_other or node not in node_memory_other:
+            continue
+        budgets[node] = NodeBudget(node, node_info[node][0], node_info[node][1],
+                                   state.expected_usage(node, other=node_cpu_other[node], metric='cpu'),
+                                   state.expected_usage(node, other=node_memory_other[node], metric='memory'))
+    for scanner in pending_scanners:
+        if scanner.node not in budgets or scanner.engine not in state.engine_index:
+            continue
+        e = state.engine_index[scanner.engine]
+        for metric in ('cpu', 'memory'):
+            budgets[scanner.node].usage[metric] += state.external_cost[metric][e] \
+                + state.cost[metric][e] * scanner.max_concurrency
+
+    # node上参与计算的scanner, 按engine分组
+    node_members: Dict[str, Dict[int, List]] = {}
+    for node in budgets:
+        members: Dict[int, List] = {}
+        for scanner in state.scanners_on_node(node):
+            i = state.scanner_index[scanner.id]
+            if state.member[i]:
+                members.setdefault(int(state.scanner_engine[i]), []).append(scanner)
+        node_members[node] = members
+
+    # 1. 超过高水位的node释放并发度, 直到回到高低水位中间
+    for node, budget in budgets.items():
+        over = [m for m in ('cpu', 'memory') if budget.usage[m] >= budget.total[m] * watermarks[m][1]]
+        if not over:
+            continue
+        target = {m: budget.total[m] * sum(watermarks[m]) / 2 for m in ('cpu', 'memory')}
+        members = node_members[node]
+        while any(budget.usage[m] > target[m] for m in over):
+            rate = assign_rate(over[0])
+            candidates = [e for e in members if any(current(s) > 0 for s in members[e])]
+            if not candidates:
+                break
+            e = max(candidates, key=lambda c: rate[c])
+            scanner = max(members[e], key=current)
+            num = current(scanner) - 1
+            concurrency[scanner.id] = num
+            assigned[e] -= 1
+            for metric in ('cpu', 'memory'):
+                budget.usage[metric] -= state.cost[metric][e]
+            if num == 0:
+                members[e].remove(scanner)
+                if not members[e]:
+                    del members[e]
+                    for metric in ('cpu', 'memory'):
+                        budget.usage[metric] -= state.external_cost[metric][e]
+        # 本轮缩容过的node不再扩容
+        budget.limit = {'cpu': .0, 'memory': .0}
+
+    # 2. 可以扩容的node: 低于低水位, 最多扩到高水位与中间值之间
+    heap: List[Tuple[float, str]] = []
+    for node, budget in budgets.items():
+        if budget.limit['cpu'] == 0:
+            continue
+        if budget.usage['cpu'] > budget.total['cpu'] * watermarks['cpu'][0] \
+            or budget.usage['memory'] > budget.total['memory'] * watermarks['memory'][0]:
+            continue
+        for metric in ('cpu', 'memory'):
+            lwl, hwl = watermarks[metric]
+            budget.limit[metric] = budget.total[metric] * ((lwl + hwl) / 2 + hwl) / 2
+        heapq.heappush(heap, (-budget.headroom(), node))
+
+    deficit = {
+        e: int(state.load[e] - assigned[e]) for e, engine in enumerate(state.engines)
+        if state.load[e] > assigned[e] and ('vpa' in scalers[engine][0] or 'hpa' in scalers[engine][0])
+    }
+    while deficit and heap:
+        rate = assign_rate('cpu')
+        e = min(deficit, key=lambda c: rate[c])
+        engine = state.engines[e]
+        scale_type = scalers[engine][0]
+        cpu_cost = state.cost['cpu'][e]
+        memory_cost = state.cost['memory'][e]
+        # 取出放不下的node, 找到资源余量最大且放得下的node
+        skipped = []
+        placed = False
+        while heap:
+            _, node = heapq.heappop(heap)
+            budget = budgets[node]
+            members = node_members[node].get(e, [])
+            if 'vpa' in scale_type and members:
+                if budget.fits(cpu_cost, memory_cost):
+                    scanner = min(members, key=current)
+                    concurrency[scanner.id] = current(scanner) + 1
+                    budget.usage['cpu'] += cpu_cost
+                    budget.usage['memory'] += memory_cost
+                    deficit[e] -= 1
+                    assigned[e] += 1
+                    placed = True
+            elif 'hpa' in scale_type:
+                pod_cpu = state.external_cost['cpu'][e] + cpu_cost * pod_concurrency
+                pod_memory = state.external_cost['memory'][e] + memory_cost * pod_concurrency
+                if budget.fits(pod_cpu, pod_memory):
+                    plan.add_pod(engine, node)
+                    budget.usage['cpu'] += pod_cpu
+                    budget.usage['memory'] += pod_memory
+                    deficit[e] -= pod_concurrency
+                    assigned[e] += pod_concurrency
+                    placed = True
+            if placed:
+                heapq.heappush(heap, (-budget.headroom(), node))
+                break
+            skipped.append(node)
+        for node in skipped:
+            heapq.heappush(heap, (-budgets[node].headroom(), node))
+        if not placed or deficit[e] <= 0:
+            # 没有node放得下该engine, 或缺口已补齐
+            del deficit[e]
+
+    for scanner_id, num in concurrency.items():
+        if num != state.get_scanner(scanner_id).max_concurrency:
+            plan.concurrency[scanner_id] = num
+    return plan
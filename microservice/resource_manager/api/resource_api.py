@@ -4,8 +4,8 @@ from typing import Dict
 from pydantic import BaseModel
 import structlog
 from ..model import scanner as Scanner
-from tidb_sql import get_db_session
-from sqlalchemy.orm import Session
+from tidb_async_sql import get_async_db_session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import desc, func
 from fastapi import FastAPI, HTTPException, Request, Depends, status as Status, Query
 from fastapi.responses import JSONResponse, StreamingResponse
@@ -63,7 +63,7 @@ async def global_exception_handler(request: Request, exc: Exception):
 
 @app.get("/list_scanner_resource", response_model=schemas.VtScannerListResponse)
 async def list_scanner_resource(
-    db_session: Session = Depends(get_db_session)
+    db_session: AsyncSession = Depends(get_async_db_session)
 ):
     """
     Http Code: 状态码200,返回数据:
@@ -92,9 +92,9 @@ async def list_scanner_resource(
                 DatabaseError
     """
     query = (
-        db_session.query(Scanner.VtScanner).filter(Scanner.VtScanner.status==Scanner.Status.ENABLE)
+        select(Scanner.VtScanner).filter(Scanner.VtScanner.status==Scanner.Status.ENABLE)
     )
-    scanners = query.all()
+    scanners = (await db_session.execute(query)).scalars().all()
     return schemas.VtScannerListResponse(
         count=len(scanners),
         scanners=scanners
@@ -103,12 +103,17 @@ async def list_scanner_resource(
 @app.post("/update_resource_scanner")
 async def update_resource_scanner(
     scanner_dict: Dict[int, int],
-    db_session: Session = Depends(get_db_session)
+    db_session: AsyncSession = Depends(get_async_db_session)
 ):
+    # 一次查询取出全部需要更新的scanner
+    scanners = (await db_session.execute(
+                    select(Scanner.VtScanner).filter(Scanner.VtScanner.id.in_(list(scanner_dict.keys())))
+                )).scalars().all()
+    db_scanner_dict = {scanner.id: scanner for scanner in scanners}
     for scanner_id in scanner_dict:
-        scanner = db_session.query(Scanner.VtScanner).filter(Scanner.VtScanner.id == scanner_id).first()
+        scanner = db_scanner_dict.get(scanner_id)
         if scanner == None:
-            logger.error(f"Scanner not found: {scanner.id}")
+            logger.error(f"Scanner not found: {scanner_id}")
             raise HTTPException(status_code=404, detail=f"Scanner with id {scanner_id} not found")
         scanner.max_concurrency = scanner_dict[scanner_id]
         db_session.add(scanner)
@@ -120,7 +125,6 @@ async def update_resource_scanner(
 # 健康检查接口
 @app.get("/healthz")
 async def healthz(
-    db_session: Session = Depends(get_db_session)
+    db_session: AsyncSession = Depends(get_async_db_session)
 ):
-    db_session.close()
     return {"status": "ok"}
@@ -0,0 +1,180 @@
+from typing import Dict, List, Tuple
+import numpy as np
+
+# 扩缩容使用的集群状态模型
+# 一轮扩缩容开始时由scalers/scanners构建一次, 以数组保存各scanner的engine、node、并发度,
+# 以及按engine、按(node, engine)汇总的并发度. 扩缩容过程中并发度变化时增量更新汇总值,
+# 已分配比例和期望使用量只需要O(engine数)的向量计算, 不再每次遍历全部scanner
+
+class ClusterState:
+    """集群状态模型
+
+    Keyword arguments:
+    scalers: 通过engine获取扩缩容注册信息('hpa', 'cpu_cost', 'memory_cost', 'time_cost', 'external_cpu_cost', 'external_memory_cost', 'hostname', 'port')
+    scanners: 扫描器列表
+    engine_load: 通过engine获取该engine上的任务负载数量
+    enable_status: 参与node上资源计算的扫描器状态
+    standby: 热备扫描器列表, 不参与计算, 扩容时通过promote_standby转为enable_status
+    """
+
+    def __init__(self, scalers: Dict[str, Tuple], scanners: List, engine_load: Dict[str, int], enable_status,
+                 standby: List = ()):
+        self.engines: List[str] = list(scalers)
+        self.engine_index: Dict[str, int] = {engine: i for i, engine in enumerate(self.engines)}
+        costs = np.array([scalers[engine][1:6] for engine in self.engines], dtype=float).reshape(-1, 5)
+        self.cost = {'cpu': costs[:, 0], 'memory': costs[:, 1]}
+        self.time_cost = costs[:, 2]
+        self.external_cost = {'cpu': costs[:, 3], 'memory': costs[:, 4]}
+        self.load = np.array([engine_load.get(engine, 0) for engine in self.engines], dtype=float)
+
+        self.scanners = list(scanners)
+        self.nodes: List[str] = []
+        self.node_index: Dict[str, int] = {}
+        self.scanner_index: Dict[int, int] = {}
+        self.node_scanners: Dict[str, List] = {}
+        scanner_engine = []
+        scanner_node = []
+        concurrency = []
+        member = []
+        for i, scanner in enumerate(self.scanners):
+            self.scanner_index[scanner.id] = i
+            if scanner.node not in self.node_index:
+                self.node_index[scanner.node] = len(self.nodes)
+                self.nodes.append(scanner.node)
+                self.node_scanners[scanner.node] = []
+            self.node_scanners[scanner.node].append(scanner)
+            scanner_engine.append(self.engine_index.get(scanner.engine, -1))
+            scanner_node.append(self.node_index[scanner.node])
+            concurrency.append(scanner.max_concurrency)
+            member.append(scanner.engine in self.engine_index and scanner.status == enable_status)
+        self.scanner_engine = np.array(scanner_engine, dtype=int)
+        self.scanner_node = np.array(scanner_node, dtype=int)
+        self.concurrency = np.array(concurrency, dtype=float)
+        # 参与node资源计算的scanner, 缩容失败或并发度降为0后移出
+        self.member = np.array(member, dtype=bool)
+
+        engine_num = len(self.engines)
+        known = self.scanner_engine >= 0
+        # 各engine的已分配并发度
+        self.engine_assigned = np.bincount(self.scanner_engine[known], weights=self.concurrency[known],
+                                           minlength=engine_num).astype(float)
+        # 各(node, engine)上参与计算的并发度, 以及该engine在node上是否有扫描器
+        self.node_engine_concurrency = np.zeros((len(self.nodes), engine_num), dtype=float)
+        self.node_engine_present = np.zeros((len(self.nodes), engine_num), dtype=bool)
+        np.add.at(self.node_engine_concurrency, (self.scanner_node[self.member], self.scanner_engine[self.member]),
+                  self.concurrency[self.member])
+        self.node_engine_present[self.scanner_node[self.member], self.scanner_engine[self.member]] = True
+        self.assign_rate_cache: Dict[str, List[Tuple[float, str]]] = {}
+        self.enable_status = enable_status
+        # 热备扫描器, 按engine分组
+        self.standby: Dict[str, List] = {}
+        for scanner in standby:
+            if scanner.engine in self.engine_index:
+                self.standby.setdefault(scanner.engine, []).append(scanner)
+
+    def get_scanner(self, scanner_id: int):
+        i = self.scanner_index.get(scanner_id)
+        if i == None:
+            return None
+        return self.scanners[i]
+
+    def scanners_on_node(self, node: str) -> List:
+        return self.node_scanners.get(node, [])
+
+    def add_scanner(self, scanner):
+        """加入一个新的参与计算的scanner, 并增量更新汇总值"""
+        i = len(self.scanners)
+        self.scanners.append(scanner)
+        self.scanner_index[scanner.id] = i
+        if scanner.node not in self.node_index:
+            self.node_index[scanner.node] = len(self.nodes)
+            self.nodes.append(scanner.node)
+            self.node_scanners[scanner.node] = []
+            row = np.zeros((1, len(self.engines)))
+            self.node_engine_concurrency = np.vstack([self.node_engine_concurrency, row])
+            self.node_engine_present = np.vstack([self.node_engine_present, row.astype(bool)])
+        self.node_scanners[scanner.node].append(scanner)
+        n = self.node_index[scanner.node]
+        engine = self.engine_index.get(scanner.engine, -1)
+        self.scanner_engine = np.append(self.scanner_engine, engine)
+        self.scanner_node = np.append(self.scanner_node, n)
+        self.concurrency = np.append(self.concurrency, float(scanner.max_concurrency))
+        self.member = np.append(self.member, engine >= 0)
+        if engine < 0:
+            return
+        self.engine_assigned[engine] += scanner.max_concurrency
+        self.node_engine_concurrency[n, engine] += scanner.max_concurrency
+        self.node_engine_present[n, engine] = True
+        self.assign_rate_cache.clear()
+
+    def promote_standby(self, engine: str, node: str = None):
+        """将engine的一个热备扫描器转为enable_status并加入计算, node为None时不限node
+
+        Return: 转换的scanner, 没有可用的热备扫描器时返回None
+        """
+        for scanner in self.standby.get(engine, []):
+            if node == None or scanner.node == node:
+                self.standby[engine].remove(scanner)
+                scanner.status = self.enable_status
+                self.add_scanner(scanner)
+                return scanner
+        return None
+
+    def set_concurrency(self, scanner, num: int):
+        """修改scanner的并发度, 并增量更新汇总值"""
+        i = self.scanner_index[scanner.id]
+        delta = num - self.concurrency[i]
+        scanner.max_concurrency = num
+        if delta == 0:
+            return
+        self.concurrency[i] = num
+        engine = self.scanner_engine[i]
+        if engine < 0:
+            return
+        self.engine_assigned[engine] += delta
+        if self.member[i]:
+            self.node_engine_concurrency[self.scanner_node[i], engine] += delta
+        self.assign_rate_cache.clear()
+
+    def detach(self, scanner):
+        """scanner不再参与所在node的资源计算"""
+        i = self.scanner_index[scanner.id]
+        if not self.member[i]:
+            return
+        self.member[i] = False
+        self.node_engine_concurrency[self.scanner_node[i], self.scanner_engine[i]] -= self.concurrency[i]
+
+    def assign_rate(self, metric: str) -> List[Tuple[float, str]]:
+        """计算各个engine 已分配比例/应分配比例
+
+        Keyword arguments:
+        metric: 不同的计算指标: cpu/memory
+        Return:
+        assign_rate_list: [(1, 'openvas), (1, 'zap')]
+        """
+        if metric in self.assign_rate_cache:
+            return list(self.assign_rate_cache[metric])
+        unit = self.cost[metric] * self.time_cost
+        external = self.external_cost[metric]
+        expected = self.load * unit + external
+        assigned = self.engine_assigned * unit + external
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rate = (assigned / assigned.sum()) / (expected / expected.sum())
+        assign_rate_list = [(float(r), engine) for r, engine in zip(rate, self.engines)]
+        self.assign_rate_cache[metric] = assign_rate_list
+        return list(assign_rate_list)
+
+    def expected_usage(self, node: str, other: float, metric: str) -> float:
+        """计算某node上某指标的期望使用值
+
+        Keyword arguments:
+        node: 节点名
+        other: 除了scanner使用外的负载情况
+        metric: 指标, cpu/memory
+        """
+        if node not in self.node_index:
+            return other
+        n = self.node_index[node]
+        usage = self.node_engine_present[n] @ self.external_cost[metric] \
+            + self.node_engine_concurrency[n] @ self.cost[metric]
+        return other + float(usage)
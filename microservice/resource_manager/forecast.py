@@ -0,0 +1,59 @@
+from typing import List, Optional
+
+# 扩缩容输入的平滑与趋势预测
+# 瞬时采样在扫描突发时波动很大, 直接使用会导致反复扩缩容,
+# 这里基于历史序列做平滑, 并外推horizon步之后的值
+
+def ewma(values: List[float], alpha: float = 0.3) -> Optional[float]:
+    """指数加权移动平均, 返回序列末尾的平滑值"""
+    if not values:
+        return None
+    smoothed = values[0]
+    for value in values[1:]:
+        smoothed = alpha * value + (1 - alpha) * smoothed
+    return smoothed
+
+def linear_trend(values: List[float], horizon: int = 1) -> Optional[float]:
+    """最小二乘线性拟合, 外推horizon步之后的值"""
+    n = len(values)
+    if n == 0:
+        return None
+    if n == 1:
+        return values[0]
+    x_mean = (n - 1) / 2
+    y_mean = sum(values) / n
+    numerator = .0
+    denominator = .0
+    for i, value in enumerate(values):
+        numerator += (i - x_mean) * (value - y_mean)
+        denominator += (i - x_mean) ** 2
+    slope = numerator / denominator if denominator > 0 else .0
+    intercept = y_mean - slope * x_mean
+    return intercept + slope * (n - 1 + horizon)
+
+def holt(values: List[float], alpha: float = 0.5, beta: float = 0.3, horizon: int = 1) -> Optional[float]:
+    """Holt双指数平滑(水平+趋势), 外推horizon步之后的值"""
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    level = values[0]
+    trend = values[1] - values[0]
+    for value in values[1:]:
+        last_level = level
+        level = alpha * value + (1 - alpha) * (level + trend)
+        trend = beta * (level - last_level) + (1 - beta) * trend
+    return level + horizon * trend
+
+def forecast(values: List[float], method: str, horizon: int = 1,
+             alpha: float = 0.3, beta: float = 0.3) -> Optional[float]:
+    """按method预测, method: ewma / linear / holt, 其他值返回最新采样"""
+    if not values:
+        return None
+    if method == 'ewma':
+        return ewma(values, alpha=alpha)
+    if method == 'linear':
+        return linear_trend(values, horizon=horizon)
+    if method == 'holt':
+        return holt(values, alpha=alpha, beta=beta, horizon=horizon)
+    return values[-1]
@@ -1,48 +1,56 @@
 from sqlalchemy import Column, Integer, String, Enum, Boolean, DateTime
 from sqlalchemy.ext.declarative import declarative_base
-# from enum import Enum as PyEnum
+from enum import Enum as PyEnum
 from datetime import datetime
 from sqlalchemy.orm import relationship
 from basemodel import Base
 from datetime import timezone
 
-class ScannerType(Enum):
+class ScannerType(str, PyEnum):
     WEB = 'web'
     HOST = 'host'
 
-class Status(Enum):
+class Status(str, PyEnum):
     ENABLE = 'enable'
     WAITING = 'waiting'
     DISABLE = 'disable'
     DELETED = 'deleted'
     DELETING = 'deleting'
+    # 预先启动的热备扫描器, 不分配任务, 扩容时直接转为ENABLE
+    STANDBY = 'standby'
 
-class ScannerEngine(Enum):
+class ScannerEngine(str, PyEnum):
     ZAP = 'zaproxy'
     OPENVAS = 'openvas'
 
-class FileType(Enum):
+class FileType(str, PyEnum):
     HTML = 'html'
     PDF = 'pdf'
     XML = 'xml'
 
+def enum_values(enum_class):
+    # 数据库中保存枚举的值而不是名称
+    return [member.value for member in enum_class]
+
 class VtScanner(Base):
     __tablename__ = 'vt_scanner'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
 
     name = Column(String(255), unique=True, nullable=False)
-    type = Column(Enum(ScannerType), nullable=False)
-    engine = Column(Enum(ScannerEngine), nullable=False)
+    type = Column(Enum(ScannerType, values_callable=enum_values), nullable=False)
+    engine = Column(Enum(ScannerEngine, values_callable=enum_values), nullable=False)
     ipaddr = Column(String(16), nullable=False)
     port = Column(String, nullable=False)
     node = Column(String, nullable=False)
-    filetype = Column(Enum(ScannerType), nullable=False)
-    status = Column(Enum(Status), default=Status.ENABLE.value, nullable=False)
+    filetype = Column(Enum(FileType, values_callable=enum_values), nullable=False)
+    # 新增STANDBY状态, 已存在的表需手动执行:
+    # ALTER TABLE vt_scanner MODIFY status ENUM('enable','waiting','disable','deleted','deleting','standby') NOT NULL;
+    status = Column(Enum(Status, values_callable=enum_values), default=Status.ENABLE.value, nullable=False)
     max_concurrency = Column(Integer, nullable=False)
     except_num = Column(Integer, default=0)
-    create_time = Column(DateTime, default=datetime.now(timezone.utc))
-    update_time = Column(DateTime, default=datetime.now(timezone.utc), onupdate=datetime.now(timezone.utc))
+    create_time = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    update_time = Column(DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
 
     # Relationships
     tasks = relationship("VtTask", back_populates="scanner")
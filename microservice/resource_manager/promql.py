@@ -1,8 +1,11 @@
 import logging
 import os
-from typing import Dict
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
 import requests
-from urllib.parse import urlencode, quote
+from requests.adapters import HTTPAdapter
 from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
 import structlog
 
@@ -16,6 +19,39 @@ prometheusHost = os.getenv("PROMETHEUS_HOST", "localhost")
 prometheusPort = os.getenv("PROMETHEUS_PORT", "9090")
 prometheusUrl = f"http://{prometheusHost}:{prometheusPort}"
 namespace = os.getenv("NAMESPACE", "vtscanner")
+# 查询超时时间(秒)
+prometheusTimeout = float(os.getenv("PROMETHEUS_TIMEOUT", "5"))
+# 查询结果缓存时间(秒), 一轮扩缩容内的重复查询直接命中缓存
+prometheusCacheTtl = float(os.getenv("PROMETHEUS_CACHE_TTL", "10"))
+# 查询方式: parallel 并发发送各个查询 / combined 合并为一个查询 / recording 使用recording rule
+prometheusQueryMode = os.getenv("PROMETHEUS_QUERY_MODE", "parallel")
+
+# 复用连接的HTTP会话
+prometheus_session = requests.Session()
+prometheus_session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=8))
+
+# 查询结果缓存 query -> (缓存时间, data)
+query_cache: Dict[str, Tuple[float, dict]] = {}
+query_cache_lock = threading.Lock()
+
+# 各指标的查询语句, recording rule见 promethues/vtscan-recording-rules.yml
+METRIC_QUERIES = {
+    'node_cpu_available': 'sum by (node) (rate(node_cpu_seconds_total{mode="idle"}[1m]))',
+    'namespace_cpu_used': f'sum by (instance) (rate(container_cpu_usage_seconds_total{{namespace="{namespace}"}}[1m]))',
+    'namespace_memory_used': f'sum by (instance) (container_memory_rss{{namespace="{namespace}"}})',
+    'node_memory_available': 'node_memory_MemAvailable_bytes',
+}
+RECORDING_RULES = {
+    'node_cpu_available': 'vtscan:node_cpu_idle:rate1m',
+    'namespace_cpu_used': 'vtscan:namespace_cpu_used:rate1m',
+    'namespace_memory_used': 'vtscan:namespace_memory_rss:sum',
+    'node_memory_available': 'node_memory_MemAvailable_bytes',
+}
+
+def metric_query(metric: str) -> str:
+    if prometheusQueryMode == 'recording':
+        return RECORDING_RULES[metric]
+    return METRIC_QUERIES[metric]
 
 def handle_retry_error(retry_state):
     logger.error(f"All retries failed with exception: {retry_state.outcome.exception()}")
@@ -50,17 +86,13 @@ def handle_retry_error(retry_state):
     retry=(retry_if_exception_type(requests.exceptions.Timeout) | retry_if_exception_type(requests.exceptions.ConnectionError)),
     retry_error_callback=handle_retry_error
 )
-def query_prometheus(query: str):
-    # 构建查询参数
-    params = {
-        'query': query
-    }
-    # 编码查询参数，确保URL安全
-    encoded_params = urlencode(params, quote_via=quote)
-    # 完整的API URL
-    api_url = f'{prometheusUrl}/api/v1/query?{encoded_params}'
-    # 发送GET请求到Prometheus API
-    response = requests.get(api_url)
+def fetch_prometheus(query: str):
+    # 发送GET请求到Prometheus API, requests负责编码查询参数
+    response = prometheus_session.get(
+        f'{prometheusUrl}/api/v1/query',
+        params={'query': query},
+        timeout=prometheusTimeout
+    )
     response.raise_for_status()
     
     data = response.json()
@@ -69,9 +101,84 @@ def query_prometheus(query: str):
         raise Exception(f"Prometeues query failed: {data.get('error', 'Unknown error')}")
     return data['data']
 
+def get_cached_query(query: str):
+    with query_cache_lock:
+        cached = query_cache.get(query)
+    if cached == None or time.monotonic() - cached[0] > prometheusCacheTtl:
+        return None
+    return cached[1]
+
+def set_cached_query(query: str, data: dict):
+    with query_cache_lock:
+        query_cache[query] = (time.monotonic(), data)
+
+def clear_query_cache():
+    """开始新一轮扩缩容前清空缓存"""
+    with query_cache_lock:
+        query_cache.clear()
+
+def query_prometheus(query: str):
+    data = get_cached_query(query)
+    if data != None:
+        return data
+    data = fetch_prometheus(query)
+    if data == None:
+        raise Exception(f"Prometeues query {query} failed")
+    set_cached_query(query, data)
+    return data
+
+def query_prometheus_batch(queries: List[str]) -> Dict[str, dict]:
+    """并发发送多个查询, 结果写入缓存"""
+    results = {}
+    missing = []
+    for query in queries:
+        data = get_cached_query(query)
+        if data != None:
+            results[query] = data
+        else:
+            missing.append(query)
+    if not missing:
+        return results
+    with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+        futures = {query: executor.submit(query_prometheus, query) for query in missing}
+        for query, future in futures.items():
+            try:
+                results[query] = future.result()
+            except Exception as e:
+                logger.error(f"Prometeues query {query} failed: {e}")
+    return results
+
+def query_prometheus_combined(metrics: List[str]) -> Dict[str, dict]:
+    """将多个指标合并为一个查询, 通过vt_metric标签拆分结果并写入缓存"""
+    parts = [
+        f'label_replace({metric_query(metric)}, "vt_metric", "{metric}", "", "")'
+        for metric in metrics
+    ]
+    data = query_prometheus(' or '.join(parts))
+    split = {metric: {'resultType': data.get('resultType', 'vector'), 'result': []} for metric in metrics}
+    for result in data['result']:
+        # 合并查询的原始结果已经写入缓存, 拆分时复制, 不修改原始结果
+        labels = dict(result['metric'])
+        metric = labels.pop('vt_metric', None)
+        if metric in split:
+            split[metric]['result'].append(dict(result, metric=labels))
+    results = {}
+    for metric in metrics:
+        query = metric_query(metric)
+        set_cached_query(query, split[metric])
+        results[query] = split[metric]
+    return results
+
+def prefetch_node_metrics():
+    """一次性获取一轮扩缩容需要的全部指标, 后续查询直接命中缓存"""
+    metrics = list(METRIC_QUERIES.keys())
+    if prometheusQueryMode == 'combined':
+        return query_prometheus_combined(metrics)
+    return query_prometheus_batch([metric_query(metric) for metric in metrics])
+
 def query_nodes_cpu_avaliable() -> Dict[str, float]:
     # 查询node整体的idle
-    query = 'sum by (node) (rate(node_cpu_seconds_total{mode="idle"}[1m]))'
+    query = metric_query('node_cpu_available')
     # 初始化结果字典
     cpu_available_cores_dict = {}
     try:
@@ -88,14 +195,14 @@ def query_nodes_cpu_avaliable() -> Dict[str, float]:
 
 def query_namespace_cpu_used():
     # 查询namespace=vtscan的usage时间
-    query = f'sum by (instance) (rate(container_cpu_usage_seconds_total{{namespace="{namespace}"}}[1m]))'
+    query = metric_query('namespace_cpu_used')
     cpu_used_dict = {}
     try:
         data = query_prometheus(query)
     except Exception as e:
         logger.error(f"Prometeues namespace used cpu query failed: {e}") 
         raise
-    for result in data['data']['result']:
+    for result in data['result']:
         node_name = result['metric'].get('instance', 'unknown')
         used_rate = float(result['value'][1])  # 将字符串转换为浮点数
         cpu_used_dict[node_name] = used_rate
@@ -103,14 +210,14 @@ def query_namespace_cpu_used():
 
 def query_namespace_memory_used():
     # 查询namespace=vtscan的memory使用
-    query = f'sum by (instance) (container_memory_rss{{namespace="{namespace}"}})'
+    query = metric_query('namespace_memory_used')
     memory_used_dict = {}
     try:
         data = query_prometheus(query)
     except Exception as e:
         logger.error(f"Prometeues namespace available memory query failed: {e}") 
         raise
-    for result in data['data']['result']:
+    for result in data['result']:
         node_name = result['metric'].get('instance', 'unknown')
         used = float(result['value'][1])  # 将字符串转换为浮点数
         memory_used_dict[node_name] = used
@@ -118,19 +225,65 @@ def query_namespace_memory_used():
 
 def query_nodes_memory_available():
     # 查询namespace=vtscan的memory使用
-    query = f'node_memory_MemAvailable_bytes'
+    query = metric_query('node_memory_available')
     memory_available_dict = {}
     try:
         data = query_prometheus(query)
     except Exception as e:
         logger.error(f"Prometeues namespace used memory query failed: {e}") 
         raise
-    for result in data['data']['result']:
+    for result in data['result']:
         node_name = result['metric'].get('node', 'unknown')
         available_memory = float(result['value'][1])  # 将字符串转换为浮点数
         memory_available_dict[node_name] = available_memory
     return memory_available_dict
 
+@retry(
+    stop=stop_after_attempt(5),
+    wait=wait_fixed(1),
+    retry=(retry_if_exception_type(requests.exceptions.Timeout) | retry_if_exception_type(requests.exceptions.ConnectionError)),
+    retry_error_callback=handle_retry_error
+)
+def fetch_prometheus_range(query: str, start: float, end: float, step: str):
+    response = prometheus_session.get(
+        f'{prometheusUrl}/api/v1/query_range',
+        params={'query': query, 'start': start, 'end': end, 'step': step},
+        timeout=prometheusTimeout
+    )
+    response.raise_for_status()
+    data = response.json()
+    if data['status'] != 'success' or "data" not in data:
+        raise Exception(f"Prometeues range query failed: {data.get('error', 'Unknown error')}")
+    return data['data']
+
+def query_prometheus_range(query: str, minutes: int, step: str = '30s') -> Dict[str, List[float]]:
+    """查询最近minutes分钟的序列
+    
+    Return:
+    {
+        "node1": [0.75, 0.68, ...]  按时间升序
+    }
+    """
+    cache_key = f'range:{minutes}:{step}:{query}'
+    data = get_cached_query(cache_key)
+    if data == None:
+        end = time.time()
+        data = fetch_prometheus_range(query, start=end - minutes * 60, end=end, step=step)
+        if data == None:
+            raise Exception(f"Prometeues range query {query} failed")
+        set_cached_query(cache_key, data)
+    series = {}
+    for result in data['result']:
+        name = result['metric'].get('node', result['metric'].get('instance', 'unknown'))
+        series[name] = [float(value[1]) for value in result['values']]
+    return series
+
+def query_nodes_cpu_avaliable_range(minutes: int, step: str = '30s') -> Dict[str, List[float]]:
+    return query_prometheus_range(metric_query('node_cpu_available'), minutes=minutes, step=step)
+
+def query_nodes_memory_available_range(minutes: int, step: str = '30s') -> Dict[str, List[float]]:
+    return query_prometheus_range(metric_query('node_memory_available'), minutes=minutes, step=step)
+
 def nodes_cpu_vt_scan_assignable():
     # 查询node整体的idle时间
     cpu_node_avaliable_dict = query_nodes_cpu_avaliable()
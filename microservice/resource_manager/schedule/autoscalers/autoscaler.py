@@ -1,4 +1,4 @@
-from typing import Dict, List
+from typing import Dict, List, Tuple
 from apscheduler.schedulers.blocking import BlockingScheduler
 import logging
 import structlog
@@ -7,16 +7,26 @@ from resource_manager.model import scanner as Scanner
 import os
 from resource_manager.tidb_sql import get_db_session
 import requests
-from sqlalchemy import Enum, Tuple
+from sqlalchemy import Enum
 from sqlalchemy.orm import Session
 from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
 # from kubernetes import client as k8s_client
 from resource_manager.k8s_client import load_kube_config
+from resource_manager.k8s_informer import Informer, new_pod_informer, new_node_informer, new_custom_object_informer
 from kubernetes import client
 from kubernetes.client import V1PodList
 from kubernetes.client.rest import ApiException
 from datetime import timezone
-from resource_manager.promql import query_nodes_cpu_avaliable, query_namespace_cpu_used, query_namespace_memory_used, query_nodes_memory_available 
+from resource_manager.promql import query_nodes_cpu_avaliable, query_namespace_cpu_used, query_namespace_memory_used, query_nodes_memory_available, \
+    clear_query_cache, prefetch_node_metrics, query_nodes_cpu_avaliable_range, query_nodes_memory_available_range
+from resource_manager.forecast import forecast
+from resource_manager.cluster_state import ClusterState
+from resource_manager.allocation_planner import plan_allocation, AllocationPlan
+from resource_manager.standby_pool import StandbyPool
+from resource_manager.http_client import http_client, none_on_unavailable, httpConnectTimeout
+from collections import deque
+import math
+import time
 from operator import itemgetter
 
 # 设置结构化日志
@@ -40,6 +50,53 @@ memoryHwl = float(os.getenv("MEMORY_HWL", "0.9"))
 memoryLwl = float(os.getenv("MEMORY_LWL", "0.7"))
 cpuWeight = float(os.getenv("CPU_WEIGHT", "0.5"))
 memoryWeight = float(os.getenv("MEMORY_WEIGHT", "0.5"))
+# 预测相关配置, method: none / ewma / linear / holt
+forecastMethod = os.getenv("FORECAST_METHOD", "none")
+forecastWindow = int(os.getenv("FORECAST_WINDOW_MINUTES", "10"))
+forecastStep = os.getenv("FORECAST_STEP", "30s")
+forecastHorizon = int(os.getenv("FORECAST_HORIZON", "2"))
+forecastAlpha = float(os.getenv("FORECAST_ALPHA", "0.3"))
+forecastBeta = float(os.getenv("FORECAST_BETA", "0.3"))
+# 批量扩容需要等待scaler创建完全部pod, 单独设置读超时(秒)
+scalerReadTimeout = float(os.getenv("SCALER_READ_TIMEOUT", "60"))
+# 各engine任务负载的历史, 每轮扩缩容记录一次
+engine_load_history: Dict[str, deque] = {}
+engineLoadHistoryLen = int(os.getenv("ENGINE_LOAD_HISTORY_LEN", "20"))
+# 按node负载扩缩容的方式: greedy 逐个并发度调整 / global 全局求解后批量执行
+autoscalePlanner = os.getenv("AUTOSCALE_PLANNER", "greedy")
+# global方式下新建pod的并发度
+plannerPodConcurrency = int(os.getenv("PLANNER_POD_CONCURRENCY", "1"))
+# 热备扫描器池, STANDBY_POOL_MAX为0时不启用
+standbyPoolMin = int(os.getenv("STANDBY_POOL_MIN", "0"))
+standbyPoolMax = int(os.getenv("STANDBY_POOL_MAX", "0"))
+standbyPoolPerNode = int(os.getenv("STANDBY_POOL_PER_NODE", "1"))
+standbyWindow = int(os.getenv("STANDBY_WINDOW_MINUTES", "30"))
+standby_pool = StandbyPool(window=standbyWindow * 60, pool_min=standbyPoolMin, pool_max=standbyPoolMax,
+                           per_node=standbyPoolPerNode)
+# scalerregisters CRD
+scalerGroup = 'cstcloud.cn'
+scalerVersion = 'v1'
+scalerPlural = 'scalerregisters'
+# node、扫描器pod及scalerregisters的本地缓存, 启动时创建
+node_informer: Informer = None
+pod_informer: Informer = None
+scaler_informer: Informer = None
+
+def start_informers():
+    """启动node、扫描器pod及scalerregisters的list+watch缓存"""
+    global node_informer, pod_informer, scaler_informer
+    node_informer = new_node_informer()
+    pod_informer = new_pod_informer(namespace=scannerNamespace)
+    scaler_informer = new_custom_object_informer(scalerGroup, scalerVersion, scalerPlural)
+    for informer in [node_informer, pod_informer, scaler_informer]:
+        informer.start()
+
+def informer_synced(informer: Informer) -> bool:
+    return informer != None and informer.has_synced()
+
+def current_time() -> float:
+    # 单独封装便于离线模拟时替换为模拟时钟
+    return time.time()
 
 def handle_retry_error(retry_state):
     logger.error(f"All retries failed with exception: {retry_state.outcome.exception()}")
@@ -65,6 +122,37 @@ def get_db_scanners(db_session: Session) -> List[Scanner.VtScanner]:
     )
     return query.all()
 
+def get_standby_scanners(db_session: Session) -> List[Scanner.VtScanner]:
+    """获取已就绪的热备scanner"""
+    return db_session.query(Scanner.VtScanner).filter(Scanner.VtScanner.status == Scanner.Status.STANDBY).all()
+
+def list_pending_standby_pods(db_session: Session) -> Dict[str, Dict[str, int]]:
+    """获取已创建但还未记录到数据库的热备pod数量
+    
+    Return:
+    {
+        'openvas': {'node1': 1}
+    }
+    """
+    pods = fetch_pod_info()
+    if pods == None:
+        return {}
+    names = set(name for (name,) in db_session.query(Scanner.VtScanner.name)
+                .filter(Scanner.VtScanner.status != Scanner.Status.DELETED))
+    pending: Dict[str, Dict[str, int]] = {}
+    for pod in pods.items:
+        labels = pod.metadata.labels or {}
+        if labels.get('standby') != 'true' or pod.metadata.name in names:
+            continue
+        if pod.metadata.deletion_timestamp != None \
+            or pod.status.phase not in [K8sPodStatus.PENDING, K8sPodStatus.RUNNING]:
+            continue
+        # 还未调度时从nodeSelector取目标node
+        node = pod.spec.node_name or (pod.spec.node_selector or {}).get('kubernetes.io/hostname')
+        engine_pending = pending.setdefault(labels.get('engine'), {})
+        engine_pending[node] = engine_pending.get(node, 0) + 1
+    return pending
+
 @retry(
     stop=stop_after_attempt(5),
     wait=wait_fixed(1),
@@ -79,9 +167,11 @@ def fetch_node_info() ->Dict[str, Tuple[float, float]]:
         "node1": (cpu_available, memory_available)
     }
     """
-    v1 = client.CoreV1Api()
-    # 获取所有节点的信息
-    nodes = v1.list_node().items
+    # 获取所有节点的信息, 缓存未同步时直接请求API server
+    if informer_synced(node_informer):
+        nodes = node_informer.list()
+    else:
+        nodes = client.CoreV1Api().list_node().items
     node_info = {}
     for node in nodes:
         total_cpu = node.status.allocatable['cpu']
@@ -98,6 +188,8 @@ def fetch_node_info() ->Dict[str, Tuple[float, float]]:
 )
 def fetch_pod_info():
     """获取openvas扫描器pod信息"""
+    if informer_synced(pod_informer):
+        return V1PodList(items=pod_informer.list())
     v1 = client.CoreV1Api()
     pods = v1.list_namespaced_pod(namespace=scannerNamespace)
     return pods
@@ -117,17 +209,14 @@ def fetch_scaler_info() -> Dict[str, Tuple[str, float, float, float, float, floa
         'zap': ('HPA', 20, 500, num, num, num, hostname, port)
     }
     """
-    # 创建自定义对象 API 实例
-    api_instance = client.CustomObjectsApi()
-
-    # 定义 CRD 的组、版本和复数形式的资源名称
-    group = 'cstcloud.cn'
-    version = 'v1'  # 版本应与 CRD 中定义的一致
-    plural = 'scalerregisters'  # 这应该是你在 CRD 中定义的复数形式
-    namespace = ''
-    scalers = api_instance.list_namespaced_custom_object(group, version, namespace, plural)
+    if informer_synced(scaler_informer):
+        scalers = scaler_informer.list()
+    else:
+        # 创建自定义对象 API 实例
+        api_instance = client.CustomObjectsApi()
+        scalers = api_instance.list_cluster_custom_object(scalerGroup, scalerVersion, scalerPlural)['items']
     scalers_info = {}
-    for scaler in scalers['items']:
+    for scaler in scalers:
         labels = scaler['metadata'].get('labels', {})
         if 'engine' not in labels or not labels['engine']\
             or 'type' not in labels or not labels['type']:
@@ -146,12 +235,7 @@ def fetch_scaler_info() -> Dict[str, Tuple[str, float, float, float, float, floa
     return scalers_info
 
 # query scanner_engine tasks from task manager
-@retry(
-    stop=stop_after_attempt(5),
-    wait=wait_fixed(1),
-    retry=(retry_if_exception_type(requests.exceptions.Timeout) | retry_if_exception_type(requests.exceptions.ConnectionError)),
-    retry_error_callback=handle_retry_error
-)
+@none_on_unavailable
 def list_engine_load() -> Dict[str, int]:
     """从任务管理模块获取所有类型的扫描器的任务负载情况
     
@@ -161,7 +245,7 @@ def list_engine_load() -> Dict[str, int]:
         'zap': 30
     }
     """
-    response = requests.get(
+    response = http_client.get(
         taskManagerUrl + '/list_engine_tasks_num',
     )
     response.raise_for_status()
@@ -175,12 +259,7 @@ def list_engine_load() -> Dict[str, int]:
     return scanner_load
 
 # query scanner running tasks from task manager
-@retry(
-    stop=stop_after_attempt(5),
-    wait=wait_fixed(1),
-    retry=(retry_if_exception_type(requests.exceptions.Timeout) | retry_if_exception_type(requests.exceptions.ConnectionError)),
-    retry_error_callback=handle_retry_error
-)
+@none_on_unavailable
 def list_scanenr_running_tasks_num(engines: List[str]) -> Dict[str, int]:
     """从任务管理模块获取所有扫描器的任务正在执行情况
     
@@ -194,7 +273,7 @@ def list_scanenr_running_tasks_num(engines: List[str]) -> Dict[str, int]:
     data = {
         "engines": engines
     }
-    response = requests.get(
+    response = http_client.get(
         taskManagerUrl + '/list_running_tasks_num',
         json=data
     )
@@ -209,12 +288,7 @@ def list_scanenr_running_tasks_num(engines: List[str]) -> Dict[str, int]:
     return scanner_num
 
 # call scanner to scale in
-@retry(
-    stop=stop_after_attempt(5),
-    wait=wait_fixed(1),
-    retry=(retry_if_exception_type(requests.exceptions.Timeout) | retry_if_exception_type(requests.exceptions.ConnectionError)),
-    retry_error_callback=handle_retry_error
-)
+@none_on_unavailable
 def call_scanner_scale_in(scanner_url:str, num: int):
     """调用某个scanner的缩容接口
     Params:
@@ -225,7 +299,7 @@ def call_scanner_scale_in(scanner_url:str, num: int):
         'errmsg': "msg"
     }
     """
-    response = requests.get(
+    response = http_client.get(
         scanner_url + '/scale_in_with_num',
         params={'num': num},
     )
@@ -236,24 +310,20 @@ def call_scanner_scale_in(scanner_url:str, num: int):
         logger.error(f"Scanner {scanner_url} scale in error: {data['errmsg']}")
     return ok
 
-@retry(
-    stop=stop_after_attempt(5),
-    wait=wait_fixed(1),
-    retry=(retry_if_exception_type(requests.exceptions.Timeout) | retry_if_exception_type(requests.exceptions.ConnectionError)),
-    retry_error_callback=handle_retry_error
-)
-def call_scaler_scale_out(scaler_url:str, node: str):
+@none_on_unavailable
+def call_scaler_scale_out(scaler_url:str, node: str, standby: bool = False):
     """调用某个scaler的HPA扩容接口
-    
+    Params:
+    standby: 是否作为热备扫描器启动
     Return:
     {
         'ok': True,
         'errmsg': "msg"
     }
     """
-    response = requests.get(
+    response = http_client.get(
         scaler_url + '/scale_out_with_node',
-        params={'node_name': node},
+        params={'node_name': node, 'standby': standby},
     )
     response.raise_for_status()
     data = response.json()
@@ -262,8 +332,80 @@ def call_scaler_scale_out(scaler_url:str, node: str):
         logger.error(f"Scale {scaler_url} scale out error: {data['errmsg']}")
     return ok
 
+# 批量扩容会创建pod, 超时后重试可能重复创建, 只在连接失败时重试
+@none_on_unavailable
+def call_scaler_scale_out_batch(scaler_url: str, node_pods: Dict[str, int], standby: bool = False) -> List[dict]:
+    """调用某个scaler的批量HPA扩容接口
+    Params:
+    node_pods: 通过node_name获取需要创建的pod数量
+    standby: 是否作为热备扫描器启动
+    Return:
+    [
+        {"node": "node1", "name": "openvas-xxxxx", "ok": True, "errmsg": ""}
+    ]
+    """
+    response = http_client.post(
+        scaler_url + '/scale_out_batch',
+        params={'standby': standby},
+        json=node_pods,
+        timeout=(httpConnectTimeout, scalerReadTimeout),
+    )
+    response.raise_for_status()
+    data = response.json()
+    if not data['ok']:
+        logger.error(f"Scaler {scaler_url} scale out batch error: {data['errmsg']}")
+    return data['results']
+
+def add_scale_out(scale_outs: Dict[Tuple[str, bool], Dict[str, int]], engine: str, node: str,
+                  standby: bool = False, num: int = 1):
+    """记录本轮需要新建的pod, 数据库会话结束后由submit_scale_outs统一发送
+    
+    Keyword arguments:
+    scale_outs: 通过(engine, standby)获取各node需要新建的pod数量
+    """
+    node_pods = scale_outs.setdefault((engine, standby), {})
+    node_pods[node] = node_pods.get(node, 0) + num
+    # 计划时即计入扩容频率, 本轮补充热备时就能用上
+    if not standby:
+        for _ in range(num):
+            standby_pool.record_scale_out(engine, current_time())
+
+def submit_scale_outs(scale_outs: Dict[Tuple[str, bool], Dict[str, int]],
+                      scalers: Dict[str, Tuple[str, float, float, float, float, float, str, str]]):
+    """每个scaler只发送一次批量扩容请求(热备pod单独一次)"""
+    for (engine, standby), node_pods in scale_outs.items():
+        scaler_url = f"http://{scalers[engine][6]}:{scalers[engine][7]}"
+        try:
+            results = call_scaler_scale_out_batch(scaler_url=scaler_url, node_pods=node_pods, standby=standby)
+        except Exception as e:
+            logger.error(f"Scaler {scaler_url} scale out batch error: {e}")
+            continue
+        if results == None:
+            continue
+        failed = [result for result in results if not result['ok']]
+        if failed:
+            logger.error(f"Scaler {scaler_url} failed to create {len(failed)} of {len(results)} pods")
+
+def promote_standby_scanner(engine: str, node: str, state: ClusterState, db_session: Session):
+    """hpa扩容时优先将热备扫描器转为ENABLE, 不需要等待pod启动
+    
+    Keyword arguments:
+    engine: 扫描器类型
+    node: 节点名, 为None时不限node
+    state: 集群状态模型
+    db_session: 数据库连接
+    Return: 转换的scanner, 没有可用的热备扫描器时返回None
+    """
+    scanner = state.promote_standby(engine, node)
+    if scanner == None:
+        return None
+    db_session.add(scanner)
+    standby_pool.record_scale_out(engine, current_time())
+    logger.info(f"Standby scanner {scanner.name} promoted on node {scanner.node}")
+    return scanner
+
 def scale_in_when_task_load_low(engine_load: Dict[str, int], 
-                                scanners: List[Scanner.VtScanner],
+                                state: ClusterState,
                                 node_usage: Dict[str, float],
                                 scalers: Dict[str, Tuple[str, float, float, float, float, float, str, str]],
                                 db_session: Session):
@@ -271,40 +413,33 @@ def scale_in_when_task_load_low(engine_load: Dict[str, int],
     
     Keyword arguments:
     engine_load: 通过engine获取该engine上的任务负载数量
-    scanners: 扫描器列表
+    state: 集群状态模型
     node_usage: 节点的负载情况
     scalers: 通过node_name获取node的详细情况('hpa', 'cpu_cost', 'memory_cost', 'time_cost', 'external_cpu_cost', 'external_memory_cost', 'external_memory_cost', 'hostname', 'port')
     db_session: 数据库连接
     """
     try:
-        engine_parallel:Dict[str, int] = {}
-        scanner_dict:Dict[int, Scanner.VtScanner] = {}
-        for scanner in scanners:
-            scanner_dict[scanner.id] = scanner
-            engine = scanner.engine
-            num = scanner.max_concurrency
-            if engine in engine_parallel:
-                engine_parallel[engine] += num
-            else:
-                engine_parallel[engine] = num
         need_scale_in = []
         need_scale_num = {}
         for engine in engine_load:
             if engine not in scalers:
                 continue
-            if engine_load[engine] < engine_parallel[engine]:
+            engine_parallel = int(state.engine_assigned[state.engine_index[engine]])
+            if engine_load[engine] < engine_parallel:
                 need_scale_in.append(engine)
-                need_scale_num[engine] = engine_parallel[engine] - engine_load[engine]
+                need_scale_num[engine] = engine_parallel - engine_load[engine]
         # 获取各个scanner运行中的任务数
         scanner_task_num = list_scanenr_running_tasks_num(need_scale_in)
         waiting_scale_in: Dict[str, List[Tuple]] = {}
         for scanner_id in scanner_task_num:
-            parallel_num = scanner_dict[scanner_id].max_concurrency
+            scanner = state.get_scanner(scanner_id)
+            if scanner == None:
+                continue
+            parallel_num = scanner.max_concurrency
             running_num = scanner_task_num[scanner_id]
             # 小于可以触发缩容, 按照node的负载情况排序, 删除掉总差数
-            node_name = scanner_dict[scanner_id].node
-            usage = node_usage[node_name]
-            engine = scanner_dict[scanner_id].engine
+            usage = node_usage[scanner.node]
+            engine = scanner.engine
             if parallel_num > running_num:
                 if engine in waiting_scale_in:
                     waiting_scale_in[engine].append((usage, parallel_num - running_num, scanner_id))
@@ -325,8 +460,8 @@ def scale_in_when_task_load_low(engine_load: Dict[str, int],
                 # call_scanner_scale_in(url, scale_num)
                 need_scale_num[engine] -= scale_num
                 # 数据库中的scanner同样缩容
-                scanner = scanner_dict[scanner_id]
-                scanner.max_concurrency -= scale_num
+                scanner = state.get_scanner(scanner_id)
+                state.set_concurrency(scanner, scanner.max_concurrency - scale_num)
                 # 如果等于0, 则直接进入waiting状态
                 if scanner.max_concurrency == 0:
                     scanner.status = Scanner.Status.WAITING
@@ -335,100 +470,24 @@ def scale_in_when_task_load_low(engine_load: Dict[str, int],
     except Exception as e:
         logger.error(f"scale in with task load low error: {e}")
 
-def compute_assign_rate(engine_load: Dict[str,int],
-                        scanners: List[Scanner.VtScanner],
-                        scalers: Dict[str, Tuple[str, float, float, float, float, float, str, str]], # hpa/vpa, cpu_cost, memory_cost, time_cost, external_cpu_cost, external_memory_cost
-                        metric: str
-                        ) -> List[Tuple[float, str]]:
-    """计算各个engine 已分配比例/应分配比例
-    
-    Keyword arguments:
-    metric: 不同的计算指标: cpu/memory
-    scanners: 扫描器列表
-    scalers: 通过node_name获取node的详细情况('hpa', 'cpu_cost', 'memory_cost', 'time_cost', 'external_cpu_cost', 'external_memory_cost', 'external_memory_cost', 'hostname', 'port')
-    engine_load: 通过engine获取该engine上的任务负载数量
-    Return: 
-    assign_rate_list: [(1, 'openvas), (1, 'zap')]
-    """
-    # 计算by engine的已分配数，即parallel值
-    engine_assigned:Dict[str, int] = {}
-    for scanner in scanners:
-        engine = scanner.engine
-        if engine not in engine_assigned:
-            engine_assigned[engine] = scanner.max_concurrency
-        else:
-            engine_assigned[engine] += scanner.max_concurrency
-    assign_rate_list: List[Tuple[float, str]] = []
-    cost_index = 1 if metric == 'cpu' else 2
-    external_cost = 4 if metric == 'cpu' else 5
-    # 计算应分配的值
-    total_expected_assign = .0
-    expected_assign_rate:Dict[str, float] = {}
-    for engine in scalers:
-        total_expected_assign += engine_load[engine] * scalers[engine][cost_index] * scalers[engine][3] + scalers[engine][external_cost]
-    # 计算各个engine应该分配的比例
-    for engine in scalers:
-        expected_assign_rate[engine] = float(engine_load[engine] * scalers[engine][cost_index] * scalers[engine][3] + scalers[engine][external_cost]) / total_expected_assign
-    # 计算总共已分配的值
-    total_assigned = .0
-    for engine in scalers:
-        total_assigned += engine_assigned[engine] * scalers[engine][cost_index] * scalers[engine][3] + scalers[engine][external_cost]
-    # 计算各个engine已经分配的比例
-    assigned_rate:Dict[str, float] = {}
-    for engine in scalers:
-        assigned_rate[engine] = float(engine_assigned[engine] * scalers[engine][cost_index] * scalers[engine][3] + scalers[engine][external_cost]) / total_assigned
-    for engine in scalers:
-        assign_rate_list.append((assigned_rate[engine] / expected_assign_rate[engine], engine))
-    return assign_rate_list
-
-def compute_usage(other: float,
-                  scanner_dict: Dict[int, Scanner.VtScanner],
-                  node_scanner_dict: Dict[str, List[int]],
-                  metric: str,
-                  scalers: Dict[str, Tuple[str, float, float, float, float, float, str, str]]):
-    """计算某指标的期望使用值
-    
-    Keyword arguments:
-    other: 除了scanner使用外的负载情况
-    scanner_dict: 通过scanner_id获取Vtscanner
-    node_scanner_dict: 通过engine获取某node上全部该类型的scanner
-    metric: 指标, cpu/memory
-    scalers: 通过node_name获取node的详细情况('hpa', 'cpu_cost', 'memory_cost', 'time_cost', 'external_cpu_cost', 'external_memory_cost', 'external_memory_cost', 'hostname', 'port')
-    """
-    
-    expected_usage: float = other
-    for engine in node_scanner_dict:
-        scanner_list = node_scanner_dict[engine]
-        external_cost = scalers[engine][4] if metric == 'cpu' else scalers[engine][5]
-        cost = scalers[engine][1] if metric == 'cpu' else scalers[engine][2]
-        expected_usage += external_cost
-        for scanner_id in scanner_list:
-            scanner = scanner_dict[scanner_id]
-            expected_usage += cost * scanner.max_concurrency
-    return expected_usage
-
-def scale_in_with_metric(metric:str, total: float, other: float, hwl: float, lwl: float,
-                         engine_load: Dict[str, int], 
-                         scanner_dict: Dict[int, Scanner.VtScanner], 
-                         scanners: List[Scanner.VtScanner],
+def scale_in_with_metric(metric:str, node: str, total: float, other: float, hwl: float, lwl: float,
+                         state: ClusterState,
                          node_scanner_dict: Dict[str, List[int]], 
-                         scalers:Dict[str, Tuple[str, float, float, float, float, float, str, str]], 
                          db_session: Session) -> bool:
     """根据某指标判断是否需要缩容
     
     Keyword arguments:
     metric: 指标, cpu/memory
+    node: 节点名
     total: node上该指标的总量
     other: 除了scanner使用外的负载情况
     hwl: 高水位线
     lwl: 低水位线
-    scanner_dict: 通过scanner_id获取Vtscanner
+    state: 集群状态模型
     node_scanner_dict: 通过engine获取某node上全部该类型的scanner
-    scalers: 通过node_name获取node的详细情况('hpa', 'cpu_cost', 'memory_cost', 'time_cost', 'external_cpu_cost', 'external_memory_cost', 'external_memory_cost', 'hostname', 'port')
     db_session: 数据库连接
     """
-    expected_usage = compute_usage(other=other, scanner_dict=scanner_dict, node_scanner_dict=node_scanner_dict,
-                                           metric=metric, scalers=scalers)
+    expected_usage = state.expected_usage(node, other=other, metric=metric)
     has_scale_in = False
     # 如果超出高水位则需要缩容, 否则不需要
     if expected_usage < total * hwl:
@@ -440,8 +499,7 @@ def scale_in_with_metric(metric:str, total: float, other: float, hwl: float, lwl
         has_scale_in = True
         # 对这个node上的所有scanner按照总的已分配/应分配进行排序
         # 排序后对第一个node上有的engine的scanner进行缩容，缩容到未高出水位或不再有scanner
-        assign_rate_list: List[Tuple[float, str]] = compute_assign_rate(engine_load=engine_load, scanners=scanners,
-                                                    scalers=scalers, metric=metric)
+        assign_rate_list: List[Tuple[float, str]] = state.assign_rate(metric)
         assign_rate_list.sort(key=itemgetter(0) ,reverse=True)
         scale_in_no_scanner = False
         for assign_rate in assign_rate_list:
@@ -450,11 +508,12 @@ def scale_in_with_metric(metric:str, total: float, other: float, hwl: float, lwl
             if engine in node_scanner_dict:
                 for i in range(len(node_scanner_dict[engine])-1, -1, -1): # 存在删除操作所以从后向前遍历
                     scanner_id = node_scanner_dict[engine][i]
-                    scanner = scanner_dict[scanner_id]
+                    scanner = state.get_scanner(scanner_id)
                     if scanner.max_concurrency == 0:
                         scanner.status = Scanner.Status.WAITING
                         db_session.add(scanner)
                         node_scanner_dict[engine].remove(scanner_id)
+                        state.detach(scanner)
                         continue
                     else:  # 进行缩容
                         scale_in_no_scanner = True
@@ -463,12 +522,14 @@ def scale_in_with_metric(metric:str, total: float, other: float, hwl: float, lwl
                         if not success:
                             # 缩容失败去缩容别的
                             node_scanner_dict[engine].remove(scanner_id)
+                            state.detach(scanner)
                         else: #缩容成功则退出
-                            scanner.max_concurrency -= 1
+                            state.set_concurrency(scanner, scanner.max_concurrency - 1)
                             if scanner.max_concurrency == 0:
                                 scanner.status = Scanner.Status.WAITING
                                 db_session.add(scanner)
                                 node_scanner_dict[engine].remove(scanner_id)
+                                state.detach(scanner)
                             scale_in_fin = True
                             break
             if scale_in_fin:
@@ -476,9 +537,8 @@ def scale_in_with_metric(metric:str, total: float, other: float, hwl: float, lwl
         # 如果没有scanner可以缩容, 则直接结束
         if not scale_in_no_scanner:
             break
-        # 再次计算 cpu_expected_usage 
-        expected_usage = compute_usage(other=other, scanner_dict=scanner_dict, node_scanner_dict=node_scanner_dict,
-                                        metric='cpu', scalers=scalers)
+        # 再次计算 expected_usage
+        expected_usage = state.expected_usage(node, other=other, metric=metric)
         times += 1
     db_session.flush()
     return has_scale_in
@@ -488,31 +548,30 @@ def scale_out_with_cpu_and_memory(node: str,
                                   cpu_other: float, memory_other: float, 
                                   cpuLwl: float, cpuHwl:float,
                                   memoryLwl: float, memoryHwl: float,
-                                  engine_load: Dict[str, int], 
-                                  scanner_dict: Dict[int, Scanner.VtScanner], 
-                                  scanners: List[Scanner.VtScanner],
+                                  state: ClusterState,
                                   node_scanner_dict: Dict[str, List[int]], 
                                   scalers:Dict[str, Tuple[str, float, float, float, float, float, str, str]], 
+                                  scale_outs: Dict[Tuple[str, bool], Dict[str, int]],
                                   db_session: Session) -> bool:
     """根据某指标判断是否需要扩容
     
     Keyword arguments:
-    metric: 指标, cpu/memory
-    total: node上该指标的总量
-    other: 除了scanner使用外的负载情况
+    node: 节点名
+    cpu_total/memory_total: node上该指标的总量
+    cpu_other/memory_other: 除了scanner使用外的负载情况
     lwl: 低水位线
     hwl: 高水位线
-    engine_load: 根据engine获取该engine的任务负载数量
-    scanners: 扫描器列表
-    scanner_dict: 通过scanner_id获取Vtscanner
+    state: 集群状态模型
     node_scanner_dict: 通过engine获取某node上全部该类型的scanner
     scalers: 通过node_name获取node的详细情况('hpa', 'cpu_cost', 'memory_cost', 'time_cost', 'external_cpu_cost', 'external_memory_cost', 'hostname', 'port')
+    scale_outs: 本轮需要新建的pod, 由调用方在数据库会话结束后统一发送
     db_session: 数据库连接
     """
-    cpu_expected_usage = compute_usage(other=cpu_other, scanner_dict=scanner_dict, node_scanner_dict=node_scanner_dict,
-                                           metric='cpu', scalers=scalers)
-    memory_expected_usage = compute_usage(other=memory_other, scanner_dict=scanner_dict, node_scanner_dict=node_scanner_dict,
-                                           metric='memory', scalers=scalers)
+    cpu_expected_usage = state.expected_usage(node, other=cpu_other, metric='cpu')
+    memory_expected_usage = state.expected_usage(node, other=memory_other, metric='memory')
+    # 本轮计划在该node上新建的pod的占用, pod创建前不在state中
+    cpu_planned = .0
+    memory_planned = .0
     # 如果低于高水位则需要扩容, 否则不需要
     if cpu_expected_usage > cpu_total * cpuLwl\
         or memory_expected_usage > memory_total * memoryLwl:
@@ -524,8 +583,7 @@ def scale_out_with_cpu_and_memory(node: str,
             and memory_expected_usage < memory_can_apply_line and times < 10:
         # 对这个node上的所有scanner按照总的已分配/应分配进行排序
         # 排序后对第一个node上有的engine的scanner进行扩容，扩容到中间或不再有scanner
-        assign_rate_list: List[Tuple[float, str]] = compute_assign_rate(engine_load=engine_load, scanners=scanners,
-                                                    scalers=scalers, metric='cpu')
+        assign_rate_list: List[Tuple[float, str]] = state.assign_rate('cpu')
         assign_rate_list.sort(key=itemgetter(0))
         scale_out_no_scanner = False
         for assign_rate in assign_rate_list:
@@ -553,28 +611,34 @@ def scale_out_with_cpu_and_memory(node: str,
             #     如果不支持, 则启动新的pod
             can_hpa = True
             if 'vpa' in scale_type:
-                scanner_list = node_scanner_dict[engine]
+                scanner_list = node_scanner_dict.get(engine, [])
                 # 扫描器数量为0则需要先通过hpa启动扫描器
                 if len(scanner_list) > 0:
                     can_hpa = False
                     waiting_scale_scanner = []
                     for scanner_id in scanner_list:
-                        scanner_parallel = scanner_dict[scanner_id].max_concurrency
+                        scanner_parallel = state.get_scanner(scanner_id).max_concurrency
                         waiting_scale_scanner.append((scanner_parallel, scanner_id))
                     # 选择并发度最小的扩充
                     waiting_scale_scanner.sort(key=itemgetter(0))
                     scanner_id = waiting_scale_scanner[0][1]
-                    scanner = scanner_dict[scanner_id]
-                    scanner.max_concurrency += 1
+                    scanner = state.get_scanner(scanner_id)
+                    state.set_concurrency(scanner, scanner.max_concurrency + 1)
                     db_session.add(scanner)
                     scale_out_fin = True
                     scale_out_no_scanner = True
             # 不能进行vpa或者没有scanner可以vpa则进行hpa
             if 'hpa' in scale_type and can_hpa:
-                scaler_hostname = scalers[engine][6] 
-                scaler_port = scalers[engine][7]
-                scaler_url = f"http://{scaler_hostname}:{scaler_port}"
-                success = call_scaler_scale_out(scaler_url=scaler_url, node=node)
+                # 优先使用该node上的热备扫描器
+                scanner = promote_standby_scanner(engine=engine, node=node, state=state, db_session=db_session)
+                if scanner != None:
+                    node_scanner_dict.setdefault(engine, []).append(scanner.id)
+                    success = True
+                else:
+                    add_scale_out(scale_outs, engine=engine, node=node)
+                    cpu_planned += scalers[engine][4] + cpu_cost * plannerPodConcurrency
+                    memory_planned += scalers[engine][5] + memory_cost * plannerPodConcurrency
+                    success = True
                 if success:
                     scale_out_fin = True
                     scale_out_no_scanner = True
@@ -584,10 +648,8 @@ def scale_out_with_cpu_and_memory(node: str,
         if not scale_out_no_scanner:
             break
         # 再次计算 cpu_expected_usage, memory_expected_uasge
-        cpu_expected_usage = compute_usage(other=cpu_other, scanner_dict=scanner_dict, node_scanner_dict=node_scanner_dict,
-                                        metric='cpu', scalers=scalers)
-        memory_expected_usage = compute_usage(other=memory_other, scanner_dict=scanner_dict, node_scanner_dict=node_scanner_dict,
-                                        metric='memory', scalers=scalers)
+        cpu_expected_usage = state.expected_usage(node, other=cpu_other, metric='cpu') + cpu_planned
+        memory_expected_usage = state.expected_usage(node, other=memory_other, metric='memory') + memory_planned
         db_session.flush()
         times += 1
     return
@@ -598,8 +660,8 @@ def scale_in_or_out_with_node_load(node_cpu_used: Dict[str, float],
                                  node_memory_available: Dict[str, float],
                                  node_info: Dict[str, Tuple[float, float]],
                                  scalers: Dict[str, Tuple[str, float, float, float, float, float, str, str]],
-                                 scanners: List[Scanner.VtScanner],
-                                 engine_load: Dict[str, int],
+                                 state: ClusterState,
+                                 scale_outs: Dict[Tuple[str, bool], Dict[str, int]],
                                  db_session: Session):
     """根据指标判断是否需要缩容或扩容, by-node
     
@@ -610,8 +672,8 @@ def scale_in_or_out_with_node_load(node_cpu_used: Dict[str, float],
     node_memory_available: 通过node_name获取节点上的memory空闲量
     node_info: 通过node_name获取节点的总量信息,('cpu_total' 'memory_total')
     scalers: 通过node_name获取node的详细情况('hpa', 'cpu_cost', 'memory_cost', 'time_cost', 'external_cpu_cost', 'external_memory_cost')
-    scanners: scanner列表
-    engine_load: 通过engine获取该engine上的任务负载数量
+    state: 集群状态模型
+    scale_outs: 本轮需要新建的pod
     db_session: 数据库连接
     """
     # by node
@@ -628,13 +690,9 @@ def scale_in_or_out_with_node_load(node_cpu_used: Dict[str, float],
         cpu_other = cpu_total - node_cpu_available[node] - node_cpu_used[node]
         memory_total = node_info[node][1]
         memory_other = memory_total - node_memory_available[node] - node_memory_used[node]
-        scanner_dict:Dict[int, Scanner.VtScanner] = {}
         node_scanner_dict: Dict[str, List[int]] = {}
-        for scanner in scanners:
-            if scanner.engine not in scalers or scanner.node != node:
-                continue
-            scanner_dict[scanner.id] = scanner
-            if scanner.status != Scanner.Status.ENABLE:
+        for scanner in state.scanners_on_node(node):
+            if scanner.engine not in scalers or scanner.status != Scanner.Status.ENABLE:
                 continue
             engine = scanner.engine
             if engine not in node_scanner_dict:
@@ -642,14 +700,10 @@ def scale_in_or_out_with_node_load(node_cpu_used: Dict[str, float],
             else:
                 node_scanner_dict[engine].append(scanner.id)
         # 判断并进行CPU指标的缩容
-        has_cpu_scale_in = scale_in_with_metric(metric='cpu', total=cpu_total, other=cpu_other, hwl=cpuHwl,
-                             engine_load=engine_load, scanner_dict=scanner_dict, scanners=scanners,
-                             node_scanner_dict=node_scanner_dict, scalers=scalers,
-                             db_session=db_session)
-        has_memory_scale_in = scale_in_with_metric(metric='memory', total=memory_total, other=memory_other, hwl=memoryHwl,
-                             engine_load=engine_load, scanner_dict=scanner_dict, scanners=scanners,
-                             node_scanner_dict=node_scanner_dict, scalers=scalers,
-                             db_session=db_session)
+        has_cpu_scale_in = scale_in_with_metric(metric='cpu', node=node, total=cpu_total, other=cpu_other, hwl=cpuHwl, lwl=cpuLwl,
+                             state=state, node_scanner_dict=node_scanner_dict, db_session=db_session)
+        has_memory_scale_in = scale_in_with_metric(metric='memory', node=node, total=memory_total, other=memory_other, hwl=memoryHwl, lwl=memoryLwl,
+                             state=state, node_scanner_dict=node_scanner_dict, db_session=db_session)
         db_session.flush()
         # 进行过缩容则不需要再扩容了
         if has_cpu_scale_in or has_memory_scale_in:
@@ -657,49 +711,106 @@ def scale_in_or_out_with_node_load(node_cpu_used: Dict[str, float],
         # 判断并进行Memory指标的扩容
         scale_out_with_cpu_and_memory(node=node, cpu_total=cpu_total, cpu_other=cpu_other, memory_total=memory_total,
                                       memory_other=memory_other, cpuLwl=cpuLwl, cpuHwl=cpuHwl, memoryLwl=memoryLwl,
-                                      memoryHwl=memoryHwl, engine_load=engine_load, scanner_dict=scanner_dict, scanners=scanners,
-                                      node_scanner_dict=node_scanner_dict, scalers=scalers,
-                                      db_session=db_session)
+                                      memoryHwl=memoryHwl, state=state, node_scanner_dict=node_scanner_dict,
+                                      scalers=scalers, scale_outs=scale_outs, db_session=db_session)
         db_session.flush()
 
-def rebalance_when_extreme_unbanlance(scalers: Dict[str, Tuple[str, float, float, float, float, float, str, str]],
-                                 scanners: List[Scanner.VtScanner], node_usage: Dict[str, float],
-                                 engine_load: Dict[str, int], db_session: Session):
+def apply_allocation_plan(plan: AllocationPlan, state: ClusterState,
+                          scale_outs: Dict[Tuple[str, bool], Dict[str, int]],
+                          db_session: Session):
+    """批量执行分配方案: 缩容的scanner每个只调用一次缩容接口, vpa扩容直接修改并发度,
+    hpa优先使用热备扫描器(先同node, 再其他node), 不足时记录到scale_outs按node新建pod
+    
+    Keyword arguments:
+    plan: 分配方案
+    state: 集群状态模型
+    scale_outs: 本轮需要新建的pod
+    db_session: 数据库连接
+    """
+    for scanner_id, num in plan.concurrency.items():
+        scanner = state.get_scanner(scanner_id)
+        if num < scanner.max_concurrency:
+            scanner_url = f"http://{scanner.ipaddr}:{scanner.port}"
+            success = call_scanner_scale_in(scanner_url=scanner_url, num=num)
+            if not success:
+                continue
+        state.set_concurrency(scanner, num)
+        if scanner.max_concurrency == 0:
+            scanner.status = Scanner.Status.WAITING
+            state.detach(scanner)
+        db_session.add(scanner)
+    for engine, node_pods in plan.pods.items():
+        for node, num in node_pods.items():
+            for _ in range(num):
+                scanner = promote_standby_scanner(engine=engine, node=node, state=state, db_session=db_session)
+                if scanner == None:
+                    scanner = promote_standby_scanner(engine=engine, node=None, state=state, db_session=db_session)
+                if scanner == None:
+                    add_scale_out(scale_outs, engine=engine, node=node)
+    db_session.flush()
+
+def scale_in_or_out_with_global_plan(node_cpu_used: Dict[str, float],
+                                     node_cpu_available: Dict[str, float],
+                                     node_memory_used: Dict[str, float],
+                                     node_memory_available: Dict[str, float],
+                                     node_info: Dict[str, Tuple[float, float]],
+                                     scalers: Dict[str, Tuple[str, float, float, float, float, float, str, str]],
+                                     state: ClusterState,
+                                     scale_outs: Dict[Tuple[str, bool], Dict[str, int]],
+                                     db_session: Session):
+    """全局求解本轮的并发度分配并批量执行, 参数同scale_in_or_out_with_node_load"""
+    node_cpu_other = {}
+    node_memory_other = {}
+    for node in node_info:
+        if node not in node_cpu_available or node not in node_cpu_used:
+            logger.error(f"node {node} node_cpu_usage not found")
+            continue
+        if node not in node_memory_available or node not in node_memory_used:
+            logger.error(f"node {node} node_memory_usage not found")
+            continue
+        node_cpu_other[node] = node_info[node][0] - node_cpu_available[node] - node_cpu_used[node]
+        node_memory_other[node] = node_info[node][1] - node_memory_available[node] - node_memory_used[node]
+    pending_scanners = [scanner for scanner in state.scanners if scanner.status == Scanner.Status.DISABLE]
+    plan = plan_allocation(state=state, scalers=scalers, node_info=node_info,
+                           node_cpu_other=node_cpu_other, node_memory_other=node_memory_other,
+                           pending_scanners=pending_scanners,
+                           watermarks={'cpu': (cpuLwl, cpuHwl), 'memory': (memoryLwl, memoryHwl)},
+                           pod_concurrency=plannerPodConcurrency)
+    if plan.empty():
+        return
+    apply_allocation_plan(plan=plan, state=state, scale_outs=scale_outs, db_session=db_session)
+
+def rebalance_when_extreme_unbanlance(state: ClusterState, node_usage: Dict[str, float], db_session: Session):
     """根据指标判断是否需要再平衡
     
     Keyword arguments:
-    scalers: 通过node_name获取node的详细情况('hpa', 'cpu_cost', 'memory_cost', 'time_cost', 'external_cpu_cost', 'external_memory_cost')
-    scanners: scanner列表
-    engine_load: 通过engine获取该engine上的任务负载数量
+    state: 集群状态模型
     node_usage: 节点的负载情况
     db_session: 数据库连接
     """
     # 首先判断是否存在极度不平衡
-    assign_rate = compute_assign_rate(engine_load=engine_load, scanners=scanners,
-                                            scalers=scalers, metric='cpu')
+    assign_rate = state.assign_rate('cpu')
     assign_rate.sort(key=itemgetter(0), reverse=True)
+    # 按照nodeusage从低到高去收缩，这样可以尽可能将大任务也放置上去
+    waiting_nodes: List[Tuple[float, str]] = []
+    for node in node_usage:
+        waiting_nodes.append((node_usage[node], node))
+    waiting_nodes.sort(key=itemgetter(0))
     times = 0
-    while assign_rate[0][0] >= 3 and times < 5:
+    while assign_rate and assign_rate[0][0] >= 3 and times < 5:
         # 需要对engine进行再平衡, 收缩
         engine = assign_rate[0][1]
-        # 按照nodeusage从低到高去收缩，这样可以尽可能将大任务也放置上去
-        # 计算nodeusage
-        waiting_nodes: List[Tuple[float, str]] = []
-        for node in node_usage:
-            waiting_nodes.append(node_usage[node], node)
-        waiting_nodes.sort(key=itemgetter(0))
         has_scale_in = False
         for waiting_node in waiting_nodes:
             node = waiting_node[1]
-            for scanner in scanners:
-                if scanner.node != node or scanner.engine != engine\
-                    or scanner.max_concurrency == 0:
+            for scanner in state.scanners_on_node(node):
+                if scanner.engine != engine or scanner.max_concurrency == 0:
                         continue
                 # 进行缩容
                 scanner_url = f"http://{scanner.ipaddr}:{scanner.port}"
                 success = call_scanner_scale_in(scanner_url=scanner_url, num=scanner.max_concurrency-1)
                 if success:
-                    scanner.max_concurrency -= 1
+                    state.set_concurrency(scanner, scanner.max_concurrency - 1)
                     if scanner.max_concurrency == 0:
                         scanner.status = Scanner.Status.WAITING
                     db_session.add(scanner)
@@ -707,12 +818,93 @@ def rebalance_when_extreme_unbanlance(scalers: Dict[str, Tuple[str, float, float
                     break
             if has_scale_in:
                 break            
-        assign_rate = compute_assign_rate(engine_load=engine_load, scanners=scanners,
-                                                    scalers=scalers, metric='cpu')
+        assign_rate = state.assign_rate('cpu')
         assign_rate.sort(key=itemgetter(0), reverse=True)
         times += 1
     db_session.flush()
 
+def maintain_standby_pool(state: ClusterState,
+                          scalers: Dict[str, Tuple[str, float, float, float, float, float, str, str]],
+                          node_usage: Dict[str, float],
+                          scale_outs: Dict[Tuple[str, bool], Dict[str, int]],
+                          db_session: Session):
+    """按最近的扩容频率补充或释放各engine的热备扫描器
+    
+    Keyword arguments:
+    state: 集群状态模型
+    scalers: 通过engine获取扩缩容注册信息
+    node_usage: 节点的负载情况
+    scale_outs: 本轮需要新建的pod
+    db_session: 数据库连接
+    """
+    if not standby_pool.enabled():
+        return
+    now = current_time()
+    pending = list_pending_standby_pods(db_session)
+    # 只在低于低水位的node上放置热备pod, 负载低的优先
+    usage_line = cpuWeight * cpuLwl + memoryWeight * memoryLwl
+    nodes = [node for node in sorted(node_usage, key=node_usage.get) if node_usage[node] < usage_line]
+    for engine in state.engines:
+        if 'hpa' not in scalers[engine][0]:
+            continue
+        create, retire = standby_pool.plan(engine, now, state.standby.get(engine, []), pending.get(engine, {}), nodes)
+        # 热备扫描器上没有任务, 直接删除
+        for scanner in retire:
+            scanner.status = Scanner.Status.DELETING
+            state.standby[engine].remove(scanner)
+            db_session.add(scanner)
+        for node, num in create.items():
+            add_scale_out(scale_outs, engine=engine, node=node, standby=True, num=num)
+    db_session.flush()
+
+def forecast_node_metric(current: Dict[str, float], range_query, metric: str) -> Dict[str, float]:
+    """用历史序列的平滑/预测值代替瞬时采样, 避免突发负载导致反复扩缩容
+    
+    Keyword arguments:
+    current: 通过node_name获取的瞬时采样
+    range_query: 获取历史序列的函数
+    metric: 指标名, 仅用于日志
+    """
+    if forecastMethod == 'none':
+        return current
+    try:
+        series = range_query(forecastWindow, step=forecastStep)
+    except Exception as e:
+        logger.error(f"Query {metric} history error: {e}")
+        return current
+    forecasted = {}
+    for node in current:
+        values = series.get(node)
+        if not values:
+            forecasted[node] = current[node]
+            continue
+        predicted = forecast(values, method=forecastMethod, horizon=forecastHorizon,
+                             alpha=forecastAlpha, beta=forecastBeta)
+        forecasted[node] = max(predicted, 0.0)
+    return forecasted
+
+def forecast_engine_load(engine_load: Dict[str, int]) -> Dict[str, int]:
+    """记录engine任务负载历史, 取当前值与预测值的较大者, 负载上升时提前扩容、不提前缩容
+    
+    Keyword arguments:
+    engine_load: 通过engine获取该engine上的任务负载数量
+    """
+    for engine in set(engine_load) | set(engine_load_history):
+        if engine not in engine_load_history:
+            engine_load_history[engine] = deque(maxlen=engineLoadHistoryLen)
+        engine_load_history[engine].append(engine_load.get(engine, 0))
+    if forecastMethod == 'none':
+        return engine_load
+    forecasted = {}
+    for engine, history in engine_load_history.items():
+        predicted = forecast(list(history), method=forecastMethod, horizon=forecastHorizon,
+                             alpha=forecastAlpha, beta=forecastBeta)
+        current = engine_load.get(engine, 0)
+        load = max(current, int(math.ceil(predicted)))
+        if load > 0 or engine in engine_load:
+            forecasted[engine] = load
+    return forecasted
+
 # 全局唯一自动扩缩容器
 def autoscaler():
     # 周期性执行任务逻辑
@@ -726,18 +918,30 @@ def autoscaler():
     #            I  任务负载低 by scaler
     #            II 或者资源负载高  by node
     logger.info("Executing the autoscale periodic task")
+    # 本轮需要的prometheus指标一次性并发获取, 后续查询命中缓存
+    clear_query_cache()
+    try:
+        prefetch_node_metrics()
+    except Exception as e:
+        logger.error(f"Prefetch node metrics error: {e}")
+    # 本轮需要新建的pod, 数据库会话结束后按scaler批量发送
+    scale_outs: Dict[Tuple[str, bool], Dict[str, int]] = {}
     try:
         with get_db_session() as db_session:
             # 首先获取需要自动扩缩容的扫描器
             scalers = fetch_scaler_info()
             # 所有engine的负载
-            engine_load = list_engine_load()
+            engine_load = forecast_engine_load(list_engine_load())
             # 所有未删除的scanner
             scanners = get_db_scanners(db_session=db_session)
+            # 热备scanner, 扩容时优先使用
+            standby_scanners = get_standby_scanners(db_session=db_session) if standby_pool.enabled() else []
             # 所有node的cpu空闲情况
             node_cpu_available = query_nodes_cpu_avaliable()
             # 所有node的memory空闲情况
             node_memory_available = query_nodes_memory_available()
+            node_cpu_available = forecast_node_metric(node_cpu_available, query_nodes_cpu_avaliable_range, 'cpu')
+            node_memory_available = forecast_node_metric(node_memory_available, query_nodes_memory_available_range, 'memory')
             # 所有node的总体信息
             node_info = fetch_node_info()
             # 1. 首先处理任务负载低时的缩容 by engine
@@ -748,7 +952,7 @@ def autoscaler():
                 node_total = node_info[node][0]
                 node_cpu_usage[node] = 1- node_cpu_available[node]/node_total
             for node in node_memory_available:
-                node_total = node_info[node][0]
+                node_total = node_info[node][1]
                 node_memory_usage[node] = 1- node_memory_available[node]/node_total
             node_usage = {}
             for node in node_cpu_usage:
@@ -756,21 +960,34 @@ def autoscaler():
                     logger.error(f"node {node} memory lost")
                 node_usage[node] = node_cpu_usage[node]
                 node_usage[node] = cpuWeight * node_cpu_usage[node] + memoryWeight * node_memory_usage[node]
-            scale_in_when_task_load_low(engine_load=engine_load, scanners=scanners, 
+            # 本轮扩缩容共用的集群状态模型, 并发度变化时增量更新
+            state = ClusterState(scalers=scalers, scanners=scanners, engine_load=engine_load,
+                                 enable_status=Scanner.Status.ENABLE, standby=standby_scanners)
+            scale_in_when_task_load_low(engine_load=engine_load, state=state,
                                         node_usage=node_usage, scalers=scalers, db_session=db_session)
             db_session.flush()
             # 2. 资源高时缩容 by node
             node_cpu_used = query_namespace_cpu_used()
             node_memory_used = query_namespace_memory_used()
-            scale_in_or_out_with_node_load(node_cpu_used=node_cpu_used, node_cpu_available=node_cpu_available,
-                                         node_memory_available=node_memory_available, node_memory_used=node_memory_used,
-                                         node_info=node_info, scalers=scalers, scanners=scanners, engine_load=engine_load,
-                                         db_session=db_session)
+            if autoscalePlanner == 'global':
+                scale_in_or_out_with_global_plan(node_cpu_used=node_cpu_used, node_cpu_available=node_cpu_available,
+                                                 node_memory_available=node_memory_available, node_memory_used=node_memory_used,
+                                                 node_info=node_info, scalers=scalers, state=state, scale_outs=scale_outs,
+                                                 db_session=db_session)
+            else:
+                scale_in_or_out_with_node_load(node_cpu_used=node_cpu_used, node_cpu_available=node_cpu_available,
+                                             node_memory_available=node_memory_available, node_memory_used=node_memory_used,
+                                             node_info=node_info, scalers=scalers, state=state, scale_outs=scale_outs,
+                                             db_session=db_session)
             # 3. 全局再平衡
             #    判断是否有极不平衡存在
             #    只需要对已分配/应分配最大的engine进行一次scale-in即可
-            rebalance_when_extreme_unbanlance(scalers=scalers, scanners=scanners, node_usage=node_usage,
-                                              engine_load=engine_load, db_session=db_session)
+            rebalance_when_extreme_unbanlance(state=state, node_usage=node_usage, db_session=db_session)
+            # 4. 按最近的扩容频率补充/释放热备扫描器
+            maintain_standby_pool(state=state, scalers=scalers, node_usage=node_usage, scale_outs=scale_outs,
+                                  db_session=db_session)
+        # 5. 数据库会话结束后再调用scaler创建pod, 不在事务中等待HTTP请求
+        submit_scale_outs(scale_outs=scale_outs, scalers=scalers)
 
     except Exception as e:
         logger.error(f"Execute the autoscale error: {e}")
@@ -783,6 +1000,7 @@ if __name__ == "__main__":
     except Exception as e:
         logger.error((e))
         raise
+    start_informers()
     scheduler = BlockingScheduler()
     scheduler.add_job(autoscaler, 'interval', seconds=30)  # 每30秒执行一次
     logger.info("Starting autoscaler...")
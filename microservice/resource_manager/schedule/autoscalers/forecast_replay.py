@@ -0,0 +1,90 @@
+"""预测方法离线回放
+
+在录制的指标序列上滚动回放各预测方法, 输出预测误差与按阈值判定的翻转次数,
+用于在上线前选择 FORECAST_METHOD 及相关参数
+
+录制: python forecast_replay.py record --query 'sum by (node) (rate(node_cpu_seconds_total{mode="idle"}[1m]))' --minutes 1440 -o cpu.json
+回放: python forecast_replay.py replay cpu.json --window 20 --horizon 2 --threshold 4
+"""
+import argparse
+import json
+import math
+from typing import Dict, List
+from resource_manager.forecast import forecast
+
+METHODS = ['none', 'ewma', 'linear', 'holt']
+
+def load_series(path: str) -> Dict[str, List[float]]:
+    """读取录制文件, 支持 {"series": {name: [values]}} 及 prometheus query_range 原始响应"""
+    with open(path) as f:
+        data = json.load(f)
+    if 'series' in data:
+        return {name: [float(v) for v in values] for name, values in data['series'].items()}
+    if 'data' in data:
+        data = data['data']
+    series = {}
+    for result in data['result']:
+        name = result['metric'].get('node', result['metric'].get('instance', 'unknown'))
+        series[name] = [float(value[1]) for value in result['values']]
+    return series
+
+def replay(values: List[float], method: str, window: int, horizon: int,
+           alpha: float, beta: float, threshold: float) -> Dict[str, float]:
+    abs_errors = []
+    decisions = []
+    for t in range(window, len(values) - horizon + 1):
+        history = values[t - window:t]
+        predicted = forecast(history, method=method, horizon=horizon, alpha=alpha, beta=beta)
+        actual = values[t + horizon - 1]
+        abs_errors.append(abs(predicted - actual))
+        decisions.append(predicted > threshold)
+    if not abs_errors:
+        return {'mae': .0, 'rmse': .0, 'flaps': 0, 'samples': 0}
+    flaps = sum(1 for i in range(1, len(decisions)) if decisions[i] != decisions[i - 1])
+    return {
+        'mae': sum(abs_errors) / len(abs_errors),
+        'rmse': math.sqrt(sum(e * e for e in abs_errors) / len(abs_errors)),
+        'flaps': flaps,
+        'samples': len(abs_errors),
+    }
+
+def record(query: str, minutes: int, step: str, output: str):
+    from resource_manager.promql import fetch_prometheus_range
+    import time
+    end = time.time()
+    data = fetch_prometheus_range(query, start=end - minutes * 60, end=end, step=step)
+    with open(output, 'w') as f:
+        json.dump({'data': data}, f)
+
+def main():
+    parser = argparse.ArgumentParser(description="Forecast replay harness")
+    sub = parser.add_subparsers(dest='command', required=True)
+    record_parser = sub.add_parser('record', help="record a range query from prometheus")
+    record_parser.add_argument('--query', required=True)
+    record_parser.add_argument('--minutes', type=int, default=1440)
+    record_parser.add_argument('--step', default='30s')
+    record_parser.add_argument('-o', '--output', required=True)
+    replay_parser = sub.add_parser('replay', help="replay forecast methods on recorded series")
+    replay_parser.add_argument('input')
+    replay_parser.add_argument('--methods', default=','.join(METHODS))
+    replay_parser.add_argument('--window', type=int, default=20, help="history samples per forecast")
+    replay_parser.add_argument('--horizon', type=int, default=2, help="forecast steps ahead")
+    replay_parser.add_argument('--alpha', type=float, default=0.3)
+    replay_parser.add_argument('--beta', type=float, default=0.3)
+    replay_parser.add_argument('--threshold', type=float, default=.0, help="decision threshold for flap counting")
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args.query, args.minutes, args.step, args.output)
+        return
+    series = load_series(args.input)
+    methods = args.methods.split(',')
+    print(f"{'series':<24}{'method':<8}{'mae':>12}{'rmse':>12}{'flaps':>8}{'samples':>9}")
+    for name, values in series.items():
+        for method in methods:
+            result = replay(values, method, args.window, args.horizon, args.alpha, args.beta, args.threshold)
+            print(f"{name:<24}{method:<8}{result['mae']:>12.4f}{result['rmse']:>12.4f}"
+                  f"{result['flaps']:>8}{result['samples']:>9}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,487 @@
+"""自动扩缩容离线模拟器
+
+按固定时间步推进的离散事件模拟: 模拟任务到达/执行、pod启动/删除以及节点的资源占用,
+用模拟的k8s、prometheus、task_manager、scanner及scaler接口驱动autoscaler中真实的
+scale_in_when_task_load_low / scale_in_or_out_with_node_load / rebalance_when_extreme_unbanlance,
+输出任务等待时间、scanner-hours、扩缩容翻转次数及水位线越界次数, 用于在上线前对比策略改动
+
+生成场景模板: python -m resource_manager.schedule.autoscalers.simulator --example > scenario.json
+运行模拟:     python -m resource_manager.schedule.autoscalers.simulator scenario.json
+对比多组配置: CPU_HWL=0.85 FORECAST_METHOD=holt python -m resource_manager.schedule.autoscalers.simulator scenario.json
+热备扫描器池: STANDBY_POOL_MAX=2 python -m resource_manager.schedule.autoscalers.simulator scenario.json
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import types
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+EXAMPLE_SCENARIO = {
+    "seed": 1,
+    "duration_minutes": 240,
+    "tick_seconds": 10,
+    "autoscale_interval_seconds": 30,
+    "pod_startup_seconds": 90,
+    "nodes": {
+        "node1": {"cpu": 8, "memory": 16384, "background_cpu": 1, "background_memory": 2048},
+        "node2": {"cpu": 8, "memory": 16384, "background_cpu": [1, 1, 2, 4, 4, 2], "background_memory": 4096}
+    },
+    "scalers": {
+        "openvas": {"type": "hpa|vpa", "cpu_cost": 0.5, "memory_cost": 512, "time_cost": 30,
+                    "external_cpu_cost": 1, "external_memory_cost": 2048, "max_concurrency": 2},
+        "zaproxy": {"type": "hpa", "cpu_cost": 0.5, "memory_cost": 1024, "time_cost": 20,
+                    "external_cpu_cost": 0.5, "external_memory_cost": 1024, "max_concurrency": 1}
+    },
+    "scanners": [
+        {"engine": "openvas", "node": "node1", "max_concurrency": 2},
+        {"engine": "zaproxy", "node": "node2", "max_concurrency": 1}
+    ],
+    "arrivals": {
+        "openvas": {"rate_per_minute": [0.05, 0.05, 0.3, 0.3, 0.1, 0.0]},
+        "zaproxy": {"rate_per_minute": 0.05}
+    },
+    "tasks": []
+}
+
+def trace_value(trace, minute: float) -> float:
+    """取轨迹在某一分钟的值, 轨迹为常数或按分钟循环的列表"""
+    if isinstance(trace, list):
+        if not trace:
+            return .0
+        return float(trace[int(minute) % len(trace)])
+    return float(trace)
+
+class SimTask:
+    def __init__(self, task_id: int, engine: str, arrive: float, duration: float):
+        self.id = task_id
+        self.engine = engine
+        self.arrive = arrive
+        self.duration = duration
+        self.start: Optional[float] = None
+        self.end: Optional[float] = None
+
+class SimScanner:
+    """替代Scanner.VtScanner, autoscaler只读写这些属性"""
+
+    def __init__(self, scanner_id: int, engine: str, node: str, max_concurrency: int, status, ready_at: float,
+                 standby: bool = False):
+        self.id = scanner_id
+        self.name = f"{engine}-{scanner_id}"
+        self.engine = engine
+        self.node = node
+        self.ipaddr = f"sim-{scanner_id}"
+        self.port = "80"
+        self.max_concurrency = max_concurrency
+        self.status = status
+        self.except_num = 0
+        self.ready_at = ready_at
+        # 带standby标签的pod, 就绪后进入STANDBY状态
+        self.standby = standby
+        self.running: List[SimTask] = []
+
+class SimSession:
+    """替代数据库会话, scanner对象即为模拟状态本身, 不需要持久化"""
+
+    def add(self, obj):
+        pass
+
+    def add_all(self, objs):
+        pass
+
+    def flush(self):
+        pass
+
+    def commit(self):
+        pass
+
+@contextmanager
+def sim_db_session():
+    yield SimSession()
+
+def load_autoscaler():
+    """导入autoscaler模块, 不连接数据库与k8s"""
+    resource_manager_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    # model下的模块以basemodel为顶层模块导入
+    model_dir = os.path.join(resource_manager_dir, 'model')
+    if model_dir not in sys.path:
+        sys.path.append(model_dir)
+    # tidb_sql在导入时会连接数据库建表, 离线运行时替换为模拟会话
+    if 'resource_manager.tidb_sql' not in sys.modules:
+        sim_sql = types.ModuleType('resource_manager.tidb_sql')
+        sim_sql.get_db_session = sim_db_session
+        sys.modules['resource_manager.tidb_sql'] = sim_sql
+    from resource_manager.schedule.autoscalers import autoscaler
+    return autoscaler
+
+class Simulator:
+
+    def __init__(self, scenario: dict, autoscaler):
+        self.scenario = scenario
+        self.autoscaler = autoscaler
+        self.status = autoscaler.Scanner.Status
+        self.random = random.Random(scenario.get('seed', 1))
+        self.tick = float(scenario.get('tick_seconds', 10))
+        self.duration = float(scenario.get('duration_minutes', 240)) * 60
+        self.autoscale_interval = float(scenario.get('autoscale_interval_seconds', 30))
+        self.pod_startup = float(scenario.get('pod_startup_seconds', 90))
+        self.nodes: Dict[str, dict] = scenario['nodes']
+        self.scaler_conf: Dict[str, dict] = scenario['scalers']
+        self.now = .0
+        self.next_scanner_id = 1
+        self.next_task_id = 1
+        self.scanners: Dict[int, SimScanner] = {}
+        self.queues: Dict[str, deque] = {engine: deque() for engine in self.scaler_conf}
+        self.pending_tasks: List[SimTask] = []
+        self.finished_tasks: List[SimTask] = []
+        # 节点可用量历史, 供FORECAST_METHOD不为none时的range查询
+        self.cpu_available_history: Dict[str, List[float]] = {node: [] for node in self.nodes}
+        self.memory_available_history: Dict[str, List[float]] = {node: [] for node in self.nodes}
+        # 统计
+        self.scanner_seconds = .0
+        self.slot_seconds = .0
+        self.scale_out_calls = 0
+        self.scale_out_requests = 0
+        self.scale_in_calls = 0
+        self.standby_calls = 0
+        self.standby_promoted = 0
+        self.preempted_tasks = 0
+        self.watermark_violations = {'cpu': 0, 'memory': 0}
+        self.samples = 0
+        self.last_capacity: Dict[str, int] = {}
+        self.last_direction: Dict[str, int] = {}
+        self.flaps: Dict[str, int] = {engine: 0 for engine in self.scaler_conf}
+        for scanner in scenario.get('scanners', []):
+            self.add_scanner(scanner['engine'], scanner['node'], scanner.get('max_concurrency'), ready=True)
+        for task in scenario.get('tasks', []):
+            # 录制的任务: [到达分钟, engine, 执行分钟]
+            self.pending_tasks.append(self.new_task(task[1], float(task[0]) * 60, float(task[2]) * 60))
+        self.pending_tasks.sort(key=lambda task: task.arrive)
+
+    def new_task(self, engine: str, arrive: float, duration: float) -> SimTask:
+        task = SimTask(self.next_task_id, engine, arrive, duration)
+        self.next_task_id += 1
+        return task
+
+    def add_scanner(self, engine: str, node: str, max_concurrency: Optional[int] = None, ready: bool = False,
+                    standby: bool = False):
+        if max_concurrency == None:
+            max_concurrency = int(self.scaler_conf[engine].get('max_concurrency', 1))
+        status = self.status.ENABLE if ready else self.status.DISABLE
+        ready_at = self.now if ready else self.now + self.pod_startup
+        scanner = SimScanner(self.next_scanner_id, engine, node, max_concurrency, status, ready_at, standby)
+        self.scanners[scanner.id] = scanner
+        self.next_scanner_id += 1
+        return scanner
+
+    def scalers(self):
+        scalers = {}
+        for engine, conf in self.scaler_conf.items():
+            scalers[engine] = (conf['type'], float(conf['cpu_cost']), float(conf['memory_cost']),
+                               float(conf['time_cost']), float(conf['external_cpu_cost']),
+                               float(conf['external_memory_cost']), f"scaler-{engine}", "80")
+        return scalers
+
+    # 模拟集群行为
+
+    def arrive_tasks(self):
+        while self.pending_tasks and self.pending_tasks[0].arrive <= self.now:
+            task = self.pending_tasks.pop(0)
+            if task.engine in self.queues:
+                self.queues[task.engine].append(task)
+        minute = self.now / 60
+        for engine, arrival in self.scenario.get('arrivals', {}).items():
+            if engine not in self.queues:
+                continue
+            # 每个时间步内按泊松过程的期望次数抽样到达
+            expected = trace_value(arrival.get('rate_per_minute', 0), minute) * self.tick / 60
+            num = 0
+            threshold = math.exp(-expected)
+            p = self.random.random()
+            while p > threshold:
+                num += 1
+                p *= self.random.random()
+            duration = float(arrival.get('task_minutes', self.scaler_conf[engine]['time_cost'])) * 60
+            for _ in range(num):
+                jitter = self.random.uniform(0.5, 1.5)
+                self.queues[engine].append(self.new_task(engine, self.now, duration * jitter))
+
+    def advance_scanners(self):
+        for scanner in list(self.scanners.values()):
+            if scanner.status == self.status.DISABLE and scanner.ready_at <= self.now:
+                scanner.status = self.status.STANDBY if scanner.standby else self.status.ENABLE
+            # resource_schedule会删除deleting状态的扫描器
+            if scanner.status == self.status.DELETING:
+                del self.scanners[scanner.id]
+                continue
+            finished = [task for task in scanner.running if task.start + task.duration <= self.now]
+            for task in finished:
+                task.end = task.start + task.duration
+                scanner.running.remove(task)
+                self.finished_tasks.append(task)
+            # resource_schedule会删除没有运行任务的waiting扫描器
+            if scanner.status == self.status.WAITING and not scanner.running:
+                del self.scanners[scanner.id]
+
+    def dispatch_tasks(self):
+        for engine, queue in self.queues.items():
+            while queue:
+                candidates = [
+                    scanner for scanner in self.scanners.values()
+                    if scanner.engine == engine and scanner.status == self.status.ENABLE
+                    and len(scanner.running) < scanner.max_concurrency
+                ]
+                if not candidates:
+                    break
+                scanner = min(candidates, key=lambda s: len(s.running) / s.max_concurrency)
+                task = queue.popleft()
+                task.start = self.now
+                scanner.running.append(task)
+
+    def nodes_used(self, metric: str) -> Dict[str, float]:
+        """各node上扫描器的实际占用: 每个pod的固定开销加上运行中任务的开销"""
+        cost_key = 'cpu_cost' if metric == 'cpu' else 'memory_cost'
+        external_key = 'external_cpu_cost' if metric == 'cpu' else 'external_memory_cost'
+        used = {node: .0 for node in self.nodes}
+        for scanner in self.scanners.values():
+            conf = self.scaler_conf[scanner.engine]
+            used[scanner.node] += float(conf[external_key]) + float(conf[cost_key]) * len(scanner.running)
+        return used
+
+    def nodes_available(self, metric: str) -> Dict[str, float]:
+        available = {}
+        for node, used in self.nodes_used(metric).items():
+            conf = self.nodes[node]
+            background = trace_value(conf.get(f'background_{metric}', 0), self.now / 60)
+            available[node] = max(float(conf[metric]) - background - used, .0)
+        return available
+
+    def record_metrics(self):
+        self.samples += 1
+        for scanner in self.scanners.values():
+            self.scanner_seconds += self.tick
+            self.slot_seconds += self.tick * scanner.max_concurrency
+        nodes_cpu_available = self.nodes_available('cpu')
+        nodes_memory_available = self.nodes_available('memory')
+        for node, conf in self.nodes.items():
+            cpu_available = nodes_cpu_available[node]
+            memory_available = nodes_memory_available[node]
+            if float(conf['cpu']) - cpu_available > float(conf['cpu']) * self.autoscaler.cpuHwl:
+                self.watermark_violations['cpu'] += 1
+            if float(conf['memory']) - memory_available > float(conf['memory']) * self.autoscaler.memoryHwl:
+                self.watermark_violations['memory'] += 1
+            self.cpu_available_history[node].append(cpu_available)
+            self.memory_available_history[node].append(memory_available)
+
+    def record_flaps(self):
+        """统计每轮扩缩容后各engine总并发度变化方向的反转次数"""
+        for engine in self.scaler_conf:
+            capacity = sum(scanner.max_concurrency for scanner in self.scanners.values()
+                           if scanner.engine == engine
+                           and scanner.status not in [self.status.WAITING, self.status.STANDBY])
+            last = self.last_capacity.get(engine, capacity)
+            self.last_capacity[engine] = capacity
+            if capacity == last:
+                continue
+            direction = 1 if capacity > last else -1
+            if self.last_direction.get(engine, direction) != direction:
+                self.flaps[engine] += 1
+            self.last_direction[engine] = direction
+
+    # 模拟autoscaler依赖的外部接口
+
+    def list_engine_load(self) -> Dict[str, int]:
+        # 与/list_engine_tasks_num一致: queued + running, 不返回为0的engine
+        load = {}
+        for engine, queue in self.queues.items():
+            num = len(queue) + sum(len(scanner.running) for scanner in self.scanners.values()
+                                   if scanner.engine == engine)
+            if num > 0:
+                load[engine] = num
+        return load
+
+    def list_scanenr_running_tasks_num(self, engines: List[str]) -> Dict[int, int]:
+        # 与/list_running_tasks_num一致: 只返回有运行中任务的扫描器
+        return {
+            scanner.id: len(scanner.running) for scanner in self.scanners.values()
+            if scanner.engine in engines and scanner.running
+        }
+
+    def get_db_scanners(self, db_session) -> List[SimScanner]:
+        # 与autoscaler中一致: 未就绪的pod在数据库中为DISABLE, 热备扫描器单独查询
+        return [scanner for scanner in self.scanners.values()
+                if scanner.status not in [self.status.STANDBY, self.status.DELETING]]
+
+    def get_standby_scanners(self, db_session) -> List[SimScanner]:
+        return [scanner for scanner in self.scanners.values() if scanner.status == self.status.STANDBY]
+
+    def list_pending_standby_pods(self, db_session) -> Dict[str, Dict[str, int]]:
+        pending: Dict[str, Dict[str, int]] = {}
+        for scanner in self.scanners.values():
+            if scanner.standby and scanner.status == self.status.DISABLE:
+                engine_pending = pending.setdefault(scanner.engine, {})
+                engine_pending[scanner.node] = engine_pending.get(scanner.node, 0) + 1
+        return pending
+
+    def call_scanner_scale_in(self, scanner_url: str, num: int):
+        self.scale_in_calls += 1
+        scanner = self.scanners.get(int(scanner_url.split('sim-')[1].split(':')[0]))
+        if scanner == None:
+            return False
+        # 扫描器缩容时停止超出并发度的任务, 任务重新排队
+        while len(scanner.running) > num:
+            task = scanner.running.pop()
+            task.start = None
+            self.queues[scanner.engine].appendleft(task)
+            self.preempted_tasks += 1
+        return True
+
+    def call_scaler_scale_out(self, scaler_url: str, node: str, standby: bool = False):
+        if standby:
+            self.standby_calls += 1
+        else:
+            self.scale_out_calls += 1
+        engine = scaler_url.split('scaler-')[1].split(':')[0]
+        self.add_scanner(engine, node, standby=standby)
+        return True
+
+    def call_scaler_scale_out_batch(self, scaler_url: str, node_pods: Dict[str, int], standby: bool = False):
+        self.scale_out_requests += 1
+        results = []
+        for node, num in node_pods.items():
+            for _ in range(num):
+                self.call_scaler_scale_out(scaler_url, node, standby=standby)
+                results.append({'node': node, 'name': None, 'ok': True, 'errmsg': ''})
+        return results
+
+    def fetch_node_info(self):
+        return {node: (float(conf['cpu']), float(conf['memory'])) for node, conf in self.nodes.items()}
+
+    def query_nodes_cpu_avaliable(self):
+        return self.nodes_available('cpu')
+
+    def query_nodes_memory_available(self):
+        return self.nodes_available('memory')
+
+    def query_namespace_cpu_used(self):
+        return self.nodes_used('cpu')
+
+    def query_namespace_memory_used(self):
+        return self.nodes_used('memory')
+
+    def history_range(self, history: Dict[str, List[float]], minutes: int):
+        num = max(int(minutes * 60 / self.tick), 1)
+        return {node: values[-num:] for node, values in history.items()}
+
+    def query_nodes_cpu_avaliable_range(self, minutes: int, step: str = "30s"):
+        return self.history_range(self.cpu_available_history, minutes)
+
+    def query_nodes_memory_available_range(self, minutes: int, step: str = "30s"):
+        return self.history_range(self.memory_available_history, minutes)
+
+    @contextmanager
+    def patched(self):
+        fakes = {
+            'get_db_session': sim_db_session,
+            'fetch_scaler_info': self.scalers,
+            'list_engine_load': self.list_engine_load,
+            'list_scanenr_running_tasks_num': self.list_scanenr_running_tasks_num,
+            'get_db_scanners': self.get_db_scanners,
+            'get_standby_scanners': self.get_standby_scanners,
+            'list_pending_standby_pods': self.list_pending_standby_pods,
+            'current_time': lambda: self.now,
+            'call_scanner_scale_in': self.call_scanner_scale_in,
+            'call_scaler_scale_out': self.call_scaler_scale_out,
+            'call_scaler_scale_out_batch': self.call_scaler_scale_out_batch,
+            'fetch_node_info': self.fetch_node_info,
+            'query_nodes_cpu_avaliable': self.query_nodes_cpu_avaliable,
+            'query_nodes_memory_available': self.query_nodes_memory_available,
+            'query_namespace_cpu_used': self.query_namespace_cpu_used,
+            'query_namespace_memory_used': self.query_namespace_memory_used,
+            'query_nodes_cpu_avaliable_range': self.query_nodes_cpu_avaliable_range,
+            'query_nodes_memory_available_range': self.query_nodes_memory_available_range,
+            'clear_query_cache': lambda: None,
+            'prefetch_node_metrics': lambda: None,
+        }
+        origins = {name: getattr(self.autoscaler, name) for name in fakes}
+        for name, fake in fakes.items():
+            setattr(self.autoscaler, name, fake)
+        self.autoscaler.engine_load_history.clear()
+        self.autoscaler.standby_pool.scale_outs.clear()
+        try:
+            yield
+        finally:
+            for name, origin in origins.items():
+                setattr(self.autoscaler, name, origin)
+
+    def run(self) -> dict:
+        next_autoscale = self.autoscale_interval
+        with self.patched():
+            while self.now < self.duration:
+                self.arrive_tasks()
+                self.advance_scanners()
+                self.dispatch_tasks()
+                self.record_metrics()
+                if self.now >= next_autoscale:
+                    self.autoscaler.autoscaler()
+                    self.record_flaps()
+                    next_autoscale += self.autoscale_interval
+                self.now += self.tick
+        return self.report()
+
+    def report(self) -> dict:
+        started = list(self.finished_tasks)
+        for scanner in self.scanners.values():
+            started.extend(scanner.running)
+        waits = sorted(task.start - task.arrive for task in started)
+        unstarted = sum(len(queue) for queue in self.queues.values())
+
+        def percentile(p: float) -> float:
+            if not waits:
+                return .0
+            return waits[min(len(waits) - 1, int(len(waits) * p))] / 60
+
+        return {
+            'tasks_finished': len(self.finished_tasks),
+            'tasks_unstarted': unstarted,
+            'wait_avg_minutes': sum(waits) / len(waits) / 60 if waits else .0,
+            'wait_p50_minutes': percentile(0.5),
+            'wait_p95_minutes': percentile(0.95),
+            'scanner_hours': self.scanner_seconds / 3600,
+            'slot_hours': self.slot_seconds / 3600,
+            'scale_out_calls': self.scale_out_calls,
+            'scale_out_requests': self.scale_out_requests,
+            'scale_in_calls': self.scale_in_calls,
+            'standby_scale_out_calls': self.standby_calls,
+            'preempted_tasks': self.preempted_tasks,
+            'flaps': self.flaps,
+            'cpu_watermark_violations': self.watermark_violations['cpu'],
+            'memory_watermark_violations': self.watermark_violations['memory'],
+            'samples': self.samples,
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline autoscaler simulator")
+    parser.add_argument('scenario', nargs='?', help="scenario json file")
+    parser.add_argument('--example', action='store_true', help="print an example scenario and exit")
+    parser.add_argument('--seeds', type=int, default=1, help="run with N consecutive seeds and print each result")
+    args = parser.parse_args()
+
+    if args.example or not args.scenario:
+        print(json.dumps(EXAMPLE_SCENARIO, indent=2))
+        return
+    with open(args.scenario) as f:
+        scenario = json.load(f)
+    autoscaler = load_autoscaler()
+    seed = scenario.get('seed', 1)
+    for i in range(args.seeds):
+        scenario['seed'] = seed + i
+        result = Simulator(scenario, autoscaler).run()
+        print(json.dumps({'seed': scenario['seed'], **result}))
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,8 @@ from apscheduler.schedulers.blocking import BlockingScheduler
 import logging
 import structlog
 from datetime import datetime
+import queue
+import threading
 from ..model import scanner as Scanner
 import os
 from ..tidb_sql import get_db_session
@@ -12,6 +14,8 @@ from sqlalchemy.orm import Session
 from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
 # from kubernetes import client as k8s_client
 from ..k8s_client import load_kube_config
+from ..k8s_informer import Informer, new_pod_informer
+from ..http_client import http_client
 from kubernetes import client
 from kubernetes.client import V1PodList
 from kubernetes.client.rest import ApiException
@@ -28,8 +32,21 @@ logger = structlog.wrap_logger(logging.getLogger())
 taskManagerHost = os.getenv("TASK_MANAGER_HOST", "localhost")
 taskManagerPort = os.getenv("TASK_MANAGER_PORT", "4000")
 taskManagerUrl = f"http://{taskManagerHost}:{taskManagerPort}"
-deleteWaitTime = os.getenv("DELETE_WAIT_TIME", "600")
+deleteWaitTime = int(os.getenv("DELETE_WAIT_TIME", "600"))
+# 全量对账的间隔(秒), 日常的状态变化由pod事件即时处理, 全量对账只作为兜底
+resyncInterval = int(os.getenv("RESYNC_INTERVAL", "300"))
+# pod与数据库记录连续不一致多少次后才删除pod, 单次不一致(如pod刚启动还没有ip)只记录
+mismatchDeleteLimit = int(os.getenv("SCANNER_MISMATCH_LIMIT", "3"))
 namespace = os.getenv("NAMESPACE", "vtscan")
+scannerLabelSelector = "type=scanner,group=vtscan"
+# 扫描器pod的本地缓存, 启动时创建
+scanner_informer: Informer = None
+# 待处理的pod事件, 由单独的线程逐个处理, 不阻塞informer的watch
+scanner_event_queue: queue.Queue = queue.Queue()
+# 事件处理与全量对账互斥, 避免同一scanner被并发修改
+reconcile_lock = threading.Lock()
+# scanner名称 -> 连续不一致的次数, 在reconcile_lock内读写
+scanner_mismatches: Dict[str, int] = {}
 
 def handle_retry_error(retry_state):
     logger.error(f"All retries failed with exception: {retry_state.outcome.exception()}")
@@ -45,26 +62,40 @@ def get_db_scanners(db_session: Session):
     query = (
         db_session.query(Scanner.VtScanner)
         .filter(Scanner.VtScanner.status.in_(
-            [Scanner.Status.DISABLE, Scanner.Status.ENABLE, Scanner.Status.WAITING, Scanner.Status.DELETING]
+            [Scanner.Status.DISABLE, Scanner.Status.ENABLE, Scanner.Status.WAITING, Scanner.Status.DELETING,
+             Scanner.Status.STANDBY]
         ))
     )
     return query.all()
 
+def start_scanner_informer():
+    global scanner_informer
+    scanner_informer = new_pod_informer(namespace=namespace, label_selector=scannerLabelSelector)
+    scanner_informer.add_handler(enqueue_scanner_event)
+    threading.Thread(target=scanner_event_worker, name="scanner-event-worker", daemon=True).start()
+    scanner_informer.start()
+
+def pod_to_scanner(pod) -> dict:
+    return {
+        'name': pod.metadata.name,
+        'labels': pod.metadata.labels,
+        'status': pod.status.phase,
+        'ipaddr': pod.status.pod_ip,
+        'node': pod.spec.node_name
+    }
+
 def fetch_scanners():
-    v1 = client.CoreV1Api()
     # 首先获取所有负责scale的scanner的scaler
     scanners = []
     try:
-        label_selector = "type=scanner,group=vtscan"
-        pods:V1PodList = v1.list_namespaced_pod(namespace=namespace, label_selector=label_selector, watch=False)
-        for pod in pods.items:
-            scanners.append({
-                'name': pod.metadata.name,
-                'labels': pod.metadata.labels,
-                'status': pod.status.phase,
-                'ipaddr': pod.status.pod_ip,
-                'node': pod.spec.node_name
-            })
+        # 缓存已同步时直接读取本地缓存
+        if scanner_informer != None and scanner_informer.has_synced():
+            pods = scanner_informer.list()
+        else:
+            v1 = client.CoreV1Api()
+            pods = v1.list_namespaced_pod(namespace=namespace, label_selector=scannerLabelSelector, watch=False).items
+        for pod in pods:
+            scanners.append(pod_to_scanner(pod))
     except ApiException as e:
         logger.error(f"Exception when calling CoreV1Api->list_pod_for_all_namespaces: {e}\n")
         return False, []
@@ -100,22 +131,16 @@ def log_delete_scanner_wrong(scanner_name: str):
     logger.error(f"scanner {scanner_name} delete Unexpected")
 
 # query scanner task from task manager
-@retry(
-    stop=stop_after_attempt(5),
-    wait=wait_fixed(1),
-    retry=(retry_if_exception_type(requests.exceptions.Timeout) | retry_if_exception_type(requests.exceptions.ConnectionError)),
-    retry_error_callback=handle_retry_error
-)
-def check_scanner_running_task(scanner_name: str):
+def check_scanner_running_task(scanner_id: int):
     """
         reponse:
         {
             running_task_num: 运行中任务数量
         }
     """
-    response = requests.get(
+    response = http_client.get(
         taskManagerUrl + '/get_running_task_num',
-        params={'scanner_name': scanner_name},
+        params={'scanner_id': scanner_id},
     )
     response.raise_for_status()
     data = response.json()
@@ -126,6 +151,9 @@ def check_scanner_running_task(scanner_name: str):
 
 def calculate_wait_time(record_time):
     current_time = datetime.now(timezone.utc)
+    # 数据库中保存的是不带时区的UTC时间
+    if record_time.tzinfo == None:
+        record_time = record_time.replace(tzinfo=timezone.utc)
     wait_time = current_time - record_time
     return int(wait_time.total_seconds())
 
@@ -146,26 +174,45 @@ def delete_deleting_scanner(scanner_name:str):
     except client.ApiException as e:
         logger.error("Exception when calling CoreV1Api->delete_namespaced_pod: %s\n" % e)
 
-def trans_db_scanner_status(db_scanner:Scanner.VtScanner, k8s_scanner_dict: Dict[dict]):
+def enum_value(value) -> str:
+    return getattr(value, 'value', value)
+
+def scanner_mismatch(db_scanner: Scanner.VtScanner, k8s_scanner: dict) -> bool:
+    """pod的ip/engine/port/filetype与数据库记录是否不一致, pod还没有分配ip时不比较ip"""
+    labels = k8s_scanner['labels']
+    if k8s_scanner['ipaddr'] != None and k8s_scanner['ipaddr'] != db_scanner.ipaddr:
+        return True
+    return labels['engine'] != enum_value(db_scanner.engine) or \
+        labels.get('port', '80') != db_scanner.port or \
+        labels.get('filetype', Scanner.FileType.HTML.value) != enum_value(db_scanner.filetype)
+
+def trans_db_scanner_status(db_scanner:Scanner.VtScanner, k8s_scanner_dict: Dict[dict]) -> bool:
+    """根据pod状态更新scanner记录, 需要在reconcile_lock内调用
+
+    返回scanner是否已等待超时, 需要向任务管理器确认没有运行中的任务后再删除.
+    该查询是阻塞的http调用, 由调用方在锁外通过delete_idle_waiting_scanners完成
+    """
     if db_scanner.name not in k8s_scanner_dict:
+        scanner_mismatches.pop(db_scanner.name, None)
         if db_scanner.status != Scanner.Status.DELETING:
             log_delete_scanner_wrong(db_scanner.name)
         else:
             log_delete_scanner_succ(db_scanner.name)
         db_scanner.status = Scanner.Status.DELETED
-        return
+        return False
     k8s_scanner = k8s_scanner_dict[db_scanner.name]
-    k8s_scanner_labels = k8s_scanner['labels']
-    k8s_scanner_engine = k8s_scanner_labels['engine']
-    k8s_scanner_port = k8s_scanner_labels.get('port', '80')
-    k8s_scanner_filetype = k8s_scanner_labels.get('filetype', Scanner.FileType.HTML)
-    if k8s_scanner['ipaddr'] != db_scanner.ipaddr or \
-        k8s_scanner_engine != db_scanner.engine or \
-        k8s_scanner_port != db_scanner.port or \
-        k8s_scanner_filetype != db_scanner.filetype:
-        logger.error(f"scanner {db_scanner.name} ip inconsistent, deleting")
-        db_scanner.status == Scanner.Status.DELETING
-        return
+    if scanner_mismatch(db_scanner, k8s_scanner):
+        mismatches = scanner_mismatches.get(db_scanner.name, 0) + 1
+        scanner_mismatches[db_scanner.name] = mismatches
+        if mismatches < mismatchDeleteLimit:
+            logger.error(f"scanner {db_scanner.name} ip inconsistent ({mismatches}/{mismatchDeleteLimit})")
+            return False
+        logger.error(f"scanner {db_scanner.name} ip inconsistent {mismatches} times, deleting")
+        scanner_mismatches.pop(db_scanner.name, None)
+        db_scanner.status = Scanner.Status.DELETING
+        delete_deleting_scanner(db_scanner.name)
+        return False
+    scanner_mismatches.pop(db_scanner.name, None)
     # 删除的话一定是什么都没了
     if k8s_scanner['status'] in [K8sPodStatus.FAILED, K8sPodStatus.SUCCEEDED]:
         if db_scanner.status != Scanner.Status.DELETING:
@@ -192,21 +239,42 @@ def trans_db_scanner_status(db_scanner:Scanner.VtScanner, k8s_scanner_dict: Dict
     if db_scanner.status == Scanner.Status.WAITING:
         wait_time = calculate_wait_time(db_scanner.update_time)
         if wait_time < deleteWaitTime:
-            return
-        # 理论上WAITING状态只有在scanner上没有负载时删除
-        try:
-            canDelete = check_scanner_running_task(db_scanner.name)
-        except Exception as e:
-            logger.error(f"check scanner running task error: {e}")
-        if not canDelete:
-            return
-        db_scanner.status = Scanner.Status.DELETING
+            return False
+        # 理论上WAITING状态只有在scanner上没有负载时删除, 由调用方在锁外确认
+        return True
     # 处理异常scanner, 直接删除
     if db_scanner.except_num >= db_scanner.max_concurrency:
         db_scanner.status = Scanner.Status.DELETING
     # 对于deleting状态下的scanner执行删除操作
     if db_scanner.status == Scanner.Status.DELETING:
         delete_deleting_scanner(db_scanner.name)    
+    return False
+
+def waiting_timeout(db_scanner: Scanner.VtScanner) -> bool:
+    return db_scanner.status == Scanner.Status.WAITING and \
+        calculate_wait_time(db_scanner.update_time) >= deleteWaitTime
+
+def delete_idle_waiting_scanners(scanner_ids: List[int]):
+    """删除等待超时且没有运行中任务的scanner
+    先在锁外逐个向任务管理器查询, 再加锁复核状态后删除, 查询期间状态被事件或autoscaler改变的跳过
+    """
+    idle_ids = []
+    for scanner_id in scanner_ids:
+        try:
+            if check_scanner_running_task(scanner_id):
+                idle_ids.append(scanner_id)
+        except Exception as e:
+            logger.error(f"check scanner running task error: {e}")
+    if not idle_ids:
+        return
+    with reconcile_lock, get_db_session() as db_session:
+        db_scanners = db_session.query(Scanner.VtScanner).filter(Scanner.VtScanner.id.in_(idle_ids)).all()
+        for db_scanner in db_scanners:
+            if not waiting_timeout(db_scanner):
+                continue
+            db_scanner.status = Scanner.Status.DELETING
+            delete_deleting_scanner(db_scanner.name)
+            db_session.add(db_scanner)
 
 def insert_scanners(k8s_scanenrs: List[dict], db_scanner_dict: Dict[str, Scanner.VtScanner]):
     new_scanners = []
@@ -219,6 +287,15 @@ def insert_scanners(k8s_scanenrs: List[dict], db_scanner_dict: Dict[str, Scanner
             k8s_scanner_node = k8s_scanner['node']
             k8s_scanner_labels = k8s_scanner['labels']
             k8s_scanner_ipaddr = k8s_scanner['ipaddr']
+            try:
+                filetype = Scanner.FileType(k8s_scanner_labels.get('filetype', Scanner.FileType.HTML.value))
+            except ValueError:
+                logger.error(f"scanner {k8s_scanner_name} has unknown filetype {k8s_scanner_labels.get('filetype')}")
+                continue
+            # 带standby标签的pod为热备扫描器, 由autoscaler扩容时转为ENABLE
+            status = Scanner.Status.ENABLE
+            if k8s_scanner_labels.get('standby') == 'true':
+                status = Scanner.Status.STANDBY
             new_scanner = Scanner.VtScanner(
                 name=k8s_scanner_name,
                 type=k8s_scanner_labels['scan_type'],
@@ -226,35 +303,83 @@ def insert_scanners(k8s_scanenrs: List[dict], db_scanner_dict: Dict[str, Scanner
                 ipaddr=k8s_scanner_ipaddr,
                 port=k8s_scanner_labels.get('port', '80'),
                 node=k8s_scanner_node,
-                filetype=k8s_scanner_labels.get('filetype', Scanner.FileType.HTML),
-                max_concurrency=k8s_scanner_labels['max_concurrency']
+                filetype=filetype,
+                max_concurrency=k8s_scanner_labels['max_concurrency'],
+                status=status
             )
             new_scanners.append(new_scanner)
     return new_scanners
 
 def trace_scanners():
-    logger.info("Tracing tasks")
+    """全量对账: 对比数据库与k8s中的全部扫描器, 作为事件处理的兜底"""
+    logger.info("Tracing scanners")
+    waiting_ids: List[int] = []
     try:
-        with get_db_session() as db_session:
+        with reconcile_lock, get_db_session() as db_session:
             # 获取数据库中运行中（enable/disable）的扫描器
-            db_scanners = get_db_scanners()
+            db_scanners = get_db_scanners(db_session)
             # 从k8s获取所有运行中scanner
             succ, k8s_scanners = fetch_scanners()
             if not succ:
                 return
-            db_scanner_dict = list_trans_to_dict(db_scanners)
+            db_scanner_dict = {db_scanner.name: db_scanner for db_scanner in db_scanners}
             k8s_scanner_dict = list_trans_to_dict(k8s_scanners)
             # 检查db_scanner
             for db_scanner in db_scanners:
                 # 不在就是已经删除了，直接删除
-                trans_db_scanner_status(db_scanner, k8s_scanner_dict)
+                if trans_db_scanner_status(db_scanner, k8s_scanner_dict):
+                    waiting_ids.append(db_scanner.id)
             # 插入新加入的scanner
             new_scanners = insert_scanners(k8s_scanners, db_scanner_dict)
             # 全部scanner变更写入数据库
             db_session.add_all(db_scanners)
             db_session.add_all(new_scanners)
     except Exception as e:
-        logger.error(f"Dbsession save {db_session} exception: {e}")
+        logger.error(f"Trace scanners exception: {e}")
+        return
+    delete_idle_waiting_scanners(waiting_ids)
+
+def enqueue_scanner_event(event_type: str, pod):
+    """informer回调, 只记录事件, 由worker线程处理"""
+    scanner_event_queue.put((event_type, pod_to_scanner(pod)))
+
+def reconcile_scanner(event_type: str, k8s_scanner: dict):
+    """根据单个pod事件只更新对应的scanner记录
+    
+    Keyword arguments:
+    event_type: ADDED / MODIFIED / DELETED
+    k8s_scanner: pod信息, 格式同fetch_scanners
+    """
+    name = k8s_scanner['name']
+    waiting_ids: List[int] = []
+    with reconcile_lock, get_db_session() as db_session:
+        db_scanner = (
+            db_session.query(Scanner.VtScanner)
+            .filter(Scanner.VtScanner.name == name)
+            .filter(Scanner.VtScanner.status.in_(
+                [Scanner.Status.DISABLE, Scanner.Status.ENABLE, Scanner.Status.WAITING, Scanner.Status.DELETING,
+                 Scanner.Status.STANDBY]
+            ))
+            .first()
+        )
+        # pod删除时k8s中已经不存在该scanner
+        k8s_scanner_dict = {} if event_type == 'DELETED' else {name: k8s_scanner}
+        if db_scanner == None:
+            new_scanners = insert_scanners(list(k8s_scanner_dict.values()), {})
+            db_session.add_all(new_scanners)
+            return
+        if trans_db_scanner_status(db_scanner, k8s_scanner_dict):
+            waiting_ids.append(db_scanner.id)
+        db_session.add(db_scanner)
+    delete_idle_waiting_scanners(waiting_ids)
+
+def scanner_event_worker():
+    while True:
+        event_type, k8s_scanner = scanner_event_queue.get()
+        try:
+            reconcile_scanner(event_type, k8s_scanner)
+        except Exception as e:
+            logger.error(f"Reconcile scanner {k8s_scanner['name']} on {event_type} error: {e}")
 
 # sacnner的扩缩容交给各个scanner自己实现的扩缩器处理
 # 资源管理器向他们提供集群资源信息, 由这些扩缩器决定是否进行扩缩，以及如何扩缩
@@ -285,8 +410,10 @@ if __name__ == "__main__":
     except Exception as e:
         logger.error((e))
         raise
+    start_scanner_informer()
     scheduler = BlockingScheduler()
-    scheduler.add_job(resource_schedule, 'interval', seconds=60)  # 每60秒执行一次
+    # pod事件即时处理, 全量对账以较长的间隔兜底
+    scheduler.add_job(resource_schedule, 'interval', seconds=resyncInterval)
     logger.info("Starting resource scheduler...")
     try:
         scheduler.start()
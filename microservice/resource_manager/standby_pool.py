@@ -0,0 +1,79 @@
+from collections import deque
+from typing import Dict, List, Tuple
+
+# 热备扫描器池
+# 新建pod从调度、拉取镜像到扫描器就绪需要数分钟, 任务突发时等待时间主要花在pod启动上.
+# 预先在node上启动少量pod并保持STANDBY状态(不分配任务、不计入engine已分配并发度),
+# 扩容时直接转为ENABLE, 只需要一次数据库更新.
+# 池的大小按最近时间窗口内该engine的扩容次数估计, 限制在[pool_min, pool_max]之间,
+# 扩容频繁时多备、空闲一段时间后逐渐释放
+
+class StandbyPool:
+    """按engine统计扩容次数并计算热备扫描器的补充/释放方案
+
+    Keyword arguments:
+    window: 统计扩容次数的时间窗口(秒)
+    pool_min/pool_max: 每个engine热备扫描器数量的上下限, pool_max为0时不启用
+    per_node: 每个node上每个engine最多的热备扫描器数量
+    """
+
+    def __init__(self, window: float, pool_min: int, pool_max: int, per_node: int):
+        self.window = window
+        self.pool_min = pool_min
+        self.pool_max = pool_max
+        self.per_node = per_node
+        # engine -> 扩容时间戳
+        self.scale_outs: Dict[str, deque] = {}
+
+    def enabled(self) -> bool:
+        return self.pool_max > 0
+
+    def record_scale_out(self, engine: str, now: float):
+        """记录一次因任务负载产生的扩容(热备转换或新建pod), 补充热备的pod不计入"""
+        self.scale_outs.setdefault(engine, deque()).append(now)
+
+    def recent_scale_outs(self, engine: str, now: float) -> int:
+        history = self.scale_outs.get(engine)
+        if not history:
+            return 0
+        while history and history[0] < now - self.window:
+            history.popleft()
+        return len(history)
+
+    def target(self, engine: str, now: float) -> int:
+        """engine的目标热备数量: 最近窗口内的扩容次数, 限制在上下限之间"""
+        return max(self.pool_min, min(self.pool_max, self.recent_scale_outs(engine, now)))
+
+    def plan(self, engine: str, now: float, standby: List, pending: Dict[str, int],
+             nodes: List[str]) -> Tuple[Dict[str, int], List]:
+        """计算engine热备池的补充与释放
+
+        Keyword arguments:
+        engine: 扫描器类型
+        now: 当前时间戳
+        standby: 该engine已就绪的热备扫描器
+        pending: 通过node获取该engine已创建但还未就绪的热备pod数量
+        nodes: 可以放置热备pod的node, 按负载从低到高排序
+        Return: ({node: 需要新建的热备pod数}, 需要释放的热备扫描器)
+        """
+        target = self.target(engine, now)
+        node_count: Dict[str, int] = dict(pending)
+        for scanner in standby:
+            node_count[scanner.node] = node_count.get(scanner.node, 0) + 1
+        have = sum(node_count.values())
+        create: Dict[str, int] = {}
+        for node in nodes:
+            if have >= target:
+                break
+            num = min(self.per_node - node_count.get(node, 0), target - have)
+            if num <= 0:
+                continue
+            create[node] = num
+            have += num
+        retire = []
+        if have > target:
+            # 只释放已就绪的热备扫描器, 优先释放负载高的node上的
+            order = {node: i for i, node in enumerate(nodes)}
+            candidates = sorted(standby, key=lambda scanner: order.get(scanner.node, len(order)), reverse=True)
+            retire = candidates[:have - target]
+        return create, retire
@@ -0,0 +1,165 @@
+"""promql查询层的测试
+
+用http.server启动一个假的Prometheus, 验证parallel / combined / recording三种查询方式与结果缓存
+用法: 在microservice目录下执行 python -m pytest resource_manager/test_promql.py
+"""
+import json
+import re
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+from resource_manager import promql
+
+# 每个查询的处理耗时(秒), 用于区分并发与串行
+QUERY_DELAY = 0.3
+
+def vector(label: str, values: dict) -> list:
+    return [{'metric': {label: name}, 'value': [1672381200, str(value)]} for name, value in values.items()]
+
+# 每个指标返回的结果, 按查询语句或recording rule名称匹配
+METRIC_RESULTS = {
+    'node_cpu_available': vector('node', {'node1': 1.5, 'node2': 2.5}),
+    'namespace_cpu_used': vector('instance', {'node1': 0.5}),
+    'namespace_memory_used': vector('instance', {'node1': 1024}),
+    'node_memory_available': vector('node', {'node1': 4096, 'node2': 8192}),
+}
+
+class FakePrometheus(BaseHTTPRequestHandler):
+    # 收到的查询, 由测试读取
+    queries = []
+    lock = threading.Lock()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query).get('query', [''])[0]
+        with self.lock:
+            self.queries.append(query)
+        time.sleep(QUERY_DELAY)
+        if url.path != '/api/v1/query':
+            self.reply(404, {'status': 'error', 'error': 'not found'})
+            return
+        self.reply(200, {'status': 'success', 'data': {'resultType': 'vector', 'result': self.evaluate(query)}})
+
+    def evaluate(self, query: str) -> list:
+        # 合并查询: 按label_replace写入的vt_metric标签拼接各指标的结果
+        combined = re.findall(r'"vt_metric", "(\w+)"', query)
+        if combined:
+            results = []
+            for metric in combined:
+                for result in METRIC_RESULTS[metric]:
+                    results.append({'metric': dict(result['metric'], vt_metric=metric), 'value': result['value']})
+            return results
+        for metric in METRIC_RESULTS:
+            if query in (promql.METRIC_QUERIES[metric], promql.RECORDING_RULES[metric]):
+                return METRIC_RESULTS[metric]
+        return []
+
+    def reply(self, code: int, body: dict):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+class PromqlTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FakePrometheus)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        FakePrometheus.queries.clear()
+        promql.clear_query_cache()
+        patcher = mock.patch.object(promql, 'prometheusUrl', self.url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def use_mode(self, mode: str, ttl: float = 10):
+        for name, value in (('prometheusQueryMode', mode), ('prometheusCacheTtl', ttl)):
+            patcher = mock.patch.object(promql, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def assert_node_metrics(self):
+        self.assertEqual(promql.query_nodes_cpu_avaliable(), {'node1': 1.5, 'node2': 2.5})
+        self.assertEqual(promql.query_namespace_cpu_used(), {'node1': 0.5})
+        self.assertEqual(promql.query_namespace_memory_used(), {'node1': 1024.0})
+        self.assertEqual(promql.query_nodes_memory_available(), {'node1': 4096.0, 'node2': 8192.0})
+        self.assertEqual(promql.nodes_cpu_vt_scan_assignable(), {'node1': 2.0})
+        self.assertEqual(promql.nodes_memory_vt_scan_assignable(), {'node1': 5120.0})
+
+    def test_parallel(self):
+        self.use_mode('parallel')
+        start = time.monotonic()
+        results = promql.prefetch_node_metrics()
+        elapsed = time.monotonic() - start
+        metrics = len(promql.METRIC_QUERIES)
+        self.assertEqual(len(results), metrics)
+        self.assertEqual(sorted(FakePrometheus.queries), sorted(promql.METRIC_QUERIES.values()))
+        # 并发发送时总耗时接近单个查询的耗时
+        self.assertLess(elapsed, QUERY_DELAY * (metrics - 1))
+        # 预取之后的查询全部命中缓存
+        self.assert_node_metrics()
+        self.assertEqual(len(FakePrometheus.queries), metrics)
+
+    def test_combined(self):
+        self.use_mode('combined')
+        results = promql.prefetch_node_metrics()
+        self.assertEqual(len(FakePrometheus.queries), 1)
+        self.assertIn(' or ', FakePrometheus.queries[0])
+        for metric, query in promql.METRIC_QUERIES.items():
+            # 拆分后的结果去掉了vt_metric标签
+            self.assertEqual(results[query]['result'], METRIC_RESULTS[metric])
+        self.assert_node_metrics()
+        self.assertEqual(len(FakePrometheus.queries), 1)
+
+    def test_combined_cached(self):
+        self.use_mode('combined')
+        first = promql.prefetch_node_metrics()
+        # 缓存时间内再次合并查询, 命中缓存的原始结果也要能正确拆分
+        second = promql.prefetch_node_metrics()
+        self.assertEqual(len(FakePrometheus.queries), 1)
+        self.assertEqual(second, first)
+        for metric, query in promql.METRIC_QUERIES.items():
+            self.assertEqual(second[query]['result'], METRIC_RESULTS[metric])
+        self.assert_node_metrics()
+
+    def test_recording(self):
+        self.use_mode('recording')
+        promql.prefetch_node_metrics()
+        self.assertEqual(sorted(FakePrometheus.queries), sorted(promql.RECORDING_RULES.values()))
+        self.assert_node_metrics()
+        self.assertEqual(len(FakePrometheus.queries), len(promql.RECORDING_RULES))
+
+    def test_cache_ttl(self):
+        self.use_mode('parallel', ttl=0.5)
+        query = promql.metric_query('node_cpu_available')
+        promql.query_prometheus(query)
+        promql.query_prometheus(query)
+        self.assertEqual(len(FakePrometheus.queries), 1)
+        # 超过缓存时间后重新查询
+        time.sleep(0.6)
+        promql.query_prometheus(query)
+        self.assertEqual(len(FakePrometheus.queries), 2)
+        # 清空缓存后重新查询
+        promql.clear_query_cache()
+        promql.query_prometheus(query)
+        self.assertEqual(len(FakePrometheus.queries), 3)
+
+if __name__ == '__main__':
+    unittest.main()
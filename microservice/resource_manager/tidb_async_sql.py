@@ -0,0 +1,32 @@
+from typing import AsyncIterator
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+import os
+from tidb_sql import get_db_url
+
+# 连接池配置, API为异步服务, 并发请求数远高于调度器, 需要更大的连接池
+dbPoolSize = int(os.getenv("DB_POOL_SIZE", "20"))
+dbMaxOverflow = int(os.getenv("DB_MAX_OVERFLOW", "30"))
+dbPoolTimeout = int(os.getenv("DB_POOL_TIMEOUT", "10"))
+
+# 创建异步数据库引擎, pre_ping保证从池中取出的连接可用
+async_engine = create_async_engine(
+    get_db_url(driver="aiomysql"),
+    pool_size=dbPoolSize,
+    max_overflow=dbMaxOverflow,
+    pool_timeout=dbPoolTimeout,
+    pool_recycle=3600,
+    pool_pre_ping=True,
+)
+
+# 创建异步会话工厂, 提交后不过期对象, 便于响应序列化
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+async def get_async_db_session() -> AsyncIterator[AsyncSession]:
+    """为每个请求提供一个事务性的异步数据库会话, 作为FastAPI依赖使用"""
+    async with AsyncSessionLocal() as db_session:
+        try:
+            yield db_session
+            await db_session.commit()
+        except Exception:
+            await db_session.rollback()
+            raise
@@ -0,0 +1,54 @@
+import html
+import json
+from typing import Dict, Iterable, List, Optional
+
+# 告警流报告
+# ZAP扫描器以NDJSON逐行返回告警(见zap_api.get_report_stream), 在此边读边生成html报告,
+# 每条告警读到后立即渲染为表格行, 不保留原始告警, 内存只与最终报告大小相关
+
+RISK_ORDER = ('High', 'Medium', 'Low', 'Informational')
+# (告警字段, 表头)
+ALERT_COLUMNS = (('risk', 'Risk'), ('confidence', 'Confidence'), ('alert', 'Alert'), ('url', 'URL'),
+                 ('param', 'Parameter'), ('cweid', 'CWE'), ('solution', 'Solution'))
+
+class IncompleteReport(Exception):
+    """告警流缺少end行, 导出中途失败"""
+
+def render_alert_row(alert: dict) -> str:
+    return "<tr>" + "".join(f"<td>{html.escape(str(alert.get(key, '')))}</td>" for key, _ in ALERT_COLUMNS) + "</tr>"
+
+def render_alert_stream(lines: Iterable[bytes]) -> bytes:
+    """将告警流渲染为按风险等级排序的html报告, 告警流不完整时抛出IncompleteReport
+
+    Keyword arguments:
+    lines: NDJSON的每一行
+    """
+    target = ''
+    rows: Dict[str, List[str]] = {risk: [] for risk in RISK_ORDER + ('',)}
+    count: Optional[int] = None
+    num = 0
+    for line in lines:
+        if not line:
+            continue
+        record = json.loads(line)
+        kind = record.pop('kind', None)
+        if kind == 'meta':
+            target = record.get('target', '')
+        elif kind == 'alert':
+            risk = record.get('risk', '')
+            rows[risk if risk in rows else ''].append(render_alert_row(record))
+            num += 1
+        elif kind == 'end':
+            count = record.get('count')
+    if count == None or count != num:
+        raise IncompleteReport(f"alert stream incomplete, {num} alerts received")
+    head = (
+        "<html><head><meta charset=\"utf-8\"><title>ZAP Scanning Report</title></head><body>"
+        f"<h1>ZAP Scanning Report</h1><p>Target: {html.escape(target)}</p><p>Alerts: {num}</p>"
+        "<table border=\"1\"><tr>" + "".join(f"<th>{title}</th>" for _, title in ALERT_COLUMNS) + "</tr>"
+    )
+    parts = [head]
+    for risk in RISK_ORDER + ('',):
+        parts.extend(rows[risk])
+    parts.append("</table></body></html>")
+    return "".join(parts).encode('utf-8')
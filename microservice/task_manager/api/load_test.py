@@ -0,0 +1,64 @@
+"""/list_tasks 压测脚本
+
+用法: python load_test.py --url http://localhost:80 --user-id 1 --clients 500 --requests 20
+输出各分位延迟, 用于验证异步数据库层在高并发下的表现
+"""
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+import requests
+
+def run_client(url: str, user_id: int, num: int, start_event: threading.Event) -> List[float]:
+    latencies = []
+    session = requests.Session()
+    start_event.wait()
+    for i in range(num):
+        begin = time.perf_counter()
+        try:
+            response = session.get(
+                url + '/list_tasks',
+                params={'user_id': user_id, 'page_num': i % 10 + 1, 'page_size': 10},
+                timeout=30
+            )
+            response.raise_for_status()
+        except Exception:
+            latencies.append(float('inf'))
+            continue
+        latencies.append(time.perf_counter() - begin)
+    return latencies
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * p))
+    return sorted_values[index]
+
+def main():
+    parser = argparse.ArgumentParser(description="/list_tasks load test")
+    parser.add_argument('--url', default='http://localhost:80')
+    parser.add_argument('--user-id', type=int, default=1)
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=20, help="requests per client")
+    args = parser.parse_args()
+
+    start_event = threading.Event()
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        futures = [executor.submit(run_client, args.url, args.user_id, args.requests, start_event)
+                   for _ in range(args.clients)]
+        begin = time.perf_counter()
+        start_event.set()
+        latencies = []
+        for future in futures:
+            latencies.extend(future.result())
+        elapsed = time.perf_counter() - begin
+    failed = len([latency for latency in latencies if latency == float('inf')])
+    latencies = sorted([latency for latency in latencies if latency != float('inf')])
+    print(f"clients={args.clients} total={len(latencies) + failed} failed={failed} "
+          f"rps={len(latencies) / elapsed:.1f}")
+    for p in [0.5, 0.9, 0.99]:
+        print(f"p{int(p * 100)}={percentile(latencies, p) * 1000:.1f}ms")
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,7 @@ class ScannerEngine(str, Enum):
 class Status(str, Enum):
     QUEUED = 'queued'
     RUNNING = 'running'
+    REPORT_PENDING = 'report_pending'
     DONE = 'done'
     FAILED = 'failed'
 
@@ -45,6 +46,7 @@ class VtTaskListResponse(BaseModel):
     page_num: int
     page_size: int
     tasks: List[VtTaskSchema]
+    next_cursor: Optional[str] = None  # 下一页游标, 为空表示没有更多数据
 
 
 class VtTaskCreateRequest(BaseModel):
@@ -96,4 +98,34 @@ class VtRunningTaskCountResponse(BaseModel):
 
 
 class VtRunningTaskCountRequest(BaseModel):
-    engines: List[str]
\ No newline at end of file
+    engines: List[str]
+
+class ScannerTaskStatus(str, Enum):
+    RUNNING = 'Running'
+    DONE = 'Done'
+    FAILED = 'Failed'
+    ERROR = 'Error'
+
+
+class VtTaskEventSchema(BaseModel):
+    event_id: str = Field(..., description="Unique id of the event, used for deduplication on the scanner side")
+    task_id: int = Field(..., description="Global task id")
+    scanner: str = Field(..., description="The name of the scanner pod that runs the task")
+    status: ScannerTaskStatus = Field(..., description="The new status of the task on the scanner")
+    report_ready: bool = Field(False, description="Whether the report can be downloaded")
+    errmsg: Optional[str] = Field(None, description="The reason of the failure")
+
+
+class VtTaskEventRequest(BaseModel):
+    events: List[VtTaskEventSchema]
+
+
+class VtTaskEventResultSchema(BaseModel):
+    event_id: str
+    applied: bool
+    reason: Optional[str] = None
+
+
+class VtTaskEventResponse(BaseModel):
+    ok: bool
+    results: List[VtTaskEventResultSchema]
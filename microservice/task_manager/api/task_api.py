@@ -1,11 +1,18 @@
 import base64
+from datetime import datetime
+import hmac
 import logging
+import os
+from typing import Optional, Tuple
 import structlog
-from ..model import task as Task
-from ..tidb_sql import get_db_session
-from sqlalchemy.orm import Session
-from sqlalchemy import desc, func
-from fastapi import FastAPI, Request, Depends, status as Status, Query
+from ..model import task as Task, counter as Counter
+from ..tidb_async_sql import get_async_db_session
+from .. import task_counter  # 注册任务计数表维护事件
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from sqlalchemy import desc, func, and_, or_
+from sqlalchemy.dialects.mysql import insert
+from fastapi import FastAPI, HTTPException, Header, Request, Depends, status as Status, Query
 from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.exc import SQLAlchemyError
 from fastapi.middleware.cors import CORSMiddleware
@@ -21,6 +28,8 @@ logging.basicConfig(
     datefmt='%Y-%m-%dT%H:%M:%S%z'
 )
 logger = structlog.wrap_logger(logging.getLogger())
+# 扫描器回调任务事件时携带的共享密钥, 为空时拒绝所有回调
+taskEventToken = os.getenv("TASK_EVENT_TOKEN", "")
 
 app = FastAPI()
 
@@ -59,19 +68,65 @@ async def global_exception_handler(request: Request, exc: Exception):
         },
     )
 
+def encode_cursor(create_time: datetime, task_id: int) -> str:
+    raw = f"{create_time.isoformat()}|{task_id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('utf-8')
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8')
+        create_time, task_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(create_time), int(task_id)
+    except Exception:
+        raise HTTPException(status_code=Status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+async def get_user_task_total(db_session: AsyncSession, user_id: int) -> int:
+    """从计数表读取用户任务总数, 计数不存在时COUNT一次并初始化"""
+    total = (await db_session.execute(
+                select(Counter.VtUserTaskCount.task_num).filter(Counter.VtUserTaskCount.user_id == str(user_id))
+            )).scalar()
+    if total != None:
+        return total
+    total = (await db_session.execute(
+                select(func.count()).select_from(Task.VtTask).filter(Task.VtTask.user_id == user_id)
+            )).scalar_one()
+    # 并发创建任务时计数可能已由incr_user_task_total插入, 此时以已有计数为准, 不覆盖
+    await db_session.execute(
+        insert(Counter.VtUserTaskCount).prefix_with('IGNORE').values(user_id=str(user_id), task_num=total)
+    )
+    return total
+
+async def incr_user_task_total(db_session: AsyncSession, user_id: int):
+    """任务插入后调用, 在同一事务内将用户任务总数加一
+
+    计数不存在时以COUNT结果(已包含新任务)初始化, 存在时在数据库中原子加一, 并发创建不会丢失更新
+    """
+    user_total = (
+        select(func.count()).select_from(Task.VtTask).filter(Task.VtTask.user_id == user_id)
+    ).scalar_subquery()
+    incr_stmt = insert(Counter.VtUserTaskCount).values(user_id=str(user_id), task_num=user_total)
+    await db_session.execute(
+        incr_stmt.on_duplicate_key_update(task_num=Counter.VtUserTaskCount.task_num + 1)
+    )
+
 @app.get("/list_tasks", response_model=schemas.VtTaskListResponse)
 async def list_tasks(
     user_id: int = Query(..., description="Filter tasks by user ID"),
-    page_num: int = Query(1, ge=1, description="Page number"),
+    page_num: int = Query(1, ge=1, description="Page number, ignored when cursor is given"),
     page_size: int = Query(10, ge=1, le=100, description="Number of items per page"),
-    db_session: Session = Depends(get_db_session)
+    cursor: Optional[str] = Query(None, description="Cursor returned by the previous page"),
+    db_session: AsyncSession = Depends(get_async_db_session)
 ):
     """
+    分页方式:
+        传cursor时按(create_time DESC, id DESC)做keyset分页, 深度翻页代价恒定;
+        不传cursor时兼容原有page_num/page_size分页
     Http Code: 状态码200,返回数据:
             {
               "count": 5,
               "page_num": 3,
               "page_size": 2,
+              "next_cursor": "MjAyMy0wMS0yOVQwMTowMToyMi40MDM4ODd8MQ==",
               "results": [
                 {
                   "id": "1",
@@ -97,29 +152,45 @@ async def list_tasks(
             500:
                 DatabaseError
     """
-    offset = (page_num - 1) * page_size
-    query = (
-        db_session.query(Task.VtTask).filter(Task.VtTask.user_id == user_id)
-        .order_by(desc(Task.VtTask.create_time))
-        .offset(offset).limit(page_size)
+    # 先只在索引上定位本页的id, 再按id回表取整行
+    id_query = (
+        select(Task.VtTask.id).filter(Task.VtTask.user_id == user_id)
+        .order_by(desc(Task.VtTask.create_time), desc(Task.VtTask.id))
+        .limit(page_size)
     )
-    tasks = query.all()
-    total = db_session.execute(
-                select(func.count()).select_from(Task.VtTask).filter(Task.VtTask.user_id == user_id)
-            ).scalar_one()
+    if cursor != None:
+        cursor_time, cursor_id = decode_cursor(cursor)
+        id_query = id_query.filter(or_(
+            Task.VtTask.create_time < cursor_time,
+            and_(Task.VtTask.create_time == cursor_time, Task.VtTask.id < cursor_id)
+        ))
+    else:
+        id_query = id_query.offset((page_num - 1) * page_size)
+    task_ids = (await db_session.execute(id_query)).scalars().all()
+    tasks = []
+    if task_ids:
+        tasks = (await db_session.execute(
+                    select(Task.VtTask).filter(Task.VtTask.id.in_(task_ids))
+                    .order_by(desc(Task.VtTask.create_time), desc(Task.VtTask.id))
+                )).scalars().all()
+    next_cursor = None
+    if len(tasks) == page_size:
+        next_cursor = encode_cursor(tasks[-1].create_time, tasks[-1].id)
+    total = await get_user_task_total(db_session, user_id)
     return schemas.VtTaskListResponse(
         count=len(tasks),
         total=total,
-        results=tasks,
+        tasks=tasks,
         page_num=page_num,
         page_size=page_size,
+        next_cursor=next_cursor,
     )
 
 @app.post("/create_task", response_model=schemas.VtTaskCreateResponse, status_code=Status.HTTP_201_CREATED)
 async def create_task(
     task: schemas.VtTaskCreateRequest,
     user_id: int = Query(..., description="Filter tasks by user ID"),
-    db_session: Session = Depends(get_db_session)
+    db_session: AsyncSession = Depends(get_async_db_session)
 ):
     # 创建新的任务实例
     new_task = Task.VtTask(
@@ -132,6 +203,9 @@ async def create_task(
         parallel=task.parallel
     )
     db_session.add(new_task)
+    # flush后才能拿到自增id, 同时让计数初始化时的COUNT包含新任务
+    await db_session.flush()
+    await incr_user_task_total(db_session, user_id)
     return schemas.VtTaskCreateResponse(
         success= True,
         task= new_task
@@ -142,9 +216,11 @@ async def create_task(
 async def get_report(
     user_id: str = Query(..., description="Filter tasks by user ID"),
     task_id: int = Query(..., description="Task ID"),
-    db_session: Session = Depends(get_db_session)
+    db_session: AsyncSession = Depends(get_async_db_session)
 ):
-    task = db_session.query(Task.VtTask).filter(Task.VtTask.id == task_id).first()
+    task = (await db_session.execute(
+                select(Task.VtTask).options(selectinload(Task.VtTask.report)).filter(Task.VtTask.id == task_id)
+            )).scalars().first()
     if task == None:
         raise NotFoundException(detail="Task Not Found")
     if task.user_id != user_id:
@@ -167,9 +243,11 @@ async def get_report(
 async def get_report(
     user_id: str = Query(..., description="Filter tasks by user ID"),
     task_id: int = Query(..., description="Task ID"),
-    db_session: Session = Depends(get_db_session)
+    db_session: AsyncSession = Depends(get_async_db_session)
 ):
-    task = db_session.query(Task.VtTask).filter(Task.VtTask.id == task_id).first()
+    task = (await db_session.execute(
+                select(Task.VtTask).options(selectinload(Task.VtTask.report)).filter(Task.VtTask.id == task_id)
+            )).scalars().first()
     if task == None:
         raise NotFoundException(detail="Task Not Found")
     if task.user_id != user_id:
@@ -184,18 +262,19 @@ async def get_report(
 # 提供给资源管理器进行伸缩的接口
 @app.get("/list_engine_tasks_num", response_model=schemas.VtTaskCountResponse)
 async def get_report(
-    db_session: Session = Depends(get_db_session)
+    db_session: AsyncSession = Depends(get_async_db_session)
 ):
+    # 直接读取计数表, 代价与engine数量相关, 与任务数量无关
     query =(
-        db_session.query(
-            Task.VtTask.scanner_type, 
-            # Task.VtTask.task_status, 
-            func.count(Task.VtTask.id).label('count')  # 使用func.count来统计每个分组的数量
+        select(
+            Counter.VtEngineTaskCount.scanner_type,
+            func.sum(Counter.VtEngineTaskCount.num).label('count')
         )
-        .filter(Task.VtTask.task_status.in_([Task.Status.QUEUED, Task.Status.RUNNING]))  # 筛选状态为'running'或'queued'的任务
-        .group_by(Task.VtTask.scanner_type)  # 按照扫描器类型分组
+        .filter(Counter.VtEngineTaskCount.status.in_([Task.Status.QUEUED, Task.Status.RUNNING]))  # 筛选状态为'running'或'queued'的任务
+        .filter(Counter.VtEngineTaskCount.num > 0)
+        .group_by(Counter.VtEngineTaskCount.scanner_type)  # 按照扫描器类型分组
     )
-    results = query.all()
+    results = (await db_session.execute(query)).all()
     type_num = len(results)
     task_count = []
     for result in results:
@@ -206,22 +285,22 @@ async def get_report(
     )
     
 # 提供给资源管理器进行伸缩的接口
-@app.get("/list_running_tasks_num", response_model=schemas.VtTaskCountResponse)
+@app.get("/list_running_tasks_num", response_model=schemas.VtRunningTaskCountResponse)
 async def get_report(
     engines: schemas.VtRunningTaskCountRequest,
-    db_session: Session = Depends(get_db_session)
+    db_session: AsyncSession = Depends(get_async_db_session)
 ):
+    # 直接读取计数表, 代价与scanner数量相关, 与任务数量无关
     query =(
-        db_session.query(
-            Task.VtTask.scanner_id, 
-            # Task.VtTask.task_status, 
-            func.count(Task.VtTask.id).label('count')  # 使用func.count来统计每个分组的数量
+        select(
+            Counter.VtScannerTaskCount.scanner_id,
+            Counter.VtScannerTaskCount.num
         )
-        .filter(Task.VtTask.task_status == Task.Status.RUNNING)  # 筛选状态为'running'的任务
-        .filter(Task.VtTask.scanner_type.in_(engines))
-        .group_by(Task.VtTask.scanner_id)  # 按照扫描器分组
+        .filter(Counter.VtScannerTaskCount.status == Task.Status.RUNNING)  # 筛选状态为'running'的任务
+        .filter(Counter.VtScannerTaskCount.scanner_type.in_(engines.engines))
+        .filter(Counter.VtScannerTaskCount.num > 0)
     )
-    results = query.all()
+    results = (await db_session.execute(query)).all()
     scanner_num = len(results)
     task_count = []
     for result in results:
@@ -232,27 +311,88 @@ async def get_report(
     )
 
 # 提供给资源管理器控制删除pod的接口
-@app.get("/get_running_task_num", response_model=schemas.VtTaskCountResponse)
+@app.get("/get_running_task_num")
 async def get_report(
     scanner_id: int = Query(..., description="Scanner Name"),
-    db_session: Session = Depends(get_db_session)
+    db_session: AsyncSession = Depends(get_async_db_session)
 ):
     query =(
-        db_session.query(
-            # Task.VtTask.task_status, 
-            func.count(Task.VtTask.id).label('count')  # 使用func.count来统计数量
+        select(
+            func.coalesce(func.sum(Counter.VtScannerTaskCount.num), 0).label('count')
         )
-        .filter(Task.VtTask.task_status == Task.Status.RUNNING)  # 筛选状态为'running'的任务
-        .filter(Task.VtTask.scanner_id == scanner_id)
+        # 筛选状态为'running'的任务, 报告未下载完成的任务同样占用scanner, 不能删除
+        .filter(Counter.VtScannerTaskCount.status.in_([Task.Status.RUNNING, Task.Status.REPORT_PENDING]))
+        .filter(Counter.VtScannerTaskCount.scanner_id == scanner_id)
     )
-    running_task_num = query.scalar()
+    running_task_num = (await db_session.execute(query)).scalar()
     return {
-        "running_task_num": running_task_num
+        "running_task_num": int(running_task_num)
     }
 
+def apply_task_event(task: Task.VtTask, event: schemas.VtTaskEventSchema) -> Tuple[bool, Optional[str]]:
+    """将扫描器上报的状态应用到任务, 返回(是否变更, 未变更的原因)
+
+    事件是幂等的: 只有仍在该扫描器上运行的任务才会变更, 重复的事件、
+    任务已被重新分发或已由轮询处理后到达的事件都直接忽略
+    """
+    if task.task_status != Task.Status.RUNNING:
+        return False, "duplicate"
+    if task.scanner == None or task.scanner.name != event.scanner:
+        return False, "stale"
+    if event.status == schemas.ScannerTaskStatus.RUNNING:
+        if task.except_num != 0:
+            task.except_num = 0
+        return False, "running"
+    if event.status == schemas.ScannerTaskStatus.DONE:
+        if not event.report_ready:
+            return False, "report_not_ready"
+        # 报告由任务调度器的下载worker拉取
+        task.task_status = Task.Status.REPORT_PENDING
+        task.except_num = 0
+    elif event.status == schemas.ScannerTaskStatus.FAILED:
+        task.task_status = Task.Status.FAILED
+        task.errmsg = (event.errmsg or '')[:255]
+        task.except_num = 0
+    elif event.status == schemas.ScannerTaskStatus.ERROR:
+        # 扫描器异常, 重新排队
+        task.scanner.except_num = (task.scanner.except_num or 0) + 1
+        task.task_status = Task.Status.QUEUED
+        task.scanner_id = None
+        task.scanner = None
+        task.except_num = 0
+    return True, None
+
+# 扫描器回调接口, 任务状态变化时由扫描器推送, 任务调度器的轮询只作为兜底
+@app.post("/task_events", response_model=schemas.VtTaskEventResponse)
+async def task_events(
+    events: schemas.VtTaskEventRequest,
+    token: Optional[str] = Header(None, alias="X-Task-Event-Token"),
+    db_session: AsyncSession = Depends(get_async_db_session)
+):
+    if not taskEventToken or token == None or not hmac.compare_digest(token, taskEventToken):
+        raise UnauthorizedException(detail="Invalid Task Event Token")
+    task_ids = {event.task_id for event in events.events}
+    tasks = (await db_session.execute(
+                select(Task.VtTask).options(selectinload(Task.VtTask.scanner)).filter(Task.VtTask.id.in_(task_ids))
+            )).scalars().all()
+    task_dict = {task.id: task for task in tasks}
+    results = []
+    for event in events.events:
+        task = task_dict.get(event.task_id)
+        if task == None:
+            applied, reason = False, "not_found"
+        else:
+            applied, reason = apply_task_event(task, event)
+        if applied:
+            logger.info(f"task {task.id} event {event.event_id} from {event.scanner}: {event.status.value}")
+        results.append(schemas.VtTaskEventResultSchema(event_id=event.event_id, applied=applied, reason=reason))
+    # 版本号冲突(调度器同时更新了任务)时整批失败, 扫描器重试时按新状态重新判断
+    await db_session.flush()
+    return schemas.VtTaskEventResponse(ok=True, results=results)
+
 # 健康检查接口
 @app.get("/healthz")
 async def healthz(
-    db_session: Session = Depends(get_db_session)
+    db_session: AsyncSession = Depends(get_async_db_session)
 ):
     return {"status": "ok"}
@@ -0,0 +1,37 @@
+from sqlalchemy import Column, Integer, String
+from basemodel import Base
+
+class VtUserTaskCount(Base):
+    """用户任务总数, 创建任务时增量更新, 避免/list_tasks每次COUNT(*)"""
+    __tablename__ = 'vt_user_task_count'
+
+    user_id = Column(String(64), primary_key=True)
+    task_num = Column(Integer, default=0, nullable=False)
+
+    def __repr__(self):
+        return f"<VtUserTaskCount(user_id={self.user_id}, task_num={self.task_num})>"
+
+
+class VtEngineTaskCount(Base):
+    """按(scanner_type, status)统计的任务数, 与任务状态变更在同一事务内更新"""
+    __tablename__ = 'vt_engine_task_count'
+
+    scanner_type = Column(String(32), primary_key=True)
+    status = Column(String(32), primary_key=True)
+    num = Column(Integer, default=0, nullable=False)
+
+    def __repr__(self):
+        return f"<VtEngineTaskCount(scanner_type={self.scanner_type}, status={self.status}, num={self.num})>"
+
+
+class VtScannerTaskCount(Base):
+    """按(scanner_id, status)统计的任务数, 与任务状态变更在同一事务内更新"""
+    __tablename__ = 'vt_scanner_task_count'
+
+    scanner_id = Column(Integer, primary_key=True)
+    status = Column(String(32), primary_key=True)
+    scanner_type = Column(String(32), nullable=False)
+    num = Column(Integer, default=0, nullable=False)
+
+    def __repr__(self):
+        return f"<VtScannerTaskCount(scanner_id={self.scanner_id}, status={self.status}, num={self.num})>"
@@ -1,13 +1,16 @@
 from sqlalchemy import Column, Integer, String, DateTime, Enum, LargeBinary, ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
-# from enum import Enum as PyEnum
+from enum import Enum as PyEnum
 from datetime import datetime, timezone
 from sqlalchemy.orm import relationship
 from basemodel import Base
+from scanner import enum_values
 
-class FileType(Enum):
+# 与扫描器的FileType一致, 报告类型取自生成报告的扫描器
+class FileType(str, PyEnum):
     HTML = 'html'
     PDF = 'pdf'
+    XML = 'xml'
 
 class VtReport(Base):
     __tablename__ = 'vt_report'
@@ -15,14 +18,14 @@ class VtReport(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
 
     filename = Column(String(255), nullable=False)
-    type = Column(Enum(FileType), default=FileType.HTML.value)
+    type = Column(Enum(FileType, values_callable=enum_values), default=FileType.HTML)
     content = Column(LargeBinary, nullable=True)
     size = Column(Integer, default=0)
-    create_time = Column(DateTime, default=datetime.now(timezone.utc))
+    create_time = Column(DateTime, default=lambda: datetime.now(timezone.utc))
 
     # Assuming there is a relationship with VtTask model
     task_id = Column(Integer, ForeignKey('vt_task.id'), nullable=True)
-    task = relationship("VtTask", back_populates="report")
+    task = relationship("VtTask", foreign_keys=[task_id])
 
     def __repr__(self):
         return f'<VtReport(filename={self.filename}, type={self.type})>'
@@ -1,20 +1,21 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Enum, Text, Table, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Enum, Text, Table, Boolean, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime, timezone
+from enum import Enum as PyEnum
 from basemodel import Base
-from scanner import ScannerEngine
+from scanner import ScannerEngine, enum_values
 
 # Assuming these are the translation of the Django model's verbose names to descriptions for SQLAlchemy
-# from enum import Enum as PyEnum
 
-class TaskType(Enum):
+class TaskType(str, PyEnum):
     WEB = 'web'
     HOST = 'host'
 
-class Status(Enum):
+class Status(str, PyEnum):
     QUEUED = 'Queued'
     RUNNING = 'Running'
+    REPORT_PENDING = 'ReportPending'  # 扫描已完成, 等待报告下载入库
     DONE = 'Done'
     FAILED = 'Failed'
 
@@ -33,14 +34,16 @@ class VtTask(Base):
     name = Column(String(255), nullable=False)
     priority = Column(Integer, default=2)
     target = Column(String(255), nullable=False)
-    type = Column(Enum(TaskType), nullable=False)
-    scanner_type = Column(Enum(ScannerEngine), default=ScannerEngine.OPENVAS, nullable=False)
-    task_status = Column(Enum(Status), default=Status.QUEUED.value)
+    type = Column(Enum(TaskType, values_callable=enum_values), nullable=False)
+    scanner_type = Column(Enum(ScannerEngine, values_callable=enum_values), default=ScannerEngine.OPENVAS, nullable=False)
+    # 新增REPORT_PENDING状态, 已存在的表需手动执行:
+    # ALTER TABLE vt_task MODIFY task_status ENUM('Queued','Running','ReportPending','Done','Failed');
+    task_status = Column(Enum(Status, values_callable=enum_values), default=Status.QUEUED)
     scanner_id = Column(String, ForeignKey('vt_scanner.id'), nullable=True)
     user_id = Column(String, nullable=True)
-    create_time = Column(DateTime, default=datetime.now(timezone.utc))
+    create_time = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     finish_time = Column(DateTime, nullable=True)
-    update_time = Column(DateTime, default=datetime.now(timezone.utc), onupdate=datetime.now(timezone.utc))
+    update_time = Column(DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
     errmsg = Column(String(255), default='')
     report_id = Column(String, ForeignKey('vt_report.id'), nullable=True)
     remark = Column(String(255), default='')
@@ -49,9 +52,22 @@ class VtTask(Base):
     # Relationships
     scanner = relationship("VtScanner", back_populates="tasks")
     # user = relationship("User", back_populates="tasks")
-    report = relationship("VtReport", back_populates="tasks")
+    # vt_task.report_id与vt_report.task_id互相引用, 需要指明各自使用的外键, report_id在报告插入后再更新
+    report = relationship("VtReport", foreign_keys=[report_id], post_update=True)
     except_num = Column(Integer, default=0)
     parallel = Column(Integer, default=1, nullable=True)
+    # 乐观锁版本号, 调度器批量更新时校验
+    # 已存在的表需手动执行: ALTER TABLE vt_task ADD COLUMN version INT NOT NULL DEFAULT 0;
+    version = Column(Integer, nullable=False, default=0, server_default='0')
+
+    # /list_tasks按(user_id, create_time DESC, id)做keyset分页, 该索引同时覆盖分页与计数查询
+    # 已存在的表需手动执行: CREATE INDEX idx_vt_task_user_create ON vt_task (user_id, create_time, id);
+    __table_args__ = (
+        Index('idx_vt_task_user_create', 'user_id', 'create_time', 'id'),
+    )
+    __mapper_args__ = {
+        'version_id_col': version
+    }
     
     def __repr__(self):
         return f"<VtTask(name={self.name}, target={self.target}, status={self.task_status})>"
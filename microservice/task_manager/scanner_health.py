@@ -0,0 +1,145 @@
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+# 扫描器健康度
+# 每个扫描器记录最近一段时间内状态查询/任务下发/探测调用的成败与耗时:
+# - 滑动窗口内的错误率, 各类调用的耗时分位数
+# - 连续失败达到阈值, 或样本足够且错误率超过阈值时隔离, 分发任务时直接跳过
+# - 隔离到期后由探测请求(/healthz)决定是否恢复, 探测失败则隔离时间加倍
+# 健康度只保存在任务调度进程内, 重启后从头统计
+
+healthWindow = float(os.getenv("HEALTH_WINDOW_SECONDS", "300"))
+healthMinSamples = int(os.getenv("HEALTH_MIN_SAMPLES", "4"))
+healthErrorRate = float(os.getenv("HEALTH_ERROR_RATE", "0.5"))
+healthLatencySamples = int(os.getenv("HEALTH_LATENCY_SAMPLES", "100"))
+# 连续失败多少次后隔离
+quarantineFailures = int(os.getenv("QUARANTINE_FAILURES", "2"))
+# 第n次隔离的时长为min(max, base * 2^(n-1))秒
+quarantineBase = float(os.getenv("QUARANTINE_BASE_SECONDS", "30"))
+quarantineMax = float(os.getenv("QUARANTINE_MAX_SECONDS", "900"))
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))]
+
+class ScannerHealth:
+    """单个扫描器的健康度"""
+
+    def __init__(self):
+        # (时间戳, 是否成功)
+        self.outcomes: Deque[Tuple[float, bool]] = deque()
+        # 调用类型 -> 最近的耗时(秒)
+        self.latencies: Dict[str, Deque[float]] = {}
+        self.consecutive_failures = 0
+        # 连续隔离次数, 恢复后清零
+        self.quarantine_level = 0
+        self.quarantined_until: Optional[float] = None
+
+    def trim(self, now: float):
+        while self.outcomes and self.outcomes[0][0] < now - healthWindow:
+            self.outcomes.popleft()
+
+    def error_rate(self, now: float) -> float:
+        self.trim(now)
+        if not self.outcomes:
+            return 0.0
+        return sum(1 for _, ok in self.outcomes if not ok) / len(self.outcomes)
+
+    def quarantined(self) -> bool:
+        return self.quarantined_until != None
+
+class HealthRegistry:
+    """所有扫描器的健康度, 线程安全(追踪、分发与报告下载worker在不同线程中记录)"""
+
+    def __init__(self):
+        self.scanners: Dict[int, ScannerHealth] = {}
+        self.lock = threading.Lock()
+
+    def get(self, scanner_id: int) -> ScannerHealth:
+        if scanner_id not in self.scanners:
+            self.scanners[scanner_id] = ScannerHealth()
+        return self.scanners[scanner_id]
+
+    def quarantine(self, health: ScannerHealth, now: float) -> float:
+        health.quarantine_level += 1
+        duration = min(quarantineMax, quarantineBase * (2 ** (health.quarantine_level - 1)))
+        health.quarantined_until = now + duration
+        return duration
+
+    def record(self, scanner_id: int, call: str, ok: bool, latency: float,
+               now: Optional[float] = None) -> Optional[float]:
+        """记录一次调用, 因此次调用被隔离时返回隔离时长(秒)
+
+        Keyword arguments:
+        call: 调用类型, status/create/probe
+        latency: 调用耗时(秒)
+        """
+        now = now if now != None else time.monotonic()
+        with self.lock:
+            health = self.get(scanner_id)
+            health.outcomes.append((now, ok))
+            health.latencies.setdefault(call, deque(maxlen=healthLatencySamples)).append(latency)
+            if ok:
+                health.consecutive_failures = 0
+                if call == 'probe' and health.quarantined():
+                    # 探测成功, 恢复分发; 清空窗口避免旧的失败立即再次触发隔离
+                    health.quarantined_until = None
+                    health.quarantine_level = 0
+                    health.outcomes.clear()
+                return None
+            health.consecutive_failures += 1
+            if health.quarantined():
+                # 隔离期间只有探测失败才延长隔离
+                if call == 'probe':
+                    return self.quarantine(health, now)
+                return None
+            health.trim(now)
+            if health.consecutive_failures >= quarantineFailures or \
+                (len(health.outcomes) >= healthMinSamples and health.error_rate(now) >= healthErrorRate):
+                return self.quarantine(health, now)
+            return None
+
+    def is_quarantined(self, scanner_id: int) -> bool:
+        with self.lock:
+            health = self.scanners.get(scanner_id)
+            return health != None and health.quarantined()
+
+    def due_probes(self, now: Optional[float] = None) -> List[int]:
+        """隔离到期, 需要探测的扫描器"""
+        now = now if now != None else time.monotonic()
+        with self.lock:
+            return [scanner_id for scanner_id, health in self.scanners.items()
+                    if health.quarantined() and health.quarantined_until <= now]
+
+    def forget(self, scanner_ids: List[int]):
+        """删除已不存在的扫描器"""
+        with self.lock:
+            for scanner_id in scanner_ids:
+                self.scanners.pop(scanner_id, None)
+
+    def snapshot(self, scanner_id: int, now: Optional[float] = None) -> dict:
+        """扫描器的健康度摘要, 用于日志"""
+        now = now if now != None else time.monotonic()
+        with self.lock:
+            health = self.get(scanner_id)
+            latency = {}
+            for call, values in health.latencies.items():
+                values = list(values)
+                latency[call] = {'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95),
+                                 'p99': percentile(values, 0.99)}
+            return {
+                'error_rate': round(health.error_rate(now), 3),
+                'samples': len(health.outcomes),
+                'consecutive_failures': health.consecutive_failures,
+                'quarantined_for': None if not health.quarantined() else round(health.quarantined_until - now, 1),
+                'latency': latency,
+            }
+
+# 任务调度进程内共用
+scanner_health = HealthRegistry()
@@ -1,5 +1,7 @@
-from copy import deepcopy
-from typing import Dict, List
+import queue
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional
 from apscheduler.schedulers.blocking import BlockingScheduler
 import logging
 import structlog
@@ -7,10 +9,15 @@ from datetime import datetime
 from ..model import task as Task, report as Report, scanner as Scanner
 import os
 from ..tidb_sql import get_db_session
+from ..task_counter import rebuild_task_counters
+from ..task_transition import TaskTransitionBatch
+from ..alert_report import render_alert_stream, IncompleteReport
+from ..http_client import http_client, none_on_unavailable, httpConnectTimeout
+from ..scanner_health import scanner_health
 import requests
-from sqlalchemy import Enum, Row, Tuple, and_, func
+from sqlalchemy import Enum, Row, Tuple, and_, desc, func
 from sqlalchemy.orm import Session
-from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
+from tenacity import retry, stop_after_attempt, wait_fixed, wait_exponential, retry_if_exception_type, retry_if_result
 # from kubernetes import client as k8s_client
 
 # 设置结构化日志
@@ -24,25 +31,51 @@ logger = structlog.wrap_logger(logging.getLogger())
 resourceControllerHost = os.getenv("RESOURCE_CONTROLLER_HOST", "localhost")
 resourceControllerPort = os.getenv("RESOURCE_CONTROLLER_PORT", "4000")
 resourceControllerUrl = f"http://{resourceControllerHost}:{resourceControllerPort}"
+# 报告下载相关配置
+reportQueueSize = int(os.getenv("REPORT_QUEUE_SIZE", "100"))
+reportWorkerNum = int(os.getenv("REPORT_WORKER_NUM", "4"))
+reportRetryNum = int(os.getenv("REPORT_RETRY_NUM", "5"))
+# 扫描器生成报告较慢, 报告下载单独设置读超时(秒)
+reportReadTimeout = float(os.getenv("REPORT_READ_TIMEOUT", "300"))
+# 任务状态由扫描器推送到/task_events, 轮询追踪作为兜底(秒)
+# 默认保持原有的60秒, 确认所有扫描器都已配置TASK_EVENT_TOKEN、推送生效后再调大;
+# 扫描器的事件经本地发件箱持久化、至少一次送达, 设置为0可关闭轮询
+traceInterval = int(os.getenv("TASK_TRACE_INTERVAL", "60"))
+# 检查REPORT_PENDING任务并入队下载的间隔(秒), 决定任务完成到报告入库的延迟
+reportPendingInterval = int(os.getenv("REPORT_PENDING_INTERVAL", "5"))
+distributeInterval = int(os.getenv("DISTRIBUTE_INTERVAL", "60"))
+
+# 报告下载队列, 追踪只负责入队, 由下载worker异步下载入库
+report_queue: "queue.Queue[int]" = queue.Queue(maxsize=reportQueueSize)
+# 已入队或下载中的任务, 防止同一任务被重复入队
+report_inflight = set()
+report_inflight_lock = threading.Lock()
 
 def get_running_tasks(db_session: Session):
     return db_session.query(Task.VtTask).filter(Task.VtTask.task_status == Task.Status.RUNNING).all()
 
+def get_orphan_running_tasks(db_session: Session):
+    """scanner已删除的运行中任务, 不会再有事件推送"""
+    return db_session.query(Task.VtTask).join(Scanner.VtScanner, Task.VtTask.scanner_id == Scanner.VtScanner.id).filter(
+                            Task.VtTask.task_status == Task.Status.RUNNING,
+                            Scanner.VtScanner.status == Scanner.Status.DELETED
+                            ).all()
+
+def get_report_pending_tasks(db_session: Session):
+    return db_session.query(Task.VtTask).filter(Task.VtTask.task_status == Task.Status.REPORT_PENDING).all()
+
 def handle_retry_error(retry_state):
     logger.error(f"All retries failed with exception: {retry_state.outcome.exception()}")
 
+def handle_report_retry_error(retry_state):
+    logger.error(f"Download report failed after {retry_state.attempt_number} attempts")
+
 class InternStatus(Enum):
         ERROR = 'Error'
         RUNNING = 'Running'
         DONE = 'Done'
         FAILED = 'Failed'
 
-@retry(
-    stop=stop_after_attempt(5),
-    wait=wait_fixed(3),
-    retry=(retry_if_exception_type(requests.exceptions.Timeout) | retry_if_exception_type(requests.exceptions.ConnectionError)),
-    retry_error_callback=handle_retry_error
-)
 def fetch_status(url, task_id):
     """
         reponse:
@@ -52,9 +85,11 @@ def fetch_status(url, task_id):
             status: 任务状态, Running / Done / Failed / Error
         }
     """
-    response = requests.get(
+    # 状态查询是幂等的, 扫描器响应慢时发起对冲请求
+    response = http_client.get(
         url + '/get_task',
         params={'task_id': task_id},
+        hedge=True,
     )
     response.raise_for_status()
     data = response.json()
@@ -66,12 +101,6 @@ def fetch_status(url, task_id):
     status = data['status']
     return status, msg
 
-@retry(
-    stop=stop_after_attempt(5),
-    wait=wait_fixed(3),
-    retry=(retry_if_exception_type(requests.exceptions.Timeout) | retry_if_exception_type(requests.exceptions.ConnectionError)),
-    retry_error_callback=handle_retry_error
-)
 def fetch_report(url, task_id):
     """
         reponse:
@@ -81,9 +110,10 @@ def fetch_report(url, task_id):
             content: 文件内容
         }
     """
-    response = requests.get(
+    response = http_client.get(
         url + '/get_report',
         params={'task_id': task_id},
+        timeout=(httpConnectTimeout, reportReadTimeout),
     )
     response.raise_for_status()
     data = response.json()
@@ -94,6 +124,29 @@ def fetch_report(url, task_id):
     # content = base64.b64decode(content)
     return content
 
+def fetch_report_stream(url, task_id):
+    """
+        以NDJSON流式获取告警并在本地生成html报告, 扫描器不支持流式导出时回退到fetch_report
+        reponse:
+        {"kind": "meta", ...}
+        {"kind": "alert", ...}
+        {"kind": "end", "count": n}
+    """
+    with http_client.get(url + '/get_report_stream', params={'task_id': task_id}, stream=True,
+                         timeout=(httpConnectTimeout, reportReadTimeout)) as response:
+        if response.status_code == 404:
+            return fetch_report(url, task_id)
+        response.raise_for_status()
+        if not response.headers.get('content-type', '').startswith('application/x-ndjson'):
+            data = response.json()
+            logger.error(f"Get report stream from scanner {url} failed, {data.get('errmsg')}")
+            return None
+        try:
+            return render_alert_stream(response.iter_lines())
+        except IncompleteReport as e:
+            logger.error(f"Get report stream from scanner {url} failed, {e}")
+            return None
+
 def reload_task(task:Task.VtTask):
     logger.info(f"Reloading task {task.id}")
     task.running_id = None
@@ -102,21 +155,38 @@ def reload_task(task:Task.VtTask):
     task.task_status = Task.Status.QUEUED
     task.except_num = 0
 
-def download_report(task:Task.VtTask):
-    logger.info(f"Downloading task {task.id}")
-    ipaddr = task.scanner.ipaddr
-    port = task.scanner.port
-    task_id = task.task_id
-    url = f"http://{ipaddr}:{port}"
+class ReportSource(NamedTuple):
+    """下载报告所需的任务与扫描器信息, 与数据库会话无关, 下载期间不占用会话"""
+    task_id: int
+    task_name: str
+    scanner_id: int
+    ipaddr: str
+    port: str
+    engine: Scanner.ScannerEngine
+    filetype: Scanner.FileType
+
+def get_report_source(task:Task.VtTask) -> ReportSource:
+    return ReportSource(task_id=task.id, task_name=task.name, scanner_id=task.scanner.id,
+                        ipaddr=task.scanner.ipaddr, port=task.scanner.port,
+                        engine=task.scanner.engine, filetype=task.scanner.filetype)
+
+def download_report(source:ReportSource) -> Optional[bytes]:
+    logger.info(f"Downloading task {source.task_id}")
+    url = f"http://{source.ipaddr}:{source.port}"
     content = None
     try:
-        content = fetch_report(url, task_id)
+        # ZAP扫描器流式导出告警, 报告在本地生成
+        if source.engine == Scanner.ScannerEngine.ZAP:
+            content = fetch_report_stream(url, source.task_id)
+        else:
+            content = fetch_report(url, source.task_id)
     except Exception as e:
         logger.error(f"fetch report error: {e}")
-    if content == None:
-        return None
+    return content
+
+def build_report(task:Task.VtTask, content: bytes) -> Report.VtReport:
     time = datetime.now().strftime("%Y%m%d%H%M%S")
-    typeF = task.scanner.filename
+    typeF = task.scanner.filetype
     filename = task.name+'_'+time+typeF
     size = len(content)
     new_report = Report.VtReport(
@@ -125,92 +195,205 @@ def download_report(task:Task.VtTask):
                         )
     return new_report    
 
-def trace_task(dbsession: Session, task:Task.VtTask, update_scanner_dict: dict):
+# 重新排队时需要重置的字段
+RELOAD_FIELDS = {
+    'task_status': Task.Status.QUEUED,
+    'scanner_id': None,
+    'except_num': 0,
+}
+
+def trace_task(task:Task.VtTask, batch: TaskTransitionBatch):
+    """追踪单个任务, 状态变更只记录到batch中, 由trace_tasks统一批量写入"""
     logger.info(f"Tracing task {task.id}")
     ipaddr = task.scanner.ipaddr
     port = task.scanner.port
-    task_id = task.task_id
     url = f"http://{ipaddr}:{port}"
     status  = None
+    msg = None
+    start = time.monotonic()
     try:
-        status, msg = fetch_status(url, task_id)
+        status, msg = fetch_status(url, task.id)
     except Exception as e:
         logger.error(f"fetch status error: {e}")
+    record_scanner_call(task.scanner, 'status', status != None and status != InternStatus.ERROR,
+                        time.monotonic() - start)
     # 统计scanner/task失败次数，达到5次则直接reload
-    old_scanner = deepcopy(task.scanner)
-    old_task = deepcopy(task)
+    scanner_except_num = batch.scanner_except_num(task.scanner)
     if status == None:
-        task.except_num += 1
-        task.scanner.except_num += 1
-        if task.except_num == 5:
-            reload_task(task)
-    if status == InternStatus.ERROR:
-        task.scanner.except_num += 1
-        reload_task(task)
-    if status == InternStatus.FAILED:
-        task.task_status = Task.Status.FAILED
-        task.except_num = 0
-        task.errmsg = msg
-    if status == InternStatus.DONE:
-        report = download_report(task)
-        if report == None:
-            task.except_num += 1
-            task.scanner.except_num += 1
-            if task.except_num == 5:
-                reload_task(task)
-        task.scanner.except_num = 0
-        task.except_num = 0
-        task.report = report
-        task.finish_time = datetime.now()
-        task.task_status = Task.Status.DONE
-        dbsession.add(report)
-        # dbsession.flush()
-        # task.report_id = report.id
-    if status == InternStatus.RUNNING:
-        task.scanner.except_num = 0
-        task.except_num = 0
-    # 判断scanner是否需要更新
-    if old_scanner.except_num != task.scanner.except_num:
-        update_scanner_dict[task.scanner.id] = task.scanner.except_num
-        dbsession.add(task.scanner)
-    # 判断task是否需要更新
-    if old_task.except_num != task.except_num or \
-        old_task.task_status != task.task_status:
-            dbsession.add(task)
+        batch.set_scanner_except_num(task.scanner, scanner_except_num + 1)
+        if task.except_num + 1 >= 5:
+            batch.transit(task, **RELOAD_FIELDS)
+        else:
+            batch.transit(task, except_num=task.except_num + 1)
+    elif status == InternStatus.ERROR:
+        batch.set_scanner_except_num(task.scanner, scanner_except_num + 1)
+        batch.transit(task, **RELOAD_FIELDS)
+    elif status == InternStatus.FAILED:
+        batch.transit(task, task_status=Task.Status.FAILED, except_num=0, errmsg=msg)
+    elif status == InternStatus.DONE:
+        # 报告下载交给下载队列处理, 避免单个大报告阻塞其他任务的追踪
+        batch.set_scanner_except_num(task.scanner, 0)
+        batch.transit(task, task_status=Task.Status.REPORT_PENDING, except_num=0)
+    elif status == InternStatus.RUNNING:
+        batch.set_scanner_except_num(task.scanner, 0)
+        if task.except_num != 0:
+            batch.transit(task, except_num=0)
+
+def reload_orphan_tasks():
+    """重新排队scanner已删除的运行中任务, 不依赖轮询追踪"""
+    try:
+        with get_db_session() as db_session:
+            batch = TaskTransitionBatch()
+            for orphan_task in get_orphan_running_tasks(db_session=db_session):
+                batch.transit(orphan_task, **RELOAD_FIELDS)
+            batch.apply(db_session)
+    except Exception as e:
+        logger.error(f"Reload orphan tasks error: {e}")
 
 def trace_tasks():
+    """轮询所有运行中的任务, 兜底处理扫描器推送丢失或扫描器无响应的情况"""
     logger.info("Tracing tasks")
+    report_pending_ids: List[int] = []
     try:
         with get_db_session() as db_session:
-            update_scanner_dict = {}
+            batch = TaskTransitionBatch()
             running_tasks = get_running_tasks(db_session=db_session)
             for running_task in running_tasks:
                 if running_task.scanner.status == Scanner.Status.DELETED:
-                    reload_task(running_task)
-                    db_session.add(running_task)
+                    batch.transit(running_task, **RELOAD_FIELDS)
                     continue
-                trace_task(db_session, running_task, update_scanner_dict)
+                trace_task(running_task, batch)
+            applied = batch.apply(db_session)
+            for running_task in running_tasks:
+                if running_task.id in applied and \
+                    batch.task_status(running_task) == Task.Status.REPORT_PENDING:
+                    report_pending_ids.append(running_task.id)
             # 目前两个scanner表共用
-            # if update_scanner_dict:
+            # if batch.scanner_excepts:
             #     try:
-            #         post_resource_scanners(update_scanner_dict)    
+            #         post_resource_scanners(batch.scanner_excepts)    
             #     except Exception as e:
             #         logger.error(f"post resource scanners error: {e}")
     except Exception as e:
         logger.error(f"Trace tasks error: {e}")
+        return
+    # 提交后再入队, 保证worker读到的是REPORT_PENDING状态
+    for task_id in report_pending_ids:
+        enqueue_report_task(task_id)
+
+def enqueue_report_pending_tasks():
+    """将REPORT_PENDING的任务入队下载
+    包括扫描器推送完成事件的任务, 以及之前入队失败(队列满/重启)的任务,
+    scanner已删除的则报告无法获取, 重新排队
+    """
+    report_pending_ids: List[int] = []
+    try:
+        with get_db_session() as db_session:
+            batch = TaskTransitionBatch()
+            pending_tasks = get_report_pending_tasks(db_session=db_session)
+            for pending_task in pending_tasks:
+                if pending_task.scanner.status == Scanner.Status.DELETED:
+                    batch.transit(pending_task, **RELOAD_FIELDS)
+                    continue
+                report_pending_ids.append(pending_task.id)
+            batch.apply(db_session)
+    except Exception as e:
+        logger.error(f"Enqueue report pending tasks error: {e}")
+        return
+    for task_id in report_pending_ids:
+        enqueue_report_task(task_id)
+
+def enqueue_report_task(task_id: int) -> bool:
+    """将任务放入报告下载队列, 队列已满时留待下一轮追踪再入队"""
+    with report_inflight_lock:
+        if task_id in report_inflight:
+            return True
+        try:
+            report_queue.put_nowait(task_id)
+        except queue.Full:
+            logger.warn(f"Report queue full, task {task_id} will be retried next tick")
+            return False
+        report_inflight.add(task_id)
+    return True
+
+@retry(
+    stop=stop_after_attempt(reportRetryNum),
+    wait=wait_exponential(multiplier=2, min=2, max=60),
+    retry=retry_if_result(lambda report: report is None),
+    retry_error_callback=handle_report_retry_error
+)
+def download_report_with_backoff(source:ReportSource):
+    return download_report(source)
+
+def get_report_pending_task(db_session: Session, task_id: int, scanner_id: Optional[int] = None):
+    """返回仍处于REPORT_PENDING的任务, 指定scanner_id时还要求任务仍在该扫描器上"""
+    task = db_session.query(Task.VtTask).filter(Task.VtTask.id == task_id).first()
+    if task == None or task.task_status != Task.Status.REPORT_PENDING:
+        return None
+    if scanner_id != None and task.scanner_id != None and int(task.scanner_id) != scanner_id:
+        return None
+    return task
+
+def store_task_report(task_id: int):
+    """下载并保存任务报告, 成功后任务状态由REPORT_PENDING转为DONE
+
+    下载可能重试数分钟, 期间不持有数据库会话: 先读出下载所需信息, 下载完成后
+    再开启短事务, 复核任务仍处于REPORT_PENDING后写入
+    """
+    with get_db_session() as db_session:
+        task = get_report_pending_task(db_session, task_id)
+        if task == None or task.scanner == None:
+            return
+        source = get_report_source(task)
+    content = download_report_with_backoff(source)
+    with get_db_session() as db_session:
+        # 下载期间任务可能已被其他worker完成或重新排队
+        task = get_report_pending_task(db_session, task_id, source.scanner_id)
+        if task == None:
+            logger.info(f"Task {task_id} left REPORT_PENDING while downloading, discard report")
+            return
+        if content == None:
+            # 下一轮追踪会重新入队, 多次失败则重新排队扫描
+            task.except_num += 1
+            task.scanner.except_num += 1
+            if task.except_num >= 5:
+                reload_task(task)
+            db_session.add(task.scanner)
+            db_session.add(task)
+            return
+        report = build_report(task, content)
+        task.scanner.except_num = 0
+        task.except_num = 0
+        task.report = report
+        task.finish_time = datetime.now()
+        task.task_status = Task.Status.DONE
+        db_session.add(report)
+        db_session.add(task)
+
+def report_worker():
+    while True:
+        task_id = report_queue.get()
+        try:
+            store_task_report(task_id)
+        except Exception as e:
+            logger.error(f"Store report of task {task_id} error: {e}")
+        finally:
+            with report_inflight_lock:
+                report_inflight.discard(task_id)
+            report_queue.task_done()
+
+def start_report_workers():
+    for i in range(reportWorkerNum):
+        worker = threading.Thread(target=report_worker, name=f"report-worker-{i}", daemon=True)
+        worker.start()
 
 def get_queued_tasks(db_session: Session, scan_engine: str, num: int):
     return db_session.query(Task.VtTask).filter(
-                            Task.VtTask.task_status == Task.Status.RUNNING, 
+                            Task.VtTask.task_status == Task.Status.QUEUED, 
                             Task.VtTask.scanner_type == scan_engine
-                            ).order_by('-priority', 'create_time').limit(num).all()
+                            ).order_by(desc(Task.VtTask.priority), Task.VtTask.create_time).limit(num).all()
 
-@retry(
-    stop=stop_after_attempt(5),
-    wait=wait_fixed(3),
-    retry=(retry_if_exception_type(requests.exceptions.Timeout) | retry_if_exception_type(requests.exceptions.ConnectionError)),
-    retry_error_callback=handle_retry_error
-)
+@none_on_unavailable
 def fetch_scanner_resource():
     """
         reponse:
@@ -223,7 +406,7 @@ def fetch_scanner_resource():
             errmsg: 错误原因
         }
     """
-    response = requests.get(
+    response = http_client.get(
         resourceControllerUrl + '/list_scanner_resource',
     )
     response.raise_for_status()
@@ -235,12 +418,7 @@ def fetch_scanner_resource():
     count = data['count']
     return count, scanners 
 
-@retry(
-    stop=stop_after_attempt(5),
-    wait=wait_fixed(3),
-    retry=(retry_if_exception_type(requests.exceptions.Timeout) | retry_if_exception_type(requests.exceptions.ConnectionError)),
-    retry_error_callback=handle_retry_error
-)
+@none_on_unavailable
 def post_resource_scanners(scanner_dict: Dict[int, int]):
     """
         更新资源管理模块的scanner, 主要是except_num
@@ -250,7 +428,7 @@ def post_resource_scanners(scanner_dict: Dict[int, int]):
             errmsg: 错误原因
         }
     """
-    response = requests.post(
+    response = http_client.post(
         resourceControllerUrl + '/update_resource_scanner',
         json=scanner_dict
     )
@@ -261,12 +439,6 @@ def post_resource_scanners(scanner_dict: Dict[int, int]):
         return False
     return True
 
-@retry(
-    stop=stop_after_attempt(5),
-    wait=wait_fixed(3),
-    retry=(retry_if_exception_type(requests.exceptions.Timeout) | retry_if_exception_type(requests.exceptions.ConnectionError)),
-    retry_error_callback=handle_retry_error
-)
 def post_task(scanner_url, target, task_id):
     """
         reponse:
@@ -275,7 +447,7 @@ def post_task(scanner_url, target, task_id):
             errmsg: 错误原因
         }
     """
-    response = requests.post(
+    response = http_client.post(
         scanner_url + '/create_task',
         params={'target': target, 'task_id': task_id}
     )
@@ -286,24 +458,56 @@ def post_task(scanner_url, target, task_id):
         logger.error(f"Create task {scanner_url} failed, {data['errmsg']}")
     return ok
 
-def distribute_task(scanner:Scanner.VtScanner, task:Task.VtTask):
-    scanner_url = f'http://{scanner['ipaddr']}:{scanner['port']}'
+def record_scanner_call(scanner: Scanner.VtScanner, call: str, ok: bool, latency: float):
+    """记录扫描器调用的成败与耗时, 被隔离时记录日志"""
+    duration = scanner_health.record(scanner.id, call, ok, latency)
+    if duration != None:
+        logger.warn(f"scanner {scanner.name} quarantined for {duration}s, health {scanner_health.snapshot(scanner.id)}")
+
+def probe_quarantined_scanners():
+    """探测隔离到期的扫描器, 成功则恢复分发, 失败则隔离时间加倍"""
+    probe_ids = scanner_health.due_probes()
+    if not probe_ids:
+        return
+    try:
+        with get_db_session() as db_session:
+            scanners = db_session.query(Scanner.VtScanner).filter(Scanner.VtScanner.id.in_(probe_ids)).all()
+            scanner_dict = {scanner.id: scanner for scanner in scanners if scanner.status != Scanner.Status.DELETED}
+            db_session.expunge_all()
+    except Exception as e:
+        logger.error(f"Probe scanners error: {e}")
+        return
+    scanner_health.forget([scanner_id for scanner_id in probe_ids if scanner_id not in scanner_dict])
+    for scanner in scanner_dict.values():
+        start = time.monotonic()
+        ok = False
+        try:
+            response = http_client.get(f"http://{scanner.ipaddr}:{scanner.port}/healthz", retry_num=0)
+            ok = response.status_code == 200
+        except Exception as e:
+            logger.error(f"probe scanner {scanner.name} error: {e}")
+        record_scanner_call(scanner, 'probe', ok, time.monotonic() - start)
+        if ok:
+            logger.info(f"scanner {scanner.name} recovered from quarantine")
+
+def distribute_task(scanner:Scanner.VtScanner, task:Task.VtTask, batch: TaskTransitionBatch):
+    scanner_url = f"http://{scanner.ipaddr}:{scanner.port}"
     ok = False
+    start = time.monotonic()
     try:
         ok = post_task(scanner_url, task.target, task.id)
     except Exception as e:
         logger.error(f"post task error: {e}")
+    record_scanner_call(scanner, 'create', ok, time.monotonic() - start)
     if not ok:
-        scanner.except_num += 1
+        batch.set_scanner_except_num(scanner, batch.scanner_except_num(scanner) + 1)
         return False
-    scanner.except_num = 0
-    task.scanner = scanner
-    task.scanner_id = scanner.id
-    task.task_status = Task.Status.RUNNING
+    batch.set_scanner_except_num(scanner, 0)
+    batch.transit(task, task_status=Task.Status.RUNNING, scanner_id=scanner.id)
     return True
 
 def get_scanners(db_session: Session) -> List[Scanner.VtScanner]:
-    return db_session.query(Scanner.VtScanner).filter(Scanner.Status.ENABLE).all()
+    return db_session.query(Scanner.VtScanner).filter(Scanner.VtScanner.status == Scanner.Status.ENABLE).all()
 
 def get_task_scanners(db_session: Session) -> List[Row[Tuple[int, int, int]]]:
     # 查询每个 scanner 及其可以并发执行的任务数与已分配的 running 状态任务数
@@ -312,21 +516,17 @@ def get_task_scanners(db_session: Session) -> List[Row[Tuple[int, int, int]]]:
             Scanner.VtScanner.id,
             Scanner.VtScanner.engine,
             Scanner.VtScanner.max_concurrency,
-            func.count(Task.id).label('running_tasks')  # 计算已分配且状态为 running 的任务数量
+            func.count(Task.VtTask.id).label('running_tasks')  # 计算已分配且状态为 running 的任务数量
         )
         .outerjoin(
             Task.VtTask, 
             and_(Task.VtTask.scanner_id == Scanner.VtScanner.id, Task.VtTask.task_status == Task.Status.RUNNING)  # 左外连接并过滤 running 状态的任务
         )
+        .filter(Scanner.VtScanner.status == Scanner.Status.ENABLE)
         .group_by(Scanner.VtScanner.id)  # 按照 scanner 分组
     )
     return query.all()
 
-def check_scanner_diff(old_scanner, new_scanner):
-    if old_scanner.except_num != new_scanner.except_num:
-        return True
-    return False
-
 def distribute_tasks():
     logger.info("Distributing tasks")
     # 从资源控制器获取资源来分发
@@ -341,27 +541,31 @@ def distribute_tasks():
     #     return
     try:
         with get_db_session() as db_session:
-            update_scanner_dict:Dict[int, int] = {}
-            scanners_available = get_task_scanners()
-            scanners:List[Scanner.VtScanner] = get_scanners()
+            batch = TaskTransitionBatch()
+            scanners_available = get_task_scanners(db_session=db_session)
+            scanners:List[Scanner.VtScanner] = get_scanners(db_session=db_session)
             scanner_dict:Dict[int, Scanner.VtScanner] = {}
             for scanner in scanners:
                 scanner_dict[scanner.id] = scanner
             # 统计不同类别的scanner还可以分配的task数量
+            # [可分配总数, [[scanner_id, 已运行数, 并发度]]]
             task_num_scanners = {}
             for scanner_id, engine, parallel, running in scanners_available:
-                if parallel == 0 or parallel == running:
+                if parallel == 0 or parallel <= running or scanner_id not in scanner_dict:
+                    continue
+                # 隔离中的扫描器直接跳过, 等待探测恢复
+                if scanner_health.is_quarantined(scanner_id):
                     continue
                 if engine in task_num_scanners:
                     task_num_scanners[engine][0] += parallel-running
-                    task_num_scanners[engine][1].append((scanner_id, parallel-running, parallel))
+                    task_num_scanners[engine][1].append([scanner_id, running, parallel])
                 else:
-                    task_num_scanners[engine] = [parallel-running, [(scanner_id, parallel-running, parallel)]]
+                    task_num_scanners[engine] = [parallel-running, [[scanner_id, running, parallel]]]
             # 获取各个engine的queued task
             for engine in task_num_scanners:
-                can_apply_task_num = task_num_scanners[engine] 
+                can_apply_task_num = task_num_scanners[engine][0]
                 wait_tasks = get_queued_tasks(db_session=db_session, scan_engine=engine, num=can_apply_task_num)
-                scanners_sorted:List[Tuple] = task_num_scanners[engine][1]
+                scanners_sorted:List[list] = task_num_scanners[engine][1]
                 # 按照使用率从低到高分发
                 index = 0
                 while index < len(wait_tasks):
@@ -373,24 +577,21 @@ def distribute_tasks():
                     )
                     scanner_chosed = scanners_sorted[0]
                     # 可能出现scanner故障，剩余scanner不够用
-                    if scanner_chosed[1] == scanner_chosed[2]:
+                    if scanner_chosed[1] >= scanner_chosed[2]:
                         break
                     scanner = scanner_dict[scanner_chosed[0]]
-                    old_scanner = deepcopy(scanner)
-                    ok = distribute_task(scanner, wait_task)
-                    if check_scanner_diff(old_scanner, scanner):
-                        update_scanner_dict[scanner.id] = scanner.except_num
-                        db_session.add(scanner)
+                    ok = distribute_task(scanner, wait_task, batch)
                     if ok:
                         scanners_sorted[0][1] += 1
                         index += 1
-                        db_session.add(wait_task)
                     else: # scanner存在问题先不分发
                         scanners_sorted.pop(0)
                         logger.warn(f"scanner {scanner.name} post task error, skip...")
-            # if update_scanner_dict:
+            # 本轮全部变更批量写入
+            batch.apply(db_session)
+            # if batch.scanner_excepts:
             #     try:
-            #         post_resource_scanners(update_scanner_dict)    
+            #         post_resource_scanners(batch.scanner_excepts)    
             #     except Exception as e:
             #         logger.error(f"post resource scanners error: {e}")                      
     except Exception as e:
@@ -399,18 +600,34 @@ def distribute_tasks():
 def task_schedule():
     # 周期性执行任务逻辑
     # 扫描任务表
-    # 1. 分发排队中的任务
-    # 2. 追踪运行中的任务
-    #   2.1. 任务完成后下载任务报告
-    #   2.2. 任务因扫描器宕机等原因执行失败则重新排队任务
+    # 1. 重新排队scanner已删除的运行中任务
+    # 2. 探测隔离到期的扫描器, 恢复的扫描器在本轮即可分发
+    # 3. 分发排队中的任务
+    # 任务状态由扫描器推送到task_api的/task_events, 其余由独立的定时任务处理:
+    # - enqueue_report_pending_tasks: 任务完成后进入REPORT_PENDING, 由下载worker异步下载任务报告
+    # - trace_tasks: 轮询运行中的任务兜底, 任务因扫描器宕机等原因执行失败则重新排队任务, 可关闭
     logger.info("Executing the task periodic task")
-    trace_tasks()
+    reload_orphan_tasks()
+    probe_quarantined_scanners()
     distribute_tasks()
     
 
 if __name__ == "__main__":
+    # 校正任务计数表, 之后由任务状态变更在同一事务内增量维护
+    try:
+        with get_db_session() as db_session:
+            rebuild_task_counters(db_session)
+    except Exception as e:
+        logger.error(f"Rebuild task counters error: {e}")
+    # 启动报告下载worker
+    start_report_workers()
     scheduler = BlockingScheduler()
-    scheduler.add_job(task_schedule, 'interval', seconds=60)  # 每60秒执行一次
+    scheduler.add_job(task_schedule, 'interval', seconds=distributeInterval)
+    scheduler.add_job(enqueue_report_pending_tasks, 'interval', seconds=reportPendingInterval)
+    if traceInterval > 0:
+        scheduler.add_job(trace_tasks, 'interval', seconds=traceInterval)
+    else:
+        logger.info("Task tracing disabled, task status only from scanner events")
     logger.info("Starting task scheduler...")
     try:
         scheduler.start()
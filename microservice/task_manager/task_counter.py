@@ -0,0 +1,133 @@
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects.mysql import insert
+from model import task as Task, counter as Counter
+
+# 任务计数表维护
+# 任务状态或所属scanner发生变化时, 在同一事务内增量更新计数表,
+# 供扩缩容相关接口直接按engine/scanner读取, 不再对vt_task做GROUP BY
+
+def _value(v):
+    return getattr(v, 'value', v)
+
+def _scanner_id(v) -> Optional[int]:
+    if v == None:
+        return None
+    return int(v)
+
+class TaskCountDelta:
+    """收集一批任务状态变更对计数表的增减量, 最后一次性写入"""
+
+    def __init__(self):
+        self.engine_deltas: Dict[Tuple[str, str], int] = defaultdict(int)
+        self.scanner_deltas: Dict[Tuple[int, str], int] = defaultdict(int)
+        self.scanner_types: Dict[int, str] = {}
+
+    def add(self, scanner_type, status, scanner_id, num: int):
+        scanner_type = _value(scanner_type)
+        status = _value(status)
+        scanner_id = _scanner_id(scanner_id)
+        if status == None:
+            return
+        self.engine_deltas[(scanner_type, status)] += num
+        if scanner_id != None:
+            self.scanner_deltas[(scanner_id, status)] += num
+            self.scanner_types[scanner_id] = scanner_type
+
+    def move(self, scanner_type, old_status, old_scanner_id, new_status, new_scanner_id):
+        """记录一次状态迁移: 旧(status, scanner)减一, 新(status, scanner)加一"""
+        if _value(old_status) == _value(new_status) and \
+            _scanner_id(old_scanner_id) == _scanner_id(new_scanner_id):
+            return
+        self.add(scanner_type, old_status, old_scanner_id, -1)
+        self.add(scanner_type, new_status, new_scanner_id, 1)
+
+    def apply(self, db_session: Session):
+        for (scanner_type, status), num in self.engine_deltas.items():
+            if num == 0:
+                continue
+            stmt = insert(Counter.VtEngineTaskCount).values(scanner_type=scanner_type, status=status, num=num)
+            db_session.execute(stmt.on_duplicate_key_update(num=Counter.VtEngineTaskCount.num + num))
+        for (scanner_id, status), num in self.scanner_deltas.items():
+            if num == 0:
+                continue
+            stmt = insert(Counter.VtScannerTaskCount).values(scanner_id=scanner_id, status=status, num=num,
+                                                             scanner_type=self.scanner_types[scanner_id])
+            db_session.execute(stmt.on_duplicate_key_update(num=Counter.VtScannerTaskCount.num + num))
+        self.engine_deltas.clear()
+        self.scanner_deltas.clear()
+
+def _history_old(state, key):
+    history = state.attrs[key].history
+    if history.deleted:
+        return history.deleted[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    return None
+
+def _history_new(state, key):
+    history = state.attrs[key].history
+    if history.added:
+        return history.added[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    return None
+
+@event.listens_for(Session, "before_flush")
+def track_task_count(db_session: Session, flush_context, instances):
+    """ORM方式修改任务时, 在flush前根据属性历史计算计数增减量"""
+    delta = TaskCountDelta()
+    for obj in db_session.new:
+        if isinstance(obj, Task.VtTask):
+            # 新建任务未显式设置状态时为默认的QUEUED
+            status = obj.task_status if obj.task_status != None else Task.Status.QUEUED
+            scanner_type = obj.scanner_type if obj.scanner_type != None else Task.ScannerEngine.OPENVAS
+            delta.add(scanner_type, status, obj.scanner_id, 1)
+    for obj in db_session.dirty:
+        if not isinstance(obj, Task.VtTask):
+            continue
+        state = inspect(obj)
+        if not state.attrs.task_status.history.has_changes() and \
+            not state.attrs.scanner_id.history.has_changes():
+            continue
+        delta.move(obj.scanner_type,
+                   _history_old(state, 'task_status'), _history_old(state, 'scanner_id'),
+                   _history_new(state, 'task_status'), _history_new(state, 'scanner_id'))
+    for obj in db_session.deleted:
+        if isinstance(obj, Task.VtTask):
+            delta.add(obj.scanner_type, obj.task_status, obj.scanner_id, -1)
+    delta.apply(db_session)
+
+def rebuild_task_counters(db_session: Session):
+    """根据vt_task校正计数表, 启动时执行一次
+
+    任务接口可能同时在增减计数, 因此不删除重建也不直接覆盖: 在同一事务(同一快照)内
+    读取实际计数与计数表, 两者之差即为漂移量, 再以num = num + 差值原子写入,
+    快照之后提交的并发增减不受影响
+    """
+    delta = TaskCountDelta()
+    engine_counts = (
+        db_session.query(Task.VtTask.scanner_type, Task.VtTask.task_status, func.count(Task.VtTask.id))
+        .group_by(Task.VtTask.scanner_type, Task.VtTask.task_status)
+        .all()
+    )
+    for scanner_type, status, num in engine_counts:
+        delta.engine_deltas[(_value(scanner_type), _value(status))] += num
+    for counter in db_session.query(Counter.VtEngineTaskCount).all():
+        delta.engine_deltas[(counter.scanner_type, counter.status)] -= counter.num
+    scanner_counts = (
+        db_session.query(Task.VtTask.scanner_id, Task.VtTask.task_status, Task.VtTask.scanner_type,
+                         func.count(Task.VtTask.id))
+        .filter(Task.VtTask.scanner_id != None)
+        .group_by(Task.VtTask.scanner_id, Task.VtTask.task_status, Task.VtTask.scanner_type)
+        .all()
+    )
+    for scanner_id, status, scanner_type, num in scanner_counts:
+        delta.scanner_deltas[(int(scanner_id), _value(status))] += num
+        delta.scanner_types[int(scanner_id)] = _value(scanner_type)
+    for counter in db_session.query(Counter.VtScannerTaskCount).all():
+        delta.scanner_deltas[(counter.scanner_id, counter.status)] -= counter.num
+        delta.scanner_types.setdefault(counter.scanner_id, counter.scanner_type)
+    delta.apply(db_session)
@@ -0,0 +1,139 @@
+from collections import defaultdict
+import logging
+import os
+from typing import Dict, List, Set, Tuple
+import structlog
+from sqlalchemy import update, select, bindparam
+from sqlalchemy.orm import Session
+from model import task as Task, scanner as Scanner
+from task_counter import TaskCountDelta
+
+logging.basicConfig(
+    level=logging.WARNING,
+    format='%(asctime)s %(levelname)s %(message)s',
+    datefmt='%Y-%m-%dT%H:%M:%S%z'
+)
+logger = structlog.wrap_logger(logging.getLogger())
+transitionChunkSize = int(os.getenv("TRANSITION_CHUNK_SIZE", "500"))
+
+def chunked(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+class TaskTransitionBatch:
+    """批量任务状态迁移
+
+    调度器在一轮中收集(task_id, new_status, fields), 不直接修改ORM对象,
+    最后按字段组合分组, 以executemany分块执行UPDATE.
+    任务通过version列做乐观锁检查, 被其他事务修改过的行跳过, 下一轮重新处理.
+    """
+
+    def __init__(self, chunk_size: int = transitionChunkSize):
+        self.chunk_size = chunk_size
+        # task_id -> 需要更新的字段
+        self.task_fields: Dict[int, dict] = {}
+        # task_id -> (version, scanner_type, task_status, scanner_id), 读取时的原值
+        self.task_origins: Dict[int, Tuple] = {}
+        # scanner_id -> except_num
+        self.scanner_origins: Dict[int, int] = {}
+        self.scanner_excepts: Dict[int, int] = {}
+
+    def transit(self, task: Task.VtTask, **fields):
+        """记录任务需要更新的字段, 同一任务多次调用时字段合并"""
+        if task.id not in self.task_origins:
+            self.task_origins[task.id] = (task.version, task.scanner_type, task.task_status, task.scanner_id)
+            self.task_fields[task.id] = {}
+        self.task_fields[task.id].update(fields)
+
+    def task_status(self, task: Task.VtTask):
+        """任务在本批次中的最新状态"""
+        return self.task_fields.get(task.id, {}).get('task_status', task.task_status)
+
+    def scanner_except_num(self, scanner: Scanner.VtScanner) -> int:
+        return self.scanner_excepts.get(scanner.id, scanner.except_num)
+
+    def set_scanner_except_num(self, scanner: Scanner.VtScanner, except_num: int):
+        if scanner.id not in self.scanner_origins:
+            self.scanner_origins[scanner.id] = scanner.except_num
+        self.scanner_excepts[scanner.id] = except_num
+
+    def apply(self, db_session: Session) -> Set[int]:
+        """执行全部更新, 返回实际更新成功的任务id"""
+        applied = self._apply_tasks(db_session)
+        self._apply_scanners(db_session)
+        return applied
+
+    def _apply_tasks(self, db_session: Session) -> Set[int]:
+        table = Task.VtTask.__table__
+        # executemany要求参数结构一致, 按更新的字段组合分组
+        groups: Dict[Tuple[str, ...], List[dict]] = defaultdict(list)
+        for task_id, fields in self.task_fields.items():
+            if not fields:
+                continue
+            params = {'b_id': task_id, 'b_version': self.task_origins[task_id][0]}
+            for key, value in fields.items():
+                params[f'b_{key}'] = value
+            groups[tuple(sorted(fields))].append(params)
+        applied: Set[int] = set()
+        for keys, params_list in groups.items():
+            values = {key: bindparam(f'b_{key}') for key in keys}
+            values['version'] = table.c.version + 1
+            stmt = (
+                update(table)
+                .where(table.c.id == bindparam('b_id'))
+                .where(table.c.version == bindparam('b_version'))
+                .values(values)
+            )
+            for chunk in chunked(params_list, self.chunk_size):
+                result = db_session.execute(stmt, chunk)
+                if result.rowcount == len(chunk):
+                    applied.update(params['b_id'] for params in chunk)
+                else:
+                    applied.update(self._check_applied(db_session, chunk))
+        self._apply_counters(db_session, applied)
+        return applied
+
+    def _check_applied(self, db_session: Session, chunk: List[dict]) -> Set[int]:
+        # 影响行数不一致时, 逐行比对version确定哪些行更新成功
+        table = Task.VtTask.__table__
+        expected = {params['b_id']: params['b_version'] + 1 for params in chunk}
+        rows = db_session.execute(
+            select(table.c.id, table.c.version).where(table.c.id.in_(list(expected.keys())))
+        ).all()
+        applied = set()
+        for task_id, version in rows:
+            if version == expected[task_id]:
+                applied.add(task_id)
+        for task_id in expected:
+            if task_id not in applied:
+                logger.warn(f"Task {task_id} modified concurrently, transition skipped")
+        return applied
+
+    def _apply_counters(self, db_session: Session, applied: Set[int]):
+        # Core UPDATE不会触发ORM的flush事件, 计数表在这里同事务更新
+        delta = TaskCountDelta()
+        for task_id in applied:
+            fields = self.task_fields[task_id]
+            if 'task_status' not in fields and 'scanner_id' not in fields:
+                continue
+            _, scanner_type, old_status, old_scanner_id = self.task_origins[task_id]
+            delta.move(scanner_type, old_status, old_scanner_id,
+                       fields.get('task_status', old_status), fields.get('scanner_id', old_scanner_id))
+        delta.apply(db_session)
+
+    def _apply_scanners(self, db_session: Session):
+        table = Scanner.VtScanner.__table__
+        params_list = [
+            {'b_id': scanner_id, 'b_except_num': except_num}
+            for scanner_id, except_num in self.scanner_excepts.items()
+            if except_num != self.scanner_origins[scanner_id]
+        ]
+        if not params_list:
+            return
+        stmt = (
+            update(table)
+            .where(table.c.id == bindparam('b_id'))
+            .values(except_num=bindparam('b_except_num'))
+        )
+        for chunk in chunked(params_list, self.chunk_size):
+            db_session.execute(stmt, chunk)
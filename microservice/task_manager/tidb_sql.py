@@ -7,14 +7,14 @@ import os
 from model.basemodel import Base
 
 # 获取环境变量或设置默认值
-def get_db_url():
+def get_db_url(driver: str = "pymysql"):
     # 从环境变量中获取数据库配置
     db_user = os.getenv("DB_USER", "root")
     db_password = os.getenv("DB_PASSWORD", "")
     db_host = os.getenv("DB_HOST", "localhost")
     db_port = os.getenv("DB_PORT", "4000")
     db_name = os.getenv("DB_NAME", "test")
-    return f"mysql+pymysql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
+    return f"mysql+{driver}://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
 
 # 创建数据库引擎
 engine = create_engine(get_db_url(), pool_recycle=3600)
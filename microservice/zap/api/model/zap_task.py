@@ -2,20 +2,20 @@ from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Enum, Text
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime, timezone
-from basemodel import Base
+from enum import Enum as PyEnum
+from model.basemodel import Base
 
 # Assuming these are the translation of the Django model's verbose names to descriptions for SQLAlchemy
-# from enum import Enum as PyEnum
 
 
-class TaskStatus(Enum):
+class TaskStatus(str, PyEnum):
     RUNNING = 'Running'
     DONE = 'Done'
     FAILED = 'Failed'
     ERROR = 'Error'
 
 
-class InternStatus(Enum):
+class InternStatus(str, PyEnum):
     SPIDER = 'spider'
     AJAXSPIDER = 'ajaxspider'
     ACTIVE = 'active'
@@ -29,13 +29,20 @@ class VtZapTask(Base):
 
     id = Column(Integer, primary_key=True)
     target = Column(String(256), nullable=False)
-    status = Column(Enum(TaskStatus), default=TaskStatus.RUNNING)
-    create_time = Column(DateTime, default=datetime.now(timezone.utc))
+    status = Column(Enum(TaskStatus), default=TaskStatus.RUNNING, index=True)
+    create_time = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     finish_time = Column(DateTime, nullable=True)
-    update_time = Column(DateTime, default=datetime.now(timezone.utc), onupdate=datetime.now(timezone.utc))
+    update_time = Column(DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
     running_status = Column(Enum(InternStatus), nullable=False, default=InternStatus.SPIDER)
+    # 当前阶段的扫描id: 传统爬虫/主动扫描的scanId, ajax爬虫阶段为空
     running_id = Column(String(256), nullable=True)
+    # 任务对应的ZAP context, 多个任务在同一个ZAP session中互不影响
+    context_id = Column(String(64), nullable=True)
     errmsg = Column(String(256), nullable=True)
-    
+    # 阶段预算模式: fixed/adaptive
+    budget_mode = Column(String(16), nullable=True)
+    # 各扫描阶段的耗时、预算与产出, json格式, 见zap_phase.PhaseMetrics
+    phase_metrics = Column(Text, nullable=True)
+
     def __repr__(self):
         return f"<VtZapTask(name={self.id})>"
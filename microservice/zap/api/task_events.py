@@ -0,0 +1,157 @@
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+import requests
+import structlog
+from sqlalchemy.orm import Session
+from model.task_event import VtTaskEvent, VtTaskEventMark
+from sqllite_sql import get_db_session
+
+# 任务事件推送
+# 任务状态变化(Running/Done/Failed/Error)时推送到任务管理器的/task_events,
+# 任务管理器据此立即更新任务状态, 不必等待轮询.
+# 事件与任务状态在同一个本地事务内写入发件箱(VtTaskEvent), 由后台线程按id顺序批量发送,
+# 送达后推进高水位; 发送失败时退避重试, 不丢弃. 推进高水位前进程退出的事件会重复发送,
+# 任务管理器按任务状态判断, 重复事件直接忽略, 因此是至少一次送达
+
+logging.basicConfig(
+    level=logging.WARNING,
+    format='%(asctime)s %(levelname)s %(message)s',
+    datefmt='%Y-%m-%dT%H:%M:%S%z'
+)
+logger = structlog.wrap_logger(logging.getLogger())
+taskManagerHost = os.getenv("TASK_MANAGER_HOST", "task-manager-api-service.default.svc.cluster.local")
+taskManagerPort = os.getenv("TASK_MANAGER_PORT", "8080")
+taskManagerUrl = f"http://{taskManagerHost}:{taskManagerPort}"
+taskEventToken = os.getenv("TASK_EVENT_TOKEN", "")
+# 扫描器名称, 与任务管理器中记录的pod名称一致
+scannerName = os.getenv("SCANNER_NAME", socket.gethostname())
+taskEventBatchSize = int(os.getenv("TASK_EVENT_BATCH_SIZE", "50"))
+taskEventTimeout = float(os.getenv("TASK_EVENT_TIMEOUT", "5"))
+# 没有新事件时检查发件箱的间隔(秒), 写入事件后会立即唤醒
+taskEventPollInterval = float(os.getenv("TASK_EVENT_POLL_INTERVAL", "2"))
+# 发送失败后的最长退避时间(秒)
+taskEventBackoffMax = float(os.getenv("TASK_EVENT_BACKOFF_MAX", "30"))
+# 已送达事件的保留时间(秒), 之后从发件箱删除
+taskEventRetention = float(os.getenv("TASK_EVENT_RETENTION", "3600"))
+
+def events_enabled() -> bool:
+    """未配置回调密钥时不记录也不推送事件"""
+    return taskEventToken != ""
+
+def record_task_event(db_session: Session, task_id: int, status: str, report_ready: bool = False,
+                      errmsg: Optional[str] = None):
+    """在调用方的事务内写入一条任务事件, 随任务状态一起提交"""
+    if not events_enabled():
+        return
+    db_session.add(VtTaskEvent(task_id=int(task_id), status=status, report_ready=report_ready,
+                               errmsg=errmsg[:256] if errmsg else errmsg))
+
+def get_delivered_id(db_session: Session) -> int:
+    mark = db_session.query(VtTaskEventMark).filter_by(id=1).first()
+    return mark.delivered_id if mark != None else 0
+
+def mark_delivered(db_session: Session, delivered_id: int):
+    """推进高水位, 并删除超过保留时间的已送达事件"""
+    mark = db_session.query(VtTaskEventMark).filter_by(id=1).first()
+    if mark == None:
+        mark = VtTaskEventMark(id=1, delivered_id=0)
+    mark.delivered_id = max(mark.delivered_id, delivered_id)
+    db_session.add(mark)
+    expire_time = datetime.now(timezone.utc) - timedelta(seconds=taskEventRetention)
+    db_session.query(VtTaskEvent).filter(VtTaskEvent.id <= mark.delivered_id,
+                                         VtTaskEvent.create_time < expire_time).delete(synchronize_session=False)
+
+def to_payload(event: VtTaskEvent) -> dict:
+    return {
+        # 扫描器名称加发件箱id, 在任务管理器侧唯一
+        'event_id': f"{scannerName}:{event.id}",
+        'task_id': event.task_id,
+        'scanner': scannerName,
+        'status': event.status,
+        'report_ready': bool(event.report_ready),
+        'errmsg': event.errmsg,
+    }
+
+class TaskEventSender:
+    """发件箱的后台发送器
+
+    Keyword arguments:
+    url: 任务管理器的/task_events地址
+    token: 回调的共享密钥
+    """
+
+    def __init__(self, url: str, token: str):
+        self.url = url
+        self.token = token
+        self.session = requests.Session()
+        self.thread: Optional[threading.Thread] = None
+        self.wakeup = threading.Event()
+        # 连续发送失败的次数, 用于退避
+        self.failures = 0
+
+    def start(self):
+        if self.thread != None:
+            return
+        if not events_enabled():
+            logger.warn("TASK_EVENT_TOKEN is not set, task events are not pushed, "
+                        "task manager falls back to polling")
+            return
+        self.thread = threading.Thread(target=self.run, name="task-event-sender", daemon=True)
+        self.thread.start()
+
+    def wake(self):
+        """事件提交后立即发送"""
+        self.wakeup.set()
+
+    def post(self, events: List[dict]) -> bool:
+        try:
+            response = self.session.post(self.url, json={'events': events},
+                                         headers={'X-Task-Event-Token': self.token}, timeout=taskEventTimeout)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"post task events error: {e}")
+            return False
+        if response.status_code == 401:
+            logger.error("post task events unauthorized, check TASK_EVENT_TOKEN")
+        elif response.status_code != 200:
+            logger.error(f"post task events failed, status {response.status_code}")
+        return response.status_code == 200
+
+    def send_batch(self) -> int:
+        """发送高水位之后的一批事件, 返回送达的事件数, 发送失败时抛出异常"""
+        with get_db_session() as db_session:
+            delivered_id = get_delivered_id(db_session)
+            events = db_session.query(VtTaskEvent).filter(VtTaskEvent.id > delivered_id) \
+                .order_by(VtTaskEvent.id).limit(taskEventBatchSize).all()
+            payload = [to_payload(event) for event in events]
+            last_id = events[-1].id if events else delivered_id
+        if not payload:
+            return 0
+        if not self.post(payload):
+            raise Exception(f"{len(payload)} task events not delivered")
+        with get_db_session() as db_session:
+            mark_delivered(db_session, last_id)
+        return len(payload)
+
+    def run(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                sent = self.send_batch()
+                self.failures = 0
+            except Exception as e:
+                logger.error(f"send task events error: {e}")
+                self.failures += 1
+                time.sleep(random.uniform(0, min(taskEventBackoffMax, 2 ** self.failures)))
+                continue
+            # 一批发满时可能还有积压, 直接发送下一批
+            if sent < taskEventBatchSize:
+                self.wakeup.wait(taskEventPollInterval)
+
+# 进程内共用的发送器
+task_event_sender = TaskEventSender(url=taskManagerUrl + '/task_events', token=taskEventToken)
@@ -1,23 +1,29 @@
 import atexit
+import json
 from typing import List
 from fastapi import APIRouter, Depends, FastAPI, Query, Request, status as Status
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.exc import SQLAlchemyError
 from fastapi.middleware.cors import CORSMiddleware
-from sqllite_sql import get_db_session
-from model.zap_task import VtZapTask, TaskStatus
+from sqllite_sql import get_db
+from model.zap_task import VtZapTask, TaskStatus, InternStatus
 from sqlalchemy.orm import Session
 from sqlalchemy import desc
-from zap_client import get_zap_conn
-from zap_task_trace_schedule import scheduler, logger
+from zap_client import get_zap_conn, start_zap_task, stop_zap_task, remove_zap_task, list_context_alerts, render_alerts_html, \
+    set_spider_budget, target_site, iter_context_alerts, compact_alert
+from zap_phase import PhaseMetrics, get_phase_budget, summarize_phase_metrics
+from zap_task_trace_schedule import tracer, logger
+from task_events import task_event_sender, record_task_event
 import os
 
 app = FastAPI()
 
-# 启动周期任务, 追踪更新任务状态
-scheduler.start()
-# 注册退出处理程序以优雅地关闭调度器
-atexit.register(lambda: scheduler.shutdown())
+# 启动任务追踪器, 并发推进各任务的扫描阶段
+tracer.start()
+# 启动任务事件发送器, 将发件箱中的任务事件推送到任务管理器
+task_event_sender.start()
+# 注册退出处理程序以优雅地关闭追踪器
+atexit.register(lambda: tracer.shutdown())
 
 app.add_middleware(
     CORSMiddleware,
@@ -59,54 +65,86 @@ def get_db_running_task(db_session: Session) -> List[VtZapTask]:
     return tasks
 
 @app.get("/healthz")
-async def healthz(db_session: Session = Depends(get_db_session)):
+async def healthz(db_session: Session = Depends(get_db)):
     return {'ok': True}
 
 @app.get("/get_task")
 async def get_task(task_id:int = Query(..., description="Global task id"),
-                   db_session: Session = Depends(get_db_session)):
+                   db_session: Session = Depends(get_db)):
     try:
         task = get_db_zap_task(id=task_id, db_session=db_session)
         status = task.status
-        return {'ok': True, 'status': status}
+        return {'ok': True, 'status': status, 'running_status': task.running_status,
+                'budget_mode': task.budget_mode, 'metrics': PhaseMetrics(task.phase_metrics).phases}
     except Exception as e:
         logger.error('Faild to get zap task: ' + str(e))
         return {'ok': False, 'errmsg': str(e)}
 
+@app.get("/phase_metrics")
+async def phase_metrics(limit:int = Query(100, description="Recent finished task num"),
+                        db_session: Session = Depends(get_db)):
+    """
+    导出最近完成任务的各阶段耗时、预算与产出, 及按阶段的汇总
+    
+    Http Code: 状态码200,返回数据:
+    {
+        "ok": True,
+        "tasks": [{"id": 1, "target": "http://a", "budget_mode": "fixed", "metrics": {"spider": {...}}}],
+        "summary": {"spider": {"count": 1, "seconds": 35.2, "avg_seconds": 35.2, "truncated": 0}}
+    }
+    """
+    try:
+        tasks = db_session.query(VtZapTask).filter(VtZapTask.status==TaskStatus.DONE) \
+            .order_by(desc(VtZapTask.finish_time)).limit(limit).all()
+        return {
+            'ok': True,
+            'tasks': [{'id': task.id, 'target': task.target, 'budget_mode': task.budget_mode,
+                       'metrics': PhaseMetrics(task.phase_metrics).phases} for task in tasks],
+            'summary': summarize_phase_metrics(tasks),
+        }
+    except Exception as e:
+        logger.error('Faild to get phase metrics: ' + str(e))
+        return {'ok': False, 'errmsg': str(e)}
+
 @app.post("/create_task")
 async def create_task(task_id:int = Query(..., description="Global task id"),
                       target:str = Query(...,  description="Task target"),
-                      db_session: Session = Depends(get_db_session)):
+                      db_session: Session = Depends(get_db)):
     try:
         running_tasks = get_db_running_task(db_session=db_session)
         if len(running_tasks) >= max_task_parallel:
             raise Exception("TaskNumLimit")
         zap = get_zap_conn()
         running_status = None
-        # 0. 开启新的session
-        zap.core.run_garbage_collection()
-        if zap.core.new_session(overwrite=True) != 'OK':
-            raise Exception("New session failed.")
+        # 0. 不再新建session, 每个任务使用独立的context, 可以同时运行多个任务
+        # 按预算模式设置传统爬虫时长
+        budget = get_phase_budget(db_session, site=target_site(target), exclude_id=task_id)
+        duration = budget.spider()
+        set_spider_budget(zap, duration)
         # 1. 开始任务，即进入传统爬虫阶段
-        zap.pscan.set_max_alerts_per_rule(20)
-        zap.spider.set_option_max_depth(5)
-        zap.spider.set_option_max_duration(10)
-        zap.spider.set_option_thread_count(8)
-        res = zap.spider.scan(target)
-        if int(res) != 0:
-            raise Exception(f"Spider scan failed.")
-        else:
-            running_id = None
-            finished_time = None
-            task = VtZapTask(
-                id=task_id,
-                target=target,
-                running_id=running_id,
-                finished_time=finished_time,
-            )
-            logger.info(f"New task {target} started.")
-            db_session.add(task)
-            db_session.flush()
+        context_id, running_id = start_zap_task(zap, task_id=task_id, target=target)
+        metrics = PhaseMetrics()
+        metrics.start(InternStatus.SPIDER, budget=duration)
+        task = VtZapTask(
+            id=task_id,
+            target=target,
+            running_id=running_id,
+            context_id=context_id,
+            status=TaskStatus.RUNNING,
+            running_status=InternStatus.SPIDER,
+            errmsg=None,
+            finish_time=None,
+            budget_mode=budget.mode,
+            phase_metrics=metrics.dumps(),
+        )
+        logger.info(f"New task {target} started.")
+        # 同id的任务重新下发时覆盖旧记录
+        db_session.merge(task)
+        record_task_event(db_session, task_id, TaskStatus.RUNNING.value)
+        # 追踪器与发送器使用各自的连接, 提交后才能读到新任务
+        db_session.commit()
+        tracer.wake()
+        task_event_sender.wake()
         return {'ok': True, 'running_status': running_status}
     except Exception as e:
         logger.error('Faild to create zap task: ' + str(e))
@@ -114,60 +152,99 @@ async def create_task(task_id:int = Query(..., description="Global task id"),
 
 @app.delete("/delete_task")
 async def delete_task(task_id:int = Query(..., description="Global task id"),
-                   db_session: Session = Depends(get_db_session)):
+                   db_session: Session = Depends(get_db)):
     try:
         task = get_db_zap_task(id=task_id, db_session=db_session)
+        # 只停止并清理该任务的context, 不影响其他任务
+        zap = get_zap_conn()
+        other_targets = [other.target for other in get_db_running_task(db_session=db_session) if other.id != task.id]
+        remove_zap_task(zap, task, other_targets=other_targets)
         task.status = TaskStatus.DONE
         db_session.add(task)
-        db_session.flush()
+        record_task_event(db_session, task.id, TaskStatus.DONE.value)
+        # 发送器使用自己的连接, 事件提交后才能读到
+        db_session.commit()
+        task_event_sender.wake()
         return {'ok': True}
-        # zap = get_zap_conn()
-        # # 0. 停止任务
-        # zap.spider.stop_all_scans()
-        # zap.ajaxSpider.stop()
-        # zap.ascan.stop_all_scans()
-        # # 1. 开启新的session
-        # zap.core.run_garbage_collection()
-        # if zap.core.new_session(overwrite=True) != 'OK':
-        #     raise Exception("New session failed.")
     except Exception as e:
         logger.error('Faild to delete zap task: ' + str(e))
         return {'ok': False, 'errmsg': str(e)}
 
 @app.get("/get_report")
 async def get_report(task_id:int = Query(..., description="Global task id"),
-                   db_session: Session = Depends(get_db_session)):
+                   db_session: Session = Depends(get_db)):
     try:
         task = get_db_zap_task(id=task_id, db_session=db_session)
         zap = get_zap_conn()
-        # 0. 停止所有扫描
-        zap.ascan.stop_all_scans()
-        zap.core.set_option_merge_related_alerts(enabled='true')
-        # 1. 获取report文件内容
-        content = zap.core.htmlreport()
+        # 0. 停止该任务的扫描
+        stop_zap_task(zap, task)
+        zap.set_option(zap.core.set_option_merge_related_alerts, 'true')
+        # 1. 只导出该任务context内的告警
+        alerts = list_context_alerts(zap, task_id=task.id)
+        content = render_alerts_html(task.target, alerts)
         content = content.encode('utf-8')
         return {'ok': True, 'content': content}
     except Exception as e:
         logger.error('Faild to get zap report: ' + str(e))
         return {'ok': False, 'errmsg': str(e)}
 
+@app.get("/get_report_stream")
+async def get_report_stream(task_id:int = Query(..., description="Global task id"),
+                            db_session: Session = Depends(get_db)):
+    """
+    以NDJSON流式导出任务的告警, 每行一个json对象, html报告由调用方生成
+    
+    Http Code: 状态码200, 返回数据(application/x-ndjson):
+    {"kind": "meta", "task_id": 1, "target": "http://a"}
+    {"kind": "alert", "alert": "...", "risk": "High", "url": "...", ...}
+    {"kind": "end", "count": 1}
+    缺少end行说明导出中途失败, 调用方需要重试
+    任务不存在或ZAP不可用时返回{"ok": False, "errmsg": "xxx"}
+    """
+    try:
+        task = get_db_zap_task(id=task_id, db_session=db_session)
+        zap = get_zap_conn()
+        # 0. 停止该任务的扫描
+        stop_zap_task(zap, task)
+        zap.set_option(zap.core.set_option_merge_related_alerts, 'true')
+        target = task.target
+    except Exception as e:
+        logger.error('Faild to get zap report: ' + str(e))
+        return {'ok': False, 'errmsg': str(e)}
+
+    def generate():
+        yield json.dumps({'kind': 'meta', 'task_id': task_id, 'target': target}, separators=(',', ':')) + '\n'
+        count = 0
+        try:
+            # 1. 分页读取该任务context内的告警, 逐条输出
+            for alert in iter_context_alerts(zap, task_id=task_id):
+                yield json.dumps(dict(kind='alert', **compact_alert(alert)), separators=(',', ':')) + '\n'
+                count += 1
+        except Exception as e:
+            logger.error('Faild to stream zap report: ' + str(e))
+            return
+        yield json.dumps({'kind': 'end', 'count': count}, separators=(',', ':')) + '\n'
+
+    return StreamingResponse(generate(), media_type='application/x-ndjson')
+
 # 缩容
 @app.delete("/scale_in_with_num")
-async def scale_in_with_num(num:str = Query(..., description="task num to scale in"),
-                        db_session: Session = Depends(get_db_session)):
+async def scale_in_with_num(num:int = Query(..., description="task num to scale in"),
+                        db_session: Session = Depends(get_db)):
     try:
         tasks:List[VtZapTask] = get_db_running_task(db_session=db_session)
         zap = get_zap_conn()
         for task in tasks:
             if num <= 0:
                 break
-            zap.ascan.stop_all_scans()
-            zap.ajaxSpider.stop()
-            zap.spider.stop_all_scans()
+            stop_zap_task(zap, task)
             task.status = TaskStatus.ERROR
             db_session.add(task)
+            record_task_event(db_session, task.id, TaskStatus.ERROR.value)
             db_session.flush()
             num -= 1
+        db_session.commit()
+        task_event_sender.wake()
         return {'ok': True}
     except Exception as e:
         logger.error('Faild to scale in: ' + str(e))
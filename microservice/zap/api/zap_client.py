@@ -1,67 +1,330 @@
+from typing import Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+import threading
+import requests
+from requests.adapters import HTTPAdapter
 from zapv2 import ZAPv2
+import html
 import os
-from model.zap_task import InternStatus
+import re
+from model.zap_task import InternStatus, TaskStatus, VtZapTask
+from sqllite_sql import get_db_session
+from zap_phase import PhaseMetrics, PhaseBudget, spiderMaxDepth, ascanRuleDuration
 
 http_proxy = os.getenv("HTTP_PROXY", "127.0.0.1")
 api_key = os.getenv("API_KEY", "cstcloud")
 zap_max_thread = int(os.getenv("ZAP_MAX_THREAD", "2"))
+# 分页获取告警时每页的数量
+alertPageSize = int(os.getenv("ALERT_PAGE_SIZE", "500"))
+# ZAP API调用的连接池大小与超时(秒)
+zapPoolSize = int(os.getenv("ZAP_POOL_SIZE", "8"))
+zapConnectTimeout = float(os.getenv("ZAP_CONNECT_TIMEOUT", "3"))
+zapReadTimeout = float(os.getenv("ZAP_READ_TIMEOUT", "30"))
 
-def get_zap_conn() -> ZAPv2:
-    zap = ZAPv2(proxies={'http':http_proxy}, apikey=api_key)
-    res = zap.pscan.set_max_alerts_per_rule(20)
+# 多个任务共用一个ZAP session, 每个任务使用独立的context限定扫描范围,
+# 传统爬虫与主动扫描使用各自的scanId, 互不影响.
+# ZAP同一时间只能运行一个ajax爬虫, 其他任务的传统爬虫完成后等待ajax爬虫空闲.
+# ajax爬虫的状态是整个ZAP共用的, 只有处于AJAXSPIDER阶段的任务拥有ajax爬虫:
+# 该任务结束ajax阶段(状态写入数据库)之前其他任务不能启动, 因此ajax爬虫"未运行"只代表这个任务的爬取完成.
+# 多个任务并发推进时, 检查ajax爬虫是否空闲与启动ajax爬虫需要在同一把锁内
+ajax_spider_lock = threading.Lock()
+
+class PooledZAPv2(ZAPv2):
+    """进程内共用的ZAP客户端
+
+    ZAPv2默认每次调用新建requests.Session, 连接不能复用且没有超时.
+    这里所有调用共用一个带连接池的Session并设置超时;
+    option设置按值缓存, 值没有变化时不再发送, ZAP连接失败(可能已重启)时清空缓存
+    """
+
+    def __init__(self, proxies: dict, apikey: str, timeout: Tuple[float, float]):
+        super().__init__(proxies=proxies, apikey=apikey)
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.proxies.update(proxies)
+        self.session.headers['X-ZAP-API-Key'] = apikey
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=zapPoolSize))
+        # (组件, setter) -> 最近一次设置成功的值
+        self.options = {}
+        self.options_lock = threading.Lock()
+
+    def _request_api(self, url, query=None, method="GET", body=None):
+        if not url.startswith('http://zap/'):
+            # 只允许请求ZAP API, 避免泄露apikey
+            raise ValueError('A non ZAP API url was specified ' + url)
+        try:
+            return self.session.request(method, url, params=query, data=body, verify=False, timeout=self.timeout)
+        except requests.exceptions.ConnectionError:
+            with self.options_lock:
+                self.options.clear()
+            raise
+
+    def set_option(self, setter, value):
+        """值与上一次设置的不同时才调用setter, 例如set_option(zap.ascan.set_option_thread_per_host, 2)"""
+        key = (type(setter.__self__).__name__, setter.__name__)
+        with self.options_lock:
+            if self.options.get(key) == value:
+                return
+        res = setter(value)
+        if res != 'OK':
+            raise Exception(f"{key[0]}.{key[1]}({value}) failed: {res}")
+        with self.options_lock:
+            self.options[key] = value
+
+zap_conn: PooledZAPv2 = None
+zap_conn_lock = threading.Lock()
+
+def get_zap_conn() -> PooledZAPv2:
+    """返回进程内唯一的ZAP客户端"""
+    global zap_conn
+    with zap_conn_lock:
+        if zap_conn == None:
+            zap_conn = PooledZAPv2(proxies={'http':http_proxy}, apikey=api_key,
+                                   timeout=(zapConnectTimeout, zapReadTimeout))
+    # 被动扫描每条规则的告警数上限, 只在ZAP(重启后)第一次使用时设置
+    zap_conn.set_option(zap_conn.pscan.set_max_alerts_per_rule, 20)
+    return zap_conn
+
+def task_context_name(task_id: int) -> str:
+    return f"vt-task-{task_id}"
+
+def target_site(target: str) -> str:
+    parsed = urlparse(target)
+    return f"{parsed.scheme}://{parsed.netloc}"
+
+def start_zap_task(zap: PooledZAPv2, task_id: int, target: str) -> Tuple[str, str]:
+    """为任务创建context并开始传统爬虫
+
+    Return: (context_id, spider_scan_id)
+    """
+    context_name = task_context_name(task_id)
+    # 同id的任务重新下发时清除旧的context
+    if context_name in zap.context.context_list:
+        zap.context.remove_context(context_name)
+    context_id = zap.context.new_context(context_name)
+    if not str(context_id).isdigit():
+        raise Exception(f"New context failed: {context_id}")
+    res = zap.context.include_in_context(context_name, re.escape(target_site(target)) + ".*")
     if res != 'OK':
-        raise Exception("Set max alerts per rule failed.") 
-    return zap
+        raise Exception(f"Include target in context failed: {res}")
+    scan_id = zap.spider.scan(url=target, contextname=context_name)
+    if not str(scan_id).isdigit():
+        raise Exception(f"Spider scan failed: {scan_id}")
+    return context_id, scan_id
 
-def handle_zap_task(zap: ZAPv2, running_status:str, target:str):
-    if running_status == InternStatus.SPIDER:
-        progress = int(zap.spider.status(0))
-        # 传统爬虫完成进入Ajax爬虫
-        if progress >= 100:
-            zap.ajaxSpider.set_option_max_crawl_depth(5)
-            zap.ajaxSpider.set_option_max_duration(10)
-            zap.ajaxSpider.set_option_browser_id('htmlunit')
-            zap.ajaxSpider.set_option_number_of_browsers(zap_max_thread)
-            res = zap.ajaxSpider.scan(target)
+def stop_zap_task(zap: PooledZAPv2, task: VtZapTask):
+    """停止任务当前阶段的扫描, 不影响其他任务"""
+    if task.running_status == InternStatus.SPIDER and task.running_id != None:
+        zap.spider.stop(task.running_id)
+    if task.running_status == InternStatus.AJAXSPIDER:
+        zap.ajaxSpider.stop()
+    if task.running_status == InternStatus.ACTIVE and task.running_id != None:
+        zap.ascan.stop(task.running_id)
+
+def remove_zap_task(zap: PooledZAPv2, task: VtZapTask, other_targets: List[str]):
+    """停止任务扫描并删除context, 没有其他任务使用同一站点时删除站点数据释放ZAP内存
+
+    Keyword arguments:
+    other_targets: 其他运行中任务的目标
+    """
+    stop_zap_task(zap, task)
+    context_name = task_context_name(task.id)
+    if context_name in zap.context.context_list:
+        zap.context.remove_context(context_name)
+    site = target_site(task.target)
+    if site not in [target_site(target) for target in other_targets]:
+        zap.core.delete_site_node(url=site)
+
+def count_context_urls(zap: PooledZAPv2, task_id: int) -> int:
+    return len(zap.context.urls(task_context_name(task_id)))
+
+def count_site_alerts(zap: PooledZAPv2, target: str) -> int:
+    return int(zap.alert.number_of_alerts(baseurl=target_site(target)))
+
+def set_spider_budget(zap: PooledZAPv2, duration: int):
+    """设置传统爬虫的深度与时长(分钟)"""
+    zap.set_option(zap.spider.set_option_max_depth, spiderMaxDepth)
+    zap.set_option(zap.spider.set_option_max_duration, duration)
+    zap.set_option(zap.spider.set_option_thread_count, 8)
+
+def get_ajax_spider_owner(exclude_id: int) -> Optional[int]:
+    """返回处于ajax爬虫阶段的其他运行中任务的id, 没有时返回None"""
+    with get_db_session() as db_session:
+        owner = db_session.query(VtZapTask.id).filter(
+            VtZapTask.status == TaskStatus.RUNNING,
+            VtZapTask.running_status == InternStatus.AJAXSPIDER,
+            VtZapTask.id != exclude_id
+        ).first()
+    return owner[0] if owner != None else None
+
+def claim_phase(task_id: int, old: InternStatus, new: InternStatus) -> bool:
+    """启动下一阶段的扫描前, 以running_status=old为条件将任务切换到new并立即提交
+
+    同一任务只有一个追踪者能切换成功, 切换失败的不应再启动扫描
+    """
+    with get_db_session() as db_session:
+        rows = db_session.query(VtZapTask).filter(
+            VtZapTask.id == task_id,
+            VtZapTask.status == TaskStatus.RUNNING,
+            VtZapTask.running_status == old
+        ).update({VtZapTask.running_status: new}, synchronize_session=False)
+    return rows == 1
+
+def release_phase(task_id: int, claimed: InternStatus, old: InternStatus):
+    """扫描启动失败时撤销claim_phase的切换"""
+    with get_db_session() as db_session:
+        db_session.query(VtZapTask).filter(
+            VtZapTask.id == task_id,
+            VtZapTask.running_status == claimed
+        ).update({VtZapTask.running_status: old}, synchronize_session=False)
+
+def start_ajax_spider(zap: PooledZAPv2, task: VtZapTask, duration: int) -> bool:
+    """ajax爬虫空闲时为任务启动ajax爬虫, 被其他任务占用时返回False
+
+    其他任务的ajax爬取已经完成、但还没有被追踪器推进到下一阶段时, ZAP中ajax爬虫同样是空闲的,
+    此时启动会让对方把本任务的爬取当作自己的, 因此以数据库中的阶段判断占用
+
+    Keyword arguments:
+    duration: ajax爬虫的时长(分钟)
+    """
+    with ajax_spider_lock:
+        if get_ajax_spider_owner(task.id) != None:
+            return False
+        if zap.ajaxSpider.status == 'running':
+            return False
+        # 先占用ajax阶段再启动, 其他任务随即看到ajax爬虫已被占用
+        if not claim_phase(task.id, InternStatus.SPIDER, InternStatus.AJAXSPIDER):
+            return False
+        try:
+            zap.set_option(zap.ajaxSpider.set_option_max_crawl_depth, spiderMaxDepth)
+            zap.set_option(zap.ajaxSpider.set_option_max_duration, duration)
+            zap.set_option(zap.ajaxSpider.set_option_browser_id, 'htmlunit')
+            zap.set_option(zap.ajaxSpider.set_option_number_of_browsers, zap_max_thread)
+            res = zap.ajaxSpider.scan(url=task.target, contextname=task_context_name(task.id))
             if res != 'OK':
                 raise Exception("AjaxSpider begin failed.")
-            running_status = InternStatus.AJAXSPIDER
+        except Exception:
+            release_phase(task.id, InternStatus.AJAXSPIDER, InternStatus.SPIDER)
+            raise
+        return True
+
+def handle_zap_task(zap: PooledZAPv2, task: VtZapTask, metrics: PhaseMetrics,
+                    budget: PhaseBudget) -> Tuple[InternStatus, Optional[str], Optional[str], Optional[int]]:
+    """推进任务的扫描阶段
+
+    Keyword arguments:
+    metrics: 任务的阶段指标, 阶段切换时记录耗时与产出
+    budget: 计算ajax爬虫与主动扫描阶段的预算
+    Return: (running_status, running_id, errmsg, progress)
+    progress: 传统爬虫/主动扫描阶段为进度百分比, 被动扫描阶段为待扫描记录数, ajax爬虫阶段为None
+    """
+    running_status = task.running_status
+    running_id = task.running_id
+    target = task.target
+    progress = None
+    if running_status == InternStatus.SPIDER:
+        progress = int(zap.spider.status(running_id))
+        # 传统爬虫完成进入Ajax爬虫, ajax爬虫被其他任务占用时等待
+        if progress >= 100:
+            if not metrics.ended(InternStatus.SPIDER):
+                metrics.end(InternStatus.SPIDER, urls=count_context_urls(zap, task.id))
+            urls = metrics.phases[InternStatus.SPIDER.value]['urls']
+            duration = budget.ajax(urls)
+            if start_ajax_spider(zap, task, duration):
+                metrics.start(InternStatus.AJAXSPIDER, budget=duration)
+                running_status = InternStatus.AJAXSPIDER
+                running_id = None
+                progress = None
     # 2. 进入ajax爬虫期间
     if running_status == InternStatus.AJAXSPIDER:
         status = zap.ajaxSpider.status
-        # ajax爬虫完成进入主动扫描
+        # ajax爬虫完成进入主动扫描, 本任务处于ajax阶段期间其他任务不会启动ajax爬虫, "未运行"即本任务爬取完成
         if status != 'running':
-            zap.ascan.set_option_max_scan_duration_in_mins(15)
-            zap.ascan.set_option_max_rule_duration_in_mins(1)
+            urls = count_context_urls(zap, task.id)
+            metrics.end(InternStatus.AJAXSPIDER, urls=urls)
+            duration = budget.active(urls)
+            zap.set_option(zap.ascan.set_option_max_scan_duration_in_mins, duration)
+            zap.set_option(zap.ascan.set_option_max_rule_duration_in_mins, ascanRuleDuration)
             # 控制线程并发数
-            zap.ascan.set_option_thread_per_host(zap_max_thread)
+            zap.set_option(zap.ascan.set_option_thread_per_host, zap_max_thread)
             # 主动扫描加速
-            zap.ascan.set_option_max_alerts_per_rule(1)
-            zap.ascan.set_option_max_results_to_list(1)
-            zap.ascan.set_option_max_chart_time_in_mins(0)
-            res = zap.ascan.scan(target)
+            zap.set_option(zap.ascan.set_option_max_alerts_per_rule, 1)
+            zap.set_option(zap.ascan.set_option_max_results_to_list, 1)
+            zap.set_option(zap.ascan.set_option_max_chart_time_in_mins, 0)
+            if not claim_phase(task.id, InternStatus.AJAXSPIDER, InternStatus.ACTIVE):
+                raise Exception(f"Task {task.id} left ajaxspider phase, skip active scan.")
+            try:
+                res = zap.ascan.scan(url=target, recurse=True, contextid=task.context_id)
+            except Exception:
+                release_phase(task.id, InternStatus.ACTIVE, InternStatus.AJAXSPIDER)
+                raise
             # url无效，扫描结束
             if res == 'url_not_found':
                 running_status = InternStatus.FAILED
-                return running_status, res
-            elif int(res) != 0:
+                return running_status, running_id, res, progress
+            elif not str(res).isdigit():
+                release_phase(task.id, InternStatus.ACTIVE, InternStatus.AJAXSPIDER)
                 raise Exception(f"Active scan failed.")
             else:
+                metrics.start(InternStatus.ACTIVE, budget=duration)
                 running_status = InternStatus.ACTIVE
+                running_id = res
     # 3. 进入主动扫描期间
     if running_status == InternStatus.ACTIVE:
-        progress = int(zap.ascan.status(0))
+        progress = int(zap.ascan.status(running_id))
         # 主动扫描完成，进入被动扫描
         if progress >= 100:
+            metrics.end(InternStatus.ACTIVE, alerts=count_site_alerts(zap, target))
             pscan = int(zap.pscan.records_to_scan)
             if pscan == 0:
                 running_status = InternStatus.DONE
             else:
+                metrics.start(InternStatus.PASSIVE)
                 running_status = InternStatus.PASSIVE
-    # 4. 进入passive扫描期间
+    # 4. 进入passive扫描期间, 被动扫描队列为全部任务共用
     if running_status == InternStatus.PASSIVE:
         pscan = int(zap.pscan.records_to_scan)
+        progress = pscan
         # 快速退出passive期间
         if pscan < 10:
+            metrics.end(InternStatus.PASSIVE, alerts=count_site_alerts(zap, target))
             running_status = InternStatus.DONE
-    return running_status, None
+    return running_status, running_id, None, progress
+
+# 流式导出报告时每条告警保留的字段
+REPORT_ALERT_FIELDS = ('pluginId', 'alert', 'risk', 'confidence', 'url', 'method', 'param', 'attack',
+                       'evidence', 'cweid', 'wascid', 'description', 'solution', 'reference')
+
+def iter_context_alerts(zap: PooledZAPv2, task_id: int) -> Iterator[dict]:
+    """分页遍历任务context内的告警, ZAP与API中同时只保留一页"""
+    context_name = task_context_name(task_id)
+    start = 0
+    while True:
+        page = zap.alert.alerts(contextname=context_name, start=start, count=alertPageSize)
+        yield from page
+        if len(page) < alertPageSize:
+            return
+        start += alertPageSize
+
+def list_context_alerts(zap: PooledZAPv2, task_id: int) -> List[dict]:
+    """分页获取任务context内的全部告警"""
+    return list(iter_context_alerts(zap, task_id))
+
+def compact_alert(alert: dict) -> dict:
+    """只保留报告需要的非空字段"""
+    return {key: alert[key] for key in REPORT_ALERT_FIELDS if alert.get(key) not in (None, '')}
+
+def render_alerts_html(target: str, alerts: List[dict]) -> str:
+    """按风险等级生成任务的html报告"""
+    risk_order = {'High': 0, 'Medium': 1, 'Low': 2, 'Informational': 3}
+    alerts = sorted(alerts, key=lambda alert: risk_order.get(alert.get('risk'), 4))
+    rows = []
+    for alert in alerts:
+        rows.append("<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>".format(
+            *(html.escape(str(alert.get(key, ''))) for key in ('risk', 'confidence', 'alert', 'url', 'solution'))))
+    return (
+        "<html><head><meta charset=\"utf-8\"><title>ZAP Scanning Report</title></head><body>"
+        f"<h1>ZAP Scanning Report</h1><p>Target: {html.escape(target)}</p><p>Alerts: {len(alerts)}</p>"
+        "<table border=\"1\"><tr><th>Risk</th><th>Confidence</th><th>Alert</th><th>URL</th><th>Solution</th></tr>"
+        + "".join(rows) + "</table></body></html>"
+    )
@@ -0,0 +1,166 @@
+import json
+import math
+import os
+import time
+from typing import Dict, List, Optional
+from sqlalchemy import desc
+from sqlalchemy.orm import Session
+from model.zap_task import VtZapTask, TaskStatus, InternStatus
+
+# 阶段预算模式: fixed使用固定预算, adaptive按站点规模与历史产出分配各阶段时间
+budgetMode = os.getenv("ZAP_BUDGET_MODE", "fixed")
+# 固定预算, 同时也是adaptive模式下的上限(分钟)
+spiderMaxDepth = int(os.getenv("SPIDER_MAX_DEPTH", "5"))
+spiderMaxDuration = int(os.getenv("SPIDER_MAX_DURATION", "10"))
+ajaxMaxDuration = int(os.getenv("AJAX_MAX_DURATION", "10"))
+ascanMaxDuration = int(os.getenv("ASCAN_MAX_DURATION", "15"))
+ascanRuleDuration = int(os.getenv("ASCAN_RULE_DURATION", "1"))
+# adaptive模式下的下限(分钟)
+ajaxMinDuration = int(os.getenv("AJAX_MIN_DURATION", "1"))
+ascanMinDuration = int(os.getenv("ASCAN_MIN_DURATION", "2"))
+# 每分钟预算能覆盖的url数
+ajaxUrlsPerMinute = float(os.getenv("AJAX_URLS_PER_MINUTE", "50"))
+ascanUrlsPerMinute = float(os.getenv("ASCAN_URLS_PER_MINUTE", "20"))
+# 参考同一站点最近几次完成任务的阶段数据
+budgetHistory = int(os.getenv("BUDGET_HISTORY", "5"))
+# 历史耗时的放大系数, 留出站点变化的余量
+budgetHistoryFactor = float(os.getenv("BUDGET_HISTORY_FACTOR", "1.5"))
+
+# 阶段指标
+# 每个任务的各阶段指标以json保存在VtZapTask.phase_metrics中:
+# {"spider": {"start": 1700000000.0, "seconds": 35.2, "budget": 10, "urls": 120}, ...}
+# start为阶段开始的时间戳, seconds为阶段耗时, budget为阶段预算(分钟),
+# 爬虫阶段记录结束时context内的url数, 主动/被动扫描阶段记录结束时站点的告警数
+
+class PhaseMetrics:
+    """任务各扫描阶段的耗时与产出
+
+    Keyword arguments:
+    raw: VtZapTask.phase_metrics的json字符串
+    """
+
+    def __init__(self, raw: Optional[str] = None):
+        self.phases: Dict[str, dict] = json.loads(raw) if raw else {}
+        self.changed = False
+
+    def start(self, phase: InternStatus, budget: Optional[int] = None, now: Optional[float] = None):
+        entry = {"start": now if now != None else time.time()}
+        if budget != None:
+            entry["budget"] = budget
+        self.phases[phase.value] = entry
+        self.changed = True
+
+    def ended(self, phase: InternStatus) -> bool:
+        return "seconds" in self.phases.get(phase.value, {})
+
+    def end(self, phase: InternStatus, now: Optional[float] = None, **outcome):
+        """记录阶段结束, outcome为阶段产出(urls/alerts)"""
+        entry = self.phases.setdefault(phase.value, {})
+        start = entry.get("start")
+        now = now if now != None else time.time()
+        entry["seconds"] = round(now - start, 1) if start != None else None
+        entry.update(outcome)
+        self.changed = True
+
+    def dumps(self) -> str:
+        return json.dumps(self.phases)
+
+def truncated(entry: dict) -> bool:
+    """阶段是否因用完预算而结束"""
+    if entry.get("budget") == None or entry.get("seconds") == None:
+        return False
+    return entry["seconds"] >= entry["budget"] * 60 * 0.95
+
+def history_cap(history: List[dict], phase: InternStatus) -> Optional[int]:
+    """按历史上未用完预算的阶段耗时估计预算(分钟), 没有历史时返回None"""
+    seconds = [metrics[phase.value]["seconds"] for metrics in history
+               if phase.value in metrics and metrics[phase.value].get("seconds") != None
+               and not truncated(metrics[phase.value])]
+    if not seconds:
+        return None
+    return max(1, math.ceil(max(seconds) * budgetHistoryFactor / 60))
+
+def clamp(value: int, low: int, high: int) -> int:
+    return min(max(value, low), high)
+
+class PhaseBudget:
+    """按站点规模与历史产出计算各阶段的预算(分钟), fixed模式下直接返回固定预算
+
+    Keyword arguments:
+    mode: fixed或adaptive
+    history: 同一站点最近完成任务的阶段指标, 从新到旧
+    """
+
+    def __init__(self, mode: str, history: List[dict]):
+        self.mode = mode
+        self.history = history
+
+    def adaptive(self) -> bool:
+        return self.mode == "adaptive"
+
+    def spider(self) -> int:
+        if not self.adaptive():
+            return spiderMaxDuration
+        cap = history_cap(self.history, InternStatus.SPIDER)
+        return spiderMaxDuration if cap == None else clamp(cap, 1, spiderMaxDuration)
+
+    def ajax(self, urls: int) -> int:
+        """urls: 传统爬虫发现的url数"""
+        if not self.adaptive():
+            return ajaxMaxDuration
+        budget = clamp(math.ceil(urls / ajaxUrlsPerMinute), ajaxMinDuration, ajaxMaxDuration)
+        # ajax爬虫历史上没有发现新url的站点只给最短时间
+        yields = [metrics["ajaxspider"]["urls"] - metrics["spider"].get("urls", 0) for metrics in self.history
+                  if "urls" in metrics.get("ajaxspider", {}) and "spider" in metrics]
+        if yields and max(yields) <= 0:
+            return ajaxMinDuration
+        cap = history_cap(self.history, InternStatus.AJAXSPIDER)
+        if cap != None:
+            budget = min(budget, cap)
+        return clamp(budget, ajaxMinDuration, ajaxMaxDuration)
+
+    def active(self, urls: int) -> int:
+        """urls: 爬虫阶段结束时context内的url数"""
+        if not self.adaptive():
+            return ascanMaxDuration
+        budget = clamp(math.ceil(urls / ascanUrlsPerMinute), ascanMinDuration, ascanMaxDuration)
+        # 历史上用完预算仍有告警产出的站点不按历史耗时收紧
+        starved = [metrics for metrics in self.history
+                   if truncated(metrics.get("active", {})) and metrics["active"].get("alerts", 0) > 0]
+        cap = history_cap(self.history, InternStatus.ACTIVE)
+        if cap != None and not starved:
+            budget = min(budget, cap)
+        return clamp(budget, ascanMinDuration, ascanMaxDuration)
+
+def get_site_history(db_session: Session, site: str, exclude_id: Optional[int] = None) -> List[dict]:
+    """同一站点最近完成任务的阶段指标"""
+    query = db_session.query(VtZapTask).filter(VtZapTask.status==TaskStatus.DONE,
+                                               VtZapTask.target.startswith(site),
+                                               VtZapTask.phase_metrics != None)
+    if exclude_id != None:
+        query = query.filter(VtZapTask.id != exclude_id)
+    tasks = query.order_by(desc(VtZapTask.finish_time)).limit(budgetHistory).all()
+    return [json.loads(task.phase_metrics) for task in tasks]
+
+def get_phase_budget(db_session: Session, site: str, exclude_id: Optional[int] = None) -> PhaseBudget:
+    if budgetMode != "adaptive":
+        return PhaseBudget(mode="fixed", history=[])
+    return PhaseBudget(mode=budgetMode, history=get_site_history(db_session, site, exclude_id=exclude_id))
+
+def summarize_phase_metrics(tasks: List[VtZapTask]) -> Dict[str, dict]:
+    """按阶段汇总任务的耗时与产出"""
+    summary: Dict[str, dict] = {}
+    for task in tasks:
+        if not task.phase_metrics:
+            continue
+        for phase, entry in json.loads(task.phase_metrics).items():
+            if entry.get("seconds") == None:
+                continue
+            stat = summary.setdefault(phase, {"count": 0, "seconds": 0.0, "truncated": 0})
+            stat["count"] += 1
+            stat["seconds"] += entry["seconds"]
+            stat["truncated"] += int(truncated(entry))
+    for stat in summary.values():
+        stat["avg_seconds"] = round(stat["seconds"] / stat["count"], 1)
+        stat["seconds"] = round(stat["seconds"], 1)
+    return summary
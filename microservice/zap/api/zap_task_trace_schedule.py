@@ -1,16 +1,20 @@
+import fcntl
 import logging
-from typing import List
-from apscheduler.schedulers.background import BackgroundScheduler
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
 from datetime import datetime
 from model.zap_task import VtZapTask, TaskStatus, InternStatus
 import structlog
-from zap_client import handle_zap_task, get_zap_conn
+from zap_client import handle_zap_task, get_zap_conn, target_site
+from zap_phase import PhaseMetrics, get_phase_budget
 from sqlalchemy.orm import Session
 from sqllite_sql import get_db_session
+from task_events import task_event_sender, record_task_event
 from sqlalchemy import desc
 
-# 初始化调度器
-scheduler = BackgroundScheduler()
 # 日志相关
 # 设置结构化日志
 logging.basicConfig(
@@ -19,32 +23,200 @@ logging.basicConfig(
     datefmt='%Y-%m-%dT%H:%M:%S%z'
 )
 logger = structlog.wrap_logger(logging.getLogger())
+# 同时推进的任务数
+traceWorkers = int(os.getenv("TRACE_WORKERS", "4"))
+# 每个任务两次轮询之间的最短/最长间隔(秒)
+traceMinInterval = float(os.getenv("TRACE_MIN_INTERVAL", "0.5"))
+traceMaxInterval = float(os.getenv("TRACE_MAX_INTERVAL", "15"))
+# 追踪器的文件锁, 与tasks.db放在同一目录; uvicorn多worker时每个pod只有持有锁的进程追踪任务
+traceLockFile = os.getenv("TRACE_LOCK_FILE", "tracer.lock")
+
+# 任务追踪
+# 每个任务独立推进扫描阶段, 由线程池并发执行, 互不阻塞.
+# 轮询间隔按阶段的进度估计: 根据进度的变化速度估计剩余时间, 取剩余时间的一半,
+# 接近完成时以最短间隔轮询, 主动扫描等长阶段放慢轮询; ajax爬虫没有进度, 按阶段已经过的时间
+# 逐渐放慢, 接近阶段预算用完时再加快轮询.
+# 阶段切换后立即进入下一次轮询.
+# 每个pod只运行一个追踪器: 进程内的ajax_spider_lock与inflight不能跨进程,
+# 多个uvicorn worker中只有拿到文件锁的一个追踪, 其余等待接替. 未持有锁的worker中wake不生效,
+# 新任务最迟在TRACE_MAX_INTERVAL后被追踪
 
 def get_db_running_task(db_session: Session) -> List[VtZapTask]:
     tasks = db_session.query(VtZapTask).filter(VtZapTask.status==TaskStatus.RUNNING).order_by(desc(VtZapTask.create_time)).all()
     return tasks
 
-def zap_task_trace_task():
-    try:
-        with get_db_session() as db_session:
-            zap = get_zap_conn()
-            # 获取任务
-            tasks = get_db_running_task(db_session=db_session)
-            for task in tasks:
-                running_status, msg = handle_zap_task(zap=zap, running_status=task.running_status, target=task.target)
+def budget_left(metrics: PhaseMetrics, running_status: InternStatus) -> Optional[float]:
+    """阶段预算剩余的秒数, 阶段没有预算时返回None"""
+    entry = metrics.phases.get(running_status.value, {})
+    if entry.get("budget") == None or entry.get("start") == None:
+        return None
+    return max(entry["start"] + entry["budget"] * 60 - time.time(), 0)
+
+class ZapTaskTracer:
+    """ZAP任务的并发追踪器
+
+    Keyword arguments:
+    workers: 同时推进的任务数
+    min_interval/max_interval: 每个任务两次轮询之间的最短/最长间隔(秒)
+    """
+
+    def __init__(self, workers: int, min_interval: float, max_interval: float):
+        self.workers = workers
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.thread: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        # task_id -> 下一次轮询的时间
+        self.next_poll: Dict[int, float] = {}
+        # 正在推进中的任务
+        self.inflight: Set[int] = set()
+        # task_id -> (阶段, 阶段开始时间, 阶段开始时的进度)
+        self.phase_start: Dict[int, Tuple[InternStatus, float, Optional[int]]] = {}
+        self.lock_file = None
+
+    def start(self):
+        if self.thread != None:
+            return
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="zap-trace")
+        self.thread = threading.Thread(target=self.run, name="zap-tracer", daemon=True)
+        self.thread.start()
+
+    def shutdown(self):
+        self.stopped.set()
+        self.wakeup.set()
+        if self.executor != None:
+            self.executor.shutdown(wait=False)
+
+    def wake(self):
+        """新任务创建后立即开始追踪"""
+        self.wakeup.set()
+
+    def next_interval(self, task_id: int, running_status: InternStatus, progress: Optional[int],
+                      changed: bool, budget_left: Optional[float] = None) -> float:
+        """根据阶段进度估计下一次轮询的间隔
+
+        Keyword arguments:
+        budget_left: 阶段预算剩余的秒数, 没有预算时为None
+        """
+        now = time.monotonic()
+        if changed or task_id not in self.phase_start or self.phase_start[task_id][0] != running_status:
+            self.phase_start[task_id] = (running_status, now, progress)
+            return self.min_interval
+        _, start_time, start_progress = self.phase_start[task_id]
+        elapsed = now - start_time
+        if progress == None or start_progress == None:
+            # 没有进度(ajax爬虫), 按已经过的时间逐渐放慢, 预算快用完时阶段即将结束, 加快轮询
+            interval = elapsed / 10
+            if budget_left != None:
+                interval = min(interval, budget_left / 2)
+            return min(max(interval, self.min_interval), self.max_interval)
+        if running_status == InternStatus.PASSIVE:
+            # 被动扫描阶段的进度为剩余记录数, 降到10以下即完成
+            done, remaining = start_progress - progress, max(progress - 10, 0)
+        else:
+            done, remaining = progress - start_progress, max(100 - progress, 0)
+        if done <= 0:
+            # 还没有进度变化, 按已经过的时间逐渐放慢
+            interval = elapsed / 10
+        else:
+            interval = remaining * elapsed / done / 2
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def step(self, task_id: int):
+        """推进一个任务的扫描阶段, 并安排下一次轮询"""
+        interval = self.max_interval
+        # 任务结束时事件与任务状态一起提交, 提交后唤醒发送器
+        finished = False
+        try:
+            with get_db_session() as db_session:
+                task = db_session.query(VtZapTask).filter_by(id=task_id).first()
+                if task == None or task.status != TaskStatus.RUNNING:
+                    return
+                zap = get_zap_conn()
+                metrics = PhaseMetrics(task.phase_metrics)
+                budget = get_phase_budget(db_session, site=target_site(task.target), exclude_id=task.id)
+                running_status, running_id, msg, progress = handle_zap_task(zap=zap, task=task, metrics=metrics,
+                                                                            budget=budget)
+                changed = running_status != task.running_status
                 if running_status == InternStatus.FAILED:
                     task.status = TaskStatus.FAILED
                     task.errmsg = msg
+                    record_task_event(db_session, task.id, TaskStatus.FAILED.value, errmsg=msg)
+                    finished = True
                 if running_status == InternStatus.DONE:
                     task.status = TaskStatus.DONE
                     task.finish_time = datetime.now()
-                if running_status != task.running_status:
+                    record_task_event(db_session, task.id, TaskStatus.DONE.value, report_ready=True)
+                    finished = True
+                if metrics.changed:
+                    task.phase_metrics = metrics.dumps()
+                if changed or running_id != task.running_id or metrics.changed:
                     task.running_status = running_status
+                    task.running_id = running_id
                     db_session.add(task)
-            db_session.flush()
-       
-    except Exception as e:
-        logger.error(f"trace zap task error: {e}")
+                db_session.flush()
+                interval = self.next_interval(task_id, running_status, progress, changed,
+                                              budget_left(metrics, running_status))
+            if finished:
+                task_event_sender.wake()
+        except Exception as e:
+            logger.error(f"trace zap task {task_id} error: {e}")
+        finally:
+            with self.lock:
+                self.next_poll[task_id] = time.monotonic() + interval
+                self.inflight.discard(task_id)
+            self.wakeup.set()
+
+    def poll(self) -> float:
+        """提交到期的任务, 返回距离下一次到期的时间"""
+        with get_db_session() as db_session:
+            task_ids = [task.id for task in get_db_running_task(db_session=db_session)]
+        now = time.monotonic()
+        wait = self.max_interval
+        with self.lock:
+            # 已结束的任务不再追踪
+            for task_id in list(self.next_poll):
+                if task_id not in task_ids and task_id not in self.inflight:
+                    self.next_poll.pop(task_id, None)
+                    self.phase_start.pop(task_id, None)
+            for task_id in task_ids:
+                if task_id in self.inflight:
+                    continue
+                due = self.next_poll.get(task_id, now)
+                if due <= now:
+                    self.inflight.add(task_id)
+                    self.executor.submit(self.step, task_id)
+                else:
+                    wait = min(wait, due - now)
+        return wait
+
+    def acquire_process_lock(self) -> bool:
+        """尝试获取追踪器的文件锁, 进程退出时由系统释放"""
+        lock_file = open(traceLockFile, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+    def run(self):
+        while not self.stopped.is_set() and not self.acquire_process_lock():
+            # 其他worker正在追踪, 等待其退出后接替
+            self.stopped.wait(self.max_interval)
+        while not self.stopped.is_set():
+            wait = self.max_interval
+            # 先清除再提交, 提交后完成的任务会重新唤醒
+            self.wakeup.clear()
+            try:
+                wait = self.poll()
+            except Exception as e:
+                logger.error(f"trace zap task error: {e}")
+            self.wakeup.wait(wait)
 
-# 添加作业到调度器
-scheduler.add_job(zap_task_trace_task, 'interval', seconds=10)
\ No newline at end of file
+# 全局唯一的任务追踪器
+tracer = ZapTaskTracer(workers=traceWorkers, min_interval=traceMinInterval, max_interval=traceMaxInterval)
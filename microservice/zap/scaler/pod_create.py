@@ -1,7 +1,13 @@
+import copy
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
 import yaml
 from kubernetes import client, config
 from datetime import datetime
 from k8s_client import load_kube_config
+from k8s_informer import Informer, new_node_informer
 import random
 import string
 import logging
@@ -13,6 +19,21 @@ logging.basicConfig(
     datefmt='%Y-%m-%dT%H:%M:%S%z'
 )
 logger = structlog.wrap_logger(logging.getLogger())
+# node信息的本地缓存, 检查node标签时不再每次请求API server
+node_informer: Informer = None
+# 复用的CoreV1Api实例, 底层连接池在多次创建之间共享
+core_api: client.CoreV1Api = None
+# 批量创建pod的并发数
+podCreateWorkers = int(os.getenv("POD_CREATE_WORKERS", "8"))
+pod_create_executor = ThreadPoolExecutor(max_workers=podCreateWorkers, thread_name_prefix="pod-create")
+
+def start_informers():
+    """加载k8s配置并启动node缓存, 服务启动时调用一次"""
+    global node_informer
+    load_kube_config()
+    if node_informer == None:
+        node_informer = new_node_informer()
+        node_informer.start()
 
 def generate_unique_pod_name(base_name='openvas'):
     """Generate a unique pod name based on the given base name."""
@@ -28,12 +49,16 @@ def check_node_label(node_name: str, label_key='openvas_data', label_value='read
     :param label_value: 标签值
     :return: 如果存在返回True, 否则返回False
     """
-    load_kube_config()
-    # 创建CoreV1Api实例
-    api_instance = client.CoreV1Api()
     try:
-        # 获取指定节点的信息
-        node = api_instance.read_node(name=node_name)
+        # 获取指定节点的信息, 缓存未同步时直接请求API server
+        if node_informer != None and node_informer.has_synced():
+            node = node_informer.get(node_name)
+            if node == None:
+                logger.error(f"Node {node_name} not found.")
+                return False
+        else:
+            load_kube_config()
+            node = client.CoreV1Api().read_node(name=node_name)
         # 检查节点标签
         labels = node.metadata.labels or {}
         if labels.get(label_key) == label_value:
@@ -45,20 +70,80 @@ def check_node_label(node_name: str, label_key='openvas_data', label_value='read
         logger.error(f"Exception when calling CoreV1Api->read_node {node_name}: %s\n" % e)
         return False
 
-def create_pod_from_yaml(node_name: str, yaml_path: str="./zap-pod.yml", namespace: str='vtscanner'):
-    # 加载配置
-    load_kube_config()
-    # 创建API实例
-    api_instance = client.CoreV1Api()
-    with open(yaml_path) as f:
-        pod_manifest = yaml.safe_load(f)
+def get_core_api() -> client.CoreV1Api:
+    global core_api
+    if core_api == None:
+        load_kube_config()
+        core_api = client.CoreV1Api()
+    return core_api
+
+def validate_pod_manifest(pod_manifest: dict):
+    """校验pod模板, 不合法时抛出ValueError"""
+    if not isinstance(pod_manifest, dict) or pod_manifest.get('kind') != 'Pod':
+        raise ValueError("template is not a Pod manifest")
+    metadata = pod_manifest.get('metadata')
+    if not isinstance(metadata, dict) or not metadata.get('name'):
+        raise ValueError("metadata.name is required")
+    if not (metadata.get('labels') or {}).get('engine'):
+        raise ValueError("metadata.labels.engine is required")
+    containers = (pod_manifest.get('spec') or {}).get('containers')
+    if not containers:
+        raise ValueError("spec.containers is required")
+    for container in containers:
+        if not container.get('name') or not container.get('image'):
+            raise ValueError("container name and image are required")
+
+class PodTemplate:
+    """pod模板缓存: 只在文件修改时间变化时重新读取并校验, 校验失败时继续使用上一次的模板
+
+    Keyword arguments:
+    yaml_path: 模板文件路径
+    """
+
+    def __init__(self, yaml_path: str):
+        self.yaml_path = yaml_path
+        self.mtime: float = None
+        self.manifest: dict = None
+        self.lock = threading.Lock()
+
+    def load(self) -> dict:
+        """返回模板的副本, 调用方可以直接修改"""
+        mtime = os.path.getmtime(self.yaml_path)
+        with self.lock:
+            if mtime != self.mtime:
+                try:
+                    with open(self.yaml_path) as f:
+                        pod_manifest = yaml.safe_load(f)
+                    validate_pod_manifest(pod_manifest)
+                    self.manifest = pod_manifest
+                    logger.info(f"Pod template {self.yaml_path} loaded")
+                except Exception as e:
+                    if self.manifest == None:
+                        raise
+                    logger.error(f"Pod template {self.yaml_path} invalid, keep the previous one: {e}")
+                self.mtime = mtime
+            return copy.deepcopy(self.manifest)
+
+pod_templates: Dict[str, PodTemplate] = {}
+pod_templates_lock = threading.Lock()
+
+def load_pod_template(yaml_path: str) -> dict:
+    with pod_templates_lock:
+        if yaml_path not in pod_templates:
+            pod_templates[yaml_path] = PodTemplate(yaml_path)
+        template = pod_templates[yaml_path]
+    return template.load()
+
+def build_pod_manifest(node_name: str, yaml_path: str, standby: bool = False) -> dict:
+    pod_manifest = load_pod_template(yaml_path)
     # 动态设置Pod名称
-    pod_manifest['metadata']['name'] = generate_unique_pod_name(pod_manifest.get('metadata', {}).get('name', 'example-pod'))
-    # 设置Node选择
-    target_node = node_name
+    pod_manifest['metadata']['name'] = generate_unique_pod_name(pod_manifest['metadata']['name'])
+    # 热备pod打上standby标签, 由资源管理器记录为STANDBY状态
+    if standby:
+        pod_manifest['metadata'].setdefault('labels', {})['standby'] = 'true'
     # 使用nodeSelector
-    pod_manifest['spec']['nodeSelector'] = {
-        "kubernetes.io/hostname": target_node
+    pod_manifest.setdefault('spec', {})['nodeSelector'] = {
+        "kubernetes.io/hostname": node_name
     }
     # 或者使用affinity
     # pod_manifest['spec']['affinity'] = {
@@ -70,7 +155,7 @@ def create_pod_from_yaml(node_name: str, yaml_path: str="./zap-pod.yml", namespa
     #                         {
     #                             "key": "kubernetes.io/hostname",
     #                             "operator": "In",
-    #                             "values": [target_node]
+    #                             "values": [node_name]
     #                         }
     #                     ]
     #                 }
@@ -78,18 +163,40 @@ def create_pod_from_yaml(node_name: str, yaml_path: str="./zap-pod.yml", namespa
     #         }
     #     }
     # }
+    return pod_manifest
+
+def create_pod(node_name: str, yaml_path: str, namespace: str = 'vtscanner', standby: bool = False) -> dict:
+    """在node上创建一个pod
+    
+    Return:
+    {
+        "node": "node1",
+        "name": "openvas-xxxxx",
+        "ok": True,
+        "errmsg": ""
+    }
+    """
+    result = {"node": node_name, "name": None, "ok": False, "errmsg": ""}
     try:
+        pod_manifest = build_pod_manifest(node_name=node_name, yaml_path=yaml_path, standby=standby)
+        result['name'] = pod_manifest['metadata']['name']
         # 创建Pod
-        api_response = api_instance.create_namespaced_pod(
+        api_response = get_core_api().create_namespaced_pod(
             body=pod_manifest,
             namespace=namespace
         )
-        logger.info(f"Pod {pod_manifest['metadata']['name']} created. status='%s'" % str(api_response.status))
-        return True
+        logger.info(f"Pod {result['name']} created. status='%s'" % str(api_response.status))
+        result['ok'] = True
     except Exception as e:
-        logger.error(f"Exception when creating Pod {pod_manifest['metadata']['name']}: %s\n" % e)
-        return False
+        logger.error(f"Exception when creating Pod {result['name']} on node {node_name}: %s\n" % e)
+        result['errmsg'] = str(e)
+    return result
+
+def create_pods(node_names: List[str], yaml_path: str, namespace: str = 'vtscanner', standby: bool = False) -> List[dict]:
+    """并发创建多个pod, node_names中每一项创建一个pod, 按顺序返回每个pod的结果, 格式同create_pod"""
+    futures = [pod_create_executor.submit(create_pod, node_name, yaml_path, namespace, standby)
+               for node_name in node_names]
+    return [future.result() for future in futures]
 
-if __name__ == '__main__':
-    # 假设你的Pod YAML文件位于当前目录下，并且名为pod.yaml
-    create_pod_from_yaml('pod.yaml', 'default')  # 根据需要更改命名空间
\ No newline at end of file
+def create_pod_from_yaml(node_name: str, yaml_path: str, namespace: str='vtscanner', standby: bool = False):
+    return create_pod(node_name=node_name, yaml_path=yaml_path, namespace=namespace, standby=standby)['ok']
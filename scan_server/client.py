@@ -9,8 +9,12 @@ from config import logger
 from pygvm.pygvm import Pygvm
 from pygvm.exceptions import HTTPError
 from config import settings
-import requests
+from http_client import http_client, httpConnectTimeout
 from sqlctrl import insert_splite_task, get_splite_task
+import os
+
+# 获取扫描结果的读超时(秒)
+resultReadTimeout = float(os.getenv("RESULT_READ_TIMEOUT", "300"))
 
 
 def get_gvm_conn() -> Pygvm:
@@ -207,9 +211,10 @@ def map_to_scanners(splite_num:int, target:str, id: str):
     for scanner_host in scanner_list:
         url = f"http://{scanner_host}/gvm/get_task_num"
         try:
-            resp = requests.get(
+            resp = http_client.get(
                 url,
-                headers={'secret-key':settings.secret_key}
+                headers={'secret-key':settings.secret_key},
+                hedge=True
             )
             resp.raise_for_status()
             data = resp.json()
@@ -249,7 +254,7 @@ def map_to_scanners(splite_num:int, target:str, id: str):
             scanner_host = scanner_task_list[idx][0]
             try:
                 url = f"http://{scanner_host}/gvm/create_task_with_config"
-                resp = requests.post(
+                resp = http_client.post(
                     url,
                     headers={'secret-key':settings.secret_key},
                     params={'target':target, 'id':id, 'num':num, 'splite_num':splite_num}
@@ -285,7 +290,7 @@ def get_splite_task_status(id: str):
         task_id = task[1]
         try:
             url = f"http://{scanner_host}/gvm/get_task"
-            resp = requests.post(
+            resp = http_client.post(
                 url,
                 headers={'secret-key':settings.secret_key},
                 params={'running_id':task_id}
@@ -315,10 +320,12 @@ def reduce_splite_task(id: str):
         task_id = task[1]
         try:
             url = f"http://{scanner_host}/gvm/get_task_result"
-            resp = requests.post(
+            # 扫描结果较大, 单独放宽读超时
+            resp = http_client.post(
                 url,
                 headers={'secret-key':settings.secret_key},
-                params={'running_id':task_id}
+                params={'running_id':task_id},
+                timeout=(httpConnectTimeout, resultReadTimeout)
             )
             data = resp.json()
             if not data['ok']:
@@ -347,7 +354,7 @@ def delete_splite_task_with_id(id: str):
         task_id = task[1]
         try:
             url = f"http://{scanner_host}/gvm/delete_task"
-            resp = requests.post(
+            resp = http_client.post(
                 url,
                 headers={'secret-key':settings.secret_key},
                 params={'running_id':task_id}
@@ -0,0 +1,228 @@
+import functools
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from config import logger
+
+# 服务间调用的HTTP客户端
+# - 每个host一个带连接池的Session, 连接复用
+# - 默认的连接/读超时
+# - 每个host一个熔断器: 连续失败达到阈值后打开, 打开期间直接失败, 不再等待重试;
+#   冷却后放行一个探测请求, 成功则关闭
+# - 失败后按指数退避加随机抖动重试: 连接没有建立(请求一定没有发出)时对所有请求重试,
+#   连接中断、读超时与5xx时请求可能已经执行, 只对幂等请求重试
+# - 可选对冲请求: 幂等的状态查询在hedge_delay内没有返回时再发一个, 取先返回的结果
+
+httpPoolSize = int(os.getenv("HTTP_POOL_SIZE", "8"))
+httpConnectTimeout = float(os.getenv("HTTP_CONNECT_TIMEOUT", "2"))
+httpReadTimeout = float(os.getenv("HTTP_READ_TIMEOUT", "10"))
+# 首次请求之外的最大重试次数
+httpRetryNum = int(os.getenv("HTTP_RETRY_NUM", "3"))
+# 第n次重试前等待[0, min(max, base * 2^n)]内的随机时间(秒)
+httpBackoffBase = float(os.getenv("HTTP_BACKOFF_BASE", "0.5"))
+httpBackoffMax = float(os.getenv("HTTP_BACKOFF_MAX", "8"))
+# 对冲请求的等待时间(秒)
+httpHedgeDelay = float(os.getenv("HTTP_HEDGE_DELAY", "0.5"))
+# 连续失败多少次后熔断, 熔断后多少秒放行探测请求
+breakerFailureThreshold = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "3"))
+breakerResetTimeout = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """目标host已熔断, 请求没有发出"""
+
+class CircuitBreaker:
+    """单个host的熔断器
+
+    Keyword arguments:
+    failure_threshold: 连续失败多少次后打开
+    reset_timeout: 打开后多少秒进入半开, 放行一个探测请求
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if self.state == CircuitBreaker.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                # 只放行一个探测请求, 结果返回前其他请求继续直接失败
+                self.state = CircuitBreaker.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = CircuitBreaker.OPEN
+                self.opened_at = time.monotonic()
+
+def connect_failed(e: requests.exceptions.ConnectionError) -> bool:
+    """连接是否没有建立, 例如连接被拒绝; 连接建立后被中断(Connection aborted)时请求可能已经发出"""
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    # requests的ConnectionError包装了urllib3的MaxRetryError, 其reason为实际的连接错误
+    reason = e.args[0] if e.args else None
+    reason = getattr(reason, 'reason', reason)
+    return isinstance(reason, (NewConnectionError, ConnectionRefusedError))
+
+def backoff(attempt: int) -> float:
+    """第attempt次重试前的等待时间, 全抖动的指数退避"""
+    return random.uniform(0, min(httpBackoffMax, httpBackoffBase * (2 ** attempt)))
+
+class HttpClient:
+    """带连接池、超时、熔断、重试与对冲的HTTP客户端, 线程安全
+
+    Keyword arguments:
+    timeout: 默认的(连接超时, 读超时)
+    retry_num: 默认的最大重试次数
+    """
+
+    def __init__(self, timeout: Tuple[float, float], retry_num: int):
+        self.timeout = timeout
+        self.retry_num = retry_num
+        self.sessions: Dict[str, requests.Session] = {}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.lock = threading.Lock()
+        self.hedge_executor = ThreadPoolExecutor(max_workers=httpPoolSize, thread_name_prefix="http-hedge")
+
+    def host_state(self, host: str) -> Tuple[requests.Session, CircuitBreaker]:
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=httpPoolSize)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.sessions[host] = session
+                self.breakers[host] = CircuitBreaker(breakerFailureThreshold, breakerResetTimeout)
+            return self.sessions[host], self.breakers[host]
+
+    def is_open(self, url: str) -> bool:
+        """目标host是否处于熔断状态, 调用方可以据此直接跳过"""
+        _, breaker = self.host_state(urlparse(url).netloc)
+        return breaker.state == CircuitBreaker.OPEN
+
+    def send(self, session: requests.Session, breaker: CircuitBreaker, method: str, url: str,
+             **kwargs) -> requests.Response:
+        """发送一次请求并更新熔断器, 5xx视为失败"""
+        if not breaker.allow():
+            raise CircuitOpenError(f"circuit open for {urlparse(url).netloc}")
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            breaker.record_failure()
+            raise
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return response
+
+    def send_hedged(self, session: requests.Session, breaker: CircuitBreaker, method: str, url: str,
+                    **kwargs) -> requests.Response:
+        """先发一个请求, hedge_delay内没有返回时再发一个, 返回先成功的结果"""
+        futures = [self.hedge_executor.submit(self.send, session, breaker, method, url, **kwargs)]
+        done, _ = wait(futures, timeout=httpHedgeDelay)
+        if not done:
+            futures.append(self.hedge_executor.submit(self.send, session, breaker, method, url, **kwargs))
+        error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                if response.status_code < 500 or not pending:
+                    return response
+        raise error
+
+    def request(self, method: str, url: str, retry_num: Optional[int] = None, hedge: bool = False,
+                **kwargs) -> requests.Response:
+        """发送请求, 失败时按退避重试, 熔断时抛出CircuitOpenError
+
+        Keyword arguments:
+        retry_num: 最大重试次数, 默认使用客户端的配置
+        hedge: 是否发起对冲请求, 只用于幂等的查询
+        kwargs: 传给requests的参数, 未指定timeout时使用默认超时
+        """
+        method = method.upper()
+        retry_num = self.retry_num if retry_num == None else retry_num
+        idempotent = method in IDEMPOTENT_METHODS
+        kwargs.setdefault('timeout', self.timeout)
+        session, breaker = self.host_state(urlparse(url).netloc)
+        attempt = 0
+        while True:
+            try:
+                if hedge and idempotent:
+                    response = self.send_hedged(session, breaker, method, url, **kwargs)
+                else:
+                    response = self.send(session, breaker, method, url, **kwargs)
+                if response.status_code < 500 or not idempotent or attempt >= retry_num:
+                    return response
+                # 丢弃的5xx响应需要关闭, stream=True时否则连接不会归还连接池
+                response.close()
+            except CircuitOpenError:
+                raise
+            except requests.exceptions.ConnectTimeout:
+                if attempt >= retry_num:
+                    raise
+            except requests.exceptions.Timeout:
+                # 读超时时请求可能已经执行, 非幂等请求不重试
+                if not idempotent or attempt >= retry_num:
+                    raise
+            except requests.exceptions.ConnectionError as e:
+                # 连接中断时请求可能已经执行, 非幂等请求只在连接没有建立时重试
+                if (not idempotent and not connect_failed(e)) or attempt >= retry_num:
+                    raise
+            time.sleep(backoff(attempt))
+            attempt += 1
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> requests.Response:
+        return self.request('DELETE', url, **kwargs)
+
+def none_on_unavailable(func):
+    """目标服务不可用(重试耗尽或已熔断)时记录日志并返回None"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, CircuitOpenError) as e:
+            logger.error(f"{func.__name__} failed, service unavailable: {e}")
+            return None
+    return wrapper
+
+# 进程内共用的客户端
+http_client = HttpClient(timeout=(httpConnectTimeout, httpReadTimeout), retry_num=httpRetryNum)
@@ -1,18 +1,47 @@
 import sqlite3
+import threading
 import time
 import os
 from config import logger
 data_path = '/home/gunicorn/data.db'
+# 写锁等待时间(毫秒), 多个worker进程同时写时等待而不是直接报database is locked
+busy_timeout = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))
+
+# 每个线程复用一个连接, 不再每次调用都新建连接
+# WAL模式下读写互不阻塞, synchronous=NORMAL在WAL模式下只在checkpoint时fsync
+_local = threading.local()
+
+def get_conn() -> sqlite3.Connection:
+    con = getattr(_local, 'con', None)
+    # gunicorn fork出的worker进程不能复用父进程的连接
+    if con is not None and _local.pid == os.getpid():
+        return con
+    con = sqlite3.connect(data_path, timeout=busy_timeout / 1000)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute(f"PRAGMA busy_timeout={busy_timeout}")
+    _local.con = con
+    _local.pid = os.getpid()
+    return con
+
+def reset_conn():
+    """出错后丢弃当前线程的连接, 未提交的事务随之回滚, 下次调用重新连接"""
+    con = getattr(_local, 'con', None)
+    _local.con = None
+    if con is not None and _local.pid == os.getpid():
+        try:
+            con.close()
+        except Exception:
+            pass
 
 def create_task_table():
     try:
-        con = sqlite3.connect(data_path)
+        con = get_conn()
         cur = con.cursor()
         cur.execute("CREATE TABLE vara(id, running_id, finished_time)")
         cur.execute("INSERT INTO vara VALUES(0, NULL, NULL)")    
         con.commit()
         cur.close()
-        con.close()
     except sqlite3.OperationalError:
         return True
     except Exception as e:
@@ -21,39 +50,48 @@ def create_task_table():
 
 def create_splite_task_table():
     try:
-        con = sqlite3.connect(data_path)
+        con = get_conn()
         cur = con.cursor()
         cur.execute("CREATE TABLE tasks(id, scanner, task_id)")
         cur.execute("INSERT INTO tasks VALUES(0, NULL, NULL)")    
         con.commit()
         cur.close()
-        con.close()
     except sqlite3.OperationalError:
         return True
     except Exception as e:
         logger.error("Create sql tasks Error: " + str(e))
     return True
 
+def create_splite_task_index():
+    """按id查询子任务, 已存在的库同样需要创建"""
+    try:
+        con = get_conn()
+        con.execute("CREATE INDEX IF NOT EXISTS idx_tasks_id ON tasks(id)")
+        con.commit()
+    except Exception as e:
+        reset_conn()
+        logger.error("Create sql tasks index Error: " + str(e))
+    return True
+
 def insert_splite_task(id:str, task_id:str, scanner:str):
     try:
-        con = sqlite3.connect(data_path)
+        con = get_conn()
         cur = con.cursor()
-        cur.execute(f"INSERT INTO tasks VALUES('{id}', '{scanner}', '{task_id}')")    
+        cur.execute("INSERT INTO tasks VALUES(?, ?, ?)", (id, scanner, task_id))
         con.commit()
         cur.close()
-        con.close()
     except Exception as e:
+        reset_conn()
         logger.error("insert sql tasks Error: " + str(e))
     return True
 
 def get_splite_task(id:str):
     try:
-        con = sqlite3.connect(data_path)
+        con = get_conn()
         cur = con.cursor()
-        res = cur.execute(f"SELECT scanner,task_id FROM tasks WHERE id = '{id}'")
+        res = cur.execute("SELECT scanner,task_id FROM tasks WHERE id = ?", (id,))
         task_list = res.fetchall()
         cur.close()
-        con.close()
         return True, task_list
     except Exception as e:
         logger.error("Get sql tasks Error: " + str(e))
@@ -61,14 +99,13 @@ def get_splite_task(id:str):
 
 def get_data():
     try:
-        con = sqlite3.connect(data_path)
+        con = get_conn()
         cur = con.cursor()
         res = cur.execute("SELECT running_id, finished_time FROM vara WHERE id=0")
         data = res.fetchone()
         running_id = data[0]
         finished_time = data[1]
         cur.close()
-        con.close()
         return True, running_id, finished_time
     except Exception as e:
         logger.error("Get sql data Error: " + str(e))
@@ -77,25 +114,14 @@ def get_data():
 
 def update_date(running_id, finished_time):
     try:
-        con = sqlite3.connect(data_path)
+        con = get_conn()
         cur = con.cursor()
-        sql = "UPDATE vara SET "
-        if running_id is None:
-            sql += "running_id=NULL, "
-        else:
-            sql += "running_id='%s', " % running_id 
-        if finished_time is None:
-            sql += "finished_time=NULL "
-        else:
-            sql += "finished_time=%s " % finished_time
-        sql += "WHERE id=0"
-        #sql = "UPDATE vara SET running_id='%s' ,finished_time=%s WHERE id=0"% (running_id, finished_time)
-        cur.execute(sql)
+        cur.execute("UPDATE vara SET running_id=?, finished_time=? WHERE id=0", (running_id, finished_time))
         con.commit()
         cur.close()
-        con.close()
         return True
     except Exception as e:
+        reset_conn()
         logger.error("Update sql data Error: " + str(e))
         return False
 
@@ -103,6 +129,7 @@ def update_date(running_id, finished_time):
 if not os.path.exists(data_path):
     create_task_table()
     create_splite_task_table()
+create_splite_task_index()
 
 if __name__ == '__main__':
     y = 122